@@ -0,0 +1,147 @@
+"""
+Measures how much of a video stays in the page cache (and how much memory the process uses)
+after streaming it the way ResumableUpload does, for each reader mode.
+
+Usage: python benchmarks/page_cache.py [--file PATH] [--size-mib N] [--chunk-mib N] [--json PATH]
+
+Without --file, a file of --size-mib random data is created next to this script (on the same disk
+as the repository, since tmpfs can't show page cache behaviour). Every mode runs in a fresh
+interpreter, so the peak RSS of each is reported separately.
+"""
+
+import os
+import sys
+import json
+import mmap
+import time
+import ctypes
+import resource
+import subprocess
+from datetime import datetime
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__ + "/.."))
+sys.path.insert(0, ROOT_DIR + "/src")
+
+MODES = ("buffered", "fadvise", "direct")
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def get_arg(name: str, default):
+    return type(default)(sys.argv[sys.argv.index(name) + 1]) if name in sys.argv else default
+
+
+def cached_fraction(path: str) -> float:
+    """The fraction of the file's pages that are in the page cache (using mincore(2))."""
+    size = os.path.getsize(path)
+    if size == 0:
+        return 0.0
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    page_count = (size + PAGE_SIZE - 1) // PAGE_SIZE
+    vector = (ctypes.c_ubyte * page_count)()
+
+    with open(path, "rb") as file:
+        # ACCESS_COPY gives a writable (so addressable from ctypes) mapping that never touches the file
+        mapped = mmap.mmap(file.fileno(), size, access=mmap.ACCESS_COPY)
+        try:
+            address = ctypes.addressof(ctypes.c_char.from_buffer(mapped))
+            if libc.mincore(ctypes.c_void_p(address), ctypes.c_size_t(size), vector) != 0:
+                raise OSError(ctypes.get_errno(), "mincore failed")
+        finally:
+            del address
+            mapped.close()
+
+    return sum(page & 1 for page in vector) / page_count
+
+
+def evict(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def stream(path: str, mode: str, chunk_size: int):
+    """Reads the whole file in chunks like ResumableUpload.upload_next_chunk."""
+    from video_reader import VideoFileReader
+
+    if mode == "buffered":
+        file = open(path, "rb")
+    else:
+        file = VideoFileReader(path, direct=mode == "direct", drop_cache=True)
+
+    total = 0
+    with file:
+        while 1:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            total += len(chunk)
+            del chunk
+
+    return total
+
+
+def run_mode(path: str, mode: str, chunk_size: int) -> dict:
+    evict(path)
+    start = time.perf_counter()
+    total = stream(path, mode, chunk_size)
+    seconds = time.perf_counter() - start
+
+    return {
+        "mode": mode,
+        "seconds": seconds,
+        "mb_per_second": total / seconds / 1_000_000 if seconds else 0,
+        "cached_fraction": cached_fraction(path),
+        "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    }
+
+
+def create_test_file(path: str, size: int):
+    block = os.urandom(8 * 1024 * 1024)
+    with open(path, "wb") as file:
+        written = 0
+        while written < size:
+            file.write(block[:size - written])
+            written += min(len(block), size - written)
+
+
+def main():
+    if "--mode" in sys.argv:
+        # A single mode, run by the parent process in a fresh interpreter
+        print(json.dumps(run_mode(get_arg("--file", ""), get_arg("--mode", ""), get_arg("--chunk-mib", 64) * 1024 * 1024)))
+        return
+
+    path = get_arg("--file", "")
+    created = False
+    if not path:
+        path = ROOT_DIR + "/benchmarks/page_cache_test.bin"
+        create_test_file(path, get_arg("--size-mib", 1024) * 1024 * 1024)
+        created = True
+
+    try:
+        results = []
+        for mode in MODES:
+            output = subprocess.run(
+                [sys.executable, __file__, "--mode", mode, "--file", path, "--chunk-mib", str(get_arg("--chunk-mib", 64))],
+                capture_output=True, text=True, check=True
+            ).stdout
+            results.append(json.loads(output))
+    finally:
+        if created:
+            os.remove(path)
+
+    print(f"{'mode':<10}{'MB/s':>10}{'cached after':>15}{'peak RSS (MiB)':>17}")
+    for result in results:
+        print(f"{result['mode']:<10}{result['mb_per_second']:>10.1f}{result['cached_fraction']:>14.1%}{result['peak_rss_mib']:>17.1f}")
+
+    if "--json" in sys.argv:
+        with open(get_arg("--json", ""), "a") as file:
+            file.write(json.dumps({"date": datetime.now().isoformat(), "results": results}) + "\n")
+
+
+if __name__ == "__main__":
+    main()
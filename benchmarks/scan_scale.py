@@ -0,0 +1,269 @@
+"""
+Simulates a recordings folder and Twitch channel at scale to measure the scan and match path:
+get_valid_videos_in_watch_folder, match_video_with_vod (with a VodIndex) and the upload history checks.
+
+Usage: python benchmarks/scan_scale.py [--files N] [--vods N] [--uploaded FRACTION] [--repeat N]
+                                       [--linear-sample N] [--dir PATH] [--json PATH]
+
+A folder of --files sparse MP4s (default 50000, taking no disk space) is generated in a temporary
+directory that's removed afterwards (or in --dir, which is kept and reused by later runs), along with
+--vods synthetic VODs (default 10000) in the format of data/test_data.json and an upload history
+holding --uploaded of them. Most files are modified within their VOD's window, the rest are too
+small, too new or don't match any VOD.
+
+For every stage the median wall time, the stat calls made and the peak memory (tracemalloc, in a
+separate run) are reported. The linear search matching used to do is timed on --linear-sample
+files (extrapolated to all of them) and checked to match the same VODs.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import statistics
+import tracemalloc
+from datetime import datetime, timezone
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__ + "/.."))
+sys.path.insert(0, ROOT_DIR + "/src")
+
+import bot  # noqa: E402
+import state  # noqa: E402
+from config import config  # noqa: E402
+
+GIB = 1024 ** 3
+
+# VODs are 1 to 10 hours long, with a stream every ~12 hours
+MIN_VOD_SECONDS = 60 * 60
+MAX_VOD_SECONDS = 10 * 60 * 60
+STREAM_SPACING = 12 * 60 * 60
+
+
+def get_arg(name: str, default):
+    return type(default)(sys.argv[sys.argv.index(name) + 1]) if name in sys.argv else default
+
+
+def format_duration(seconds: int) -> str:
+    return f"{seconds // 3600}h{seconds % 3600 // 60}m{seconds % 60}s"
+
+
+def generate_vods(count: int, rng: random.Random) -> list:
+    """Synthetic VODs, newest first like the Twitch API returns them."""
+    start = time.time() - count * STREAM_SPACING - 7 * 24 * 60 * 60
+    vods = []
+    for i in range(count):
+        created_at = datetime.fromtimestamp(start + i * STREAM_SPACING + rng.randint(0, 3600), timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        vods.append({
+            "id": str(100_000_000 + i),
+            "user_id": config["twitch_user_id"] or "0",
+            "title": f"Synthetic stream {i}",
+            "created_at": created_at,
+            "published_at": created_at,
+            "url": f"https://www.twitch.tv/videos/{100_000_000 + i}",
+            "duration": format_duration(rng.randint(MIN_VOD_SECONDS, MAX_VOD_SECONDS))
+        })
+
+    return vods[::-1]
+
+
+def generate_folder(folder: str, file_count: int, vods: list, rng: random.Random):
+    """Creates sparse MP4s whose sizes and modified times are spread over the VODs."""
+    if os.path.isdir(folder) and sum(1 for name in os.listdir(folder) if name.endswith(".mp4")) == file_count:
+        return
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+
+    for i in range(file_count):
+        vod = rng.choice(vods)
+        vod_start, vod_end = bot.get_vod_match_window(vod)
+        kind = rng.random()
+
+        if kind < 0.85:
+            # A recording, modified within its VOD's window
+            modified_time = rng.uniform(vod_start, vod_end - 1)
+            size = rng.randint(1, 20) * GIB
+        elif kind < 0.9:
+            # Too small to be uploaded
+            modified_time = rng.uniform(vod_start, vod_end - 1)
+            size = rng.randint(1, 1000) * 1024 ** 2
+        elif kind < 0.95:
+            # Still being recorded
+            modified_time = time.time()
+            size = 2 * GIB
+        else:
+            # Recorded while the channel wasn't streaming
+            modified_time = vod_start - STREAM_SPACING / 3
+            size = 2 * GIB
+
+        path = os.path.join(folder, f"{i:06d}.mp4")
+        with open(path, "wb") as file:
+            file.truncate(size)
+        os.utime(path, (modified_time, modified_time))
+
+    # A few files the scan skips by name
+    for i in range(file_count // 100):
+        open(os.path.join(folder, f"{i:06d}.flv"), "wb").close()
+
+
+class StatCounter():
+    """Counts os.stat calls (os.path.isfile, getmtime, getsize, ...) and scandir entry stats."""
+
+    class Entry():
+        def __init__(self, entry, counter):
+            self.entry = entry
+            self.counter = counter
+            self.name = entry.name
+            self.path = entry.path
+
+        def is_file(self, *args, **kwargs):
+            return self.entry.is_file(*args, **kwargs)
+
+        def stat(self, *args, **kwargs):
+            self.counter.count += 1
+            return self.entry.stat(*args, **kwargs)
+
+    class ScandirIterator():
+        def __init__(self, iterator, counter):
+            self.iterator = iterator
+            self.counter = counter
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            self.iterator.close()
+
+        def __iter__(self):
+            return (StatCounter.Entry(entry, self.counter) for entry in self.iterator)
+
+    def __init__(self):
+        self.count = 0
+
+    def __enter__(self):
+        self.original_stat, self.original_scandir = os.stat, os.scandir
+
+        def counting_stat(*args, **kwargs):
+            self.count += 1
+            return self.original_stat(*args, **kwargs)
+
+        os.stat = counting_stat
+        os.scandir = lambda *args: StatCounter.ScandirIterator(self.original_scandir(*args), self)
+        return self
+
+    def __exit__(self, *args):
+        os.stat, os.scandir = self.original_stat, self.original_scandir
+
+
+def run_stages(folder: str, vods: list) -> dict:
+    """Runs the scan and match path once, returning {stage: (seconds, stat calls, result)}."""
+    stages = {}
+
+    def stage(name: str, func):
+        with StatCounter() as counter:
+            start = time.perf_counter()
+            result = func()
+            stages[name] = (time.perf_counter() - start, counter.count, result)
+        return result
+
+    video_files = stage("scan", lambda: bot.get_valid_videos_in_watch_folder(folder))
+    vod_index = stage("index", lambda: bot.VodIndex(vods))
+    matches = stage("match", lambda: {
+        file_path: bot.match_video_with_vod(file_path, modified_time, vod_index)
+        for file_path, modified_time in video_files.items()
+    })
+    stage("history", lambda: [state.check_vod_uploaded(vod["id"]) for vod in matches.values() if vod])
+
+    return stages
+
+
+def time_linear_matching(video_files: dict, vods: list, sample_size: int, index_matches: dict) -> tuple:
+    """Times the linear search on a sample of the videos, returning (extrapolated seconds, mismatches)."""
+    sample = list(video_files.items())[:sample_size]
+    if not sample:
+        return 0.0, 0
+
+    start = time.perf_counter()
+    linear_matches = {file_path: bot.match_video_with_vod(file_path, modified_time, vods) for file_path, modified_time in sample}
+    seconds = (time.perf_counter() - start) * len(video_files) / len(sample)
+
+    mismatches = sum(1 for file_path, vod in linear_matches.items() if vod is not index_matches[file_path])
+    return seconds, mismatches
+
+
+def main():
+    file_count = get_arg("--files", 50_000)
+    vod_count = get_arg("--vods", 10_000)
+    uploaded_fraction = get_arg("--uploaded", 0.5)
+    repeat = get_arg("--repeat", 3)
+    linear_sample = get_arg("--linear-sample", 200)
+    folder = get_arg("--dir", "") or tempfile.mkdtemp(prefix="scan_scale_")
+
+    rng = random.Random(0)
+    vods = generate_vods(vod_count, rng)
+
+    generate_start = time.perf_counter()
+    generate_folder(folder + "/recordings", file_count, vods, rng)
+    generate_time = f"{time.perf_counter() - generate_start:.1f}s"
+
+    state.UPLOAD_HISTORY_PATH = folder + "/upload_history.txt"
+    with open(state.UPLOAD_HISTORY_PATH, "w") as file:
+        file.writelines(vod["id"] + "\n" for vod in vods if rng.random() < uploaded_fraction)
+
+    # Only what's being measured gets logged
+    bot.logger.setLevel("WARNING")
+
+    runs = [run_stages(folder + "/recordings", vods) for _ in range(repeat)]
+
+    tracemalloc.start()
+    peaks = {}
+    for name in runs[0]:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        if name == "scan":
+            result = bot.get_valid_videos_in_watch_folder(folder + "/recordings")
+        elif name == "index":
+            result = bot.VodIndex(vods)
+        elif name == "match":
+            index = runs[0]["index"][2]
+            result = {file_path: bot.match_video_with_vod(file_path, modified_time, index) for file_path, modified_time in runs[0]["scan"][2].items()}
+        else:
+            result = [state.check_vod_uploaded(vod["id"]) for vod in runs[0]["match"][2].values() if vod]
+        peaks[name] = (tracemalloc.get_traced_memory()[1] - baseline) / 1024 ** 2
+        del result
+    tracemalloc.stop()
+
+    video_files, matches = runs[0]["scan"][2], runs[0]["match"][2]
+    linear_seconds, mismatches = time_linear_matching(video_files, vods, linear_sample, matches)
+
+    if "--dir" not in sys.argv:
+        shutil.rmtree(folder)
+
+    results = {
+        name: {
+            "seconds": statistics.median(run[name][0] for run in runs),
+            "stat_calls": runs[0][name][1],
+            "peak_mib": peaks[name]
+        }
+        for name in runs[0]
+    }
+
+    print(f"{file_count} files ({len(video_files)} valid, {sum(1 for vod in matches.values() if vod)} matched), {vod_count} VODs, generated in {generate_time}")
+    print(f"{'stage':<12}{'wall (ms)':>12}{'stat calls':>13}{'peak (MiB)':>13}")
+    for name, result in results.items():
+        print(f"{name:<12}{result['seconds'] * 1000:>12.1f}{result['stat_calls']:>13}{result['peak_mib']:>13.1f}")
+    print(f"linear search matching (extrapolated from {min(linear_sample, len(video_files))} files): {linear_seconds * 1000:.1f} ms, {mismatches} mismatches")
+
+    if "--json" in sys.argv:
+        output_path = sys.argv[sys.argv.index("--json") + 1]
+        with open(output_path, "a") as file:
+            file.write(json.dumps({
+                "date": datetime.now().isoformat(), "files": file_count, "vods": vod_count, "repeat": repeat,
+                "results": results, "linear_match_seconds": linear_seconds, "mismatches": mismatches
+            }) + "\n")
+
+
+if __name__ == "__main__":
+    main()
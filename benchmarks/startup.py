@@ -0,0 +1,97 @@
+"""
+Measures the startup (import) cost of each entry point in a fresh interpreter.
+
+Usage: python benchmarks/startup.py [--repeat N] [--json PATH]
+
+For every entry point, the wall time of the whole interpreter run is reported next to the
+cumulative import time of its modules (from python -X importtime), with the cost of an empty
+interpreter (python -c pass) listed as the baseline.
+"""
+
+import os
+import sys
+import json
+import time
+import statistics
+import subprocess
+from datetime import datetime
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__ + "/.."))
+SRC_DIR = ROOT_DIR + "/src"
+
+# name -> (modules imported by the entry point, extra command line arguments)
+ENTRY_POINTS = {
+    # The daemon imports the Google auth and upload stack in main()
+    "bot.py": (["bot", "youtube_auth", "upload"], []),
+    "bot.py --match-vods-only": (["bot"], ["--match-vods-only"]),
+    "youtube_auth": (["youtube_auth"], []),
+}
+
+
+def run_interpreter(code: str, args: list) -> tuple:
+    """Runs code in a fresh interpreter, returning (wall time in ms, stderr)."""
+    command = [sys.executable, "-X", "importtime", "-c", code] + args
+    start = time.perf_counter()
+    result = subprocess.run(command, cwd=SRC_DIR, capture_output=True, text=True)
+    wall_ms = (time.perf_counter() - start) * 1000
+
+    if result.returncode != 0:
+        raise RuntimeError(f"{command} failed:\n{result.stderr}")
+
+    return wall_ms, result.stderr
+
+
+def parse_import_time(importtime_output: str, modules: list) -> float:
+    """Sums the cumulative import time (in ms) of the given top level modules."""
+    total_us = 0
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if name.strip() in modules and not name.startswith("  "):
+            try:
+                total_us += int(cumulative)
+            except ValueError:
+                pass
+
+    return total_us / 1000
+
+
+def benchmark(repeat: int) -> dict:
+    results = {}
+
+    baseline = [run_interpreter("pass", [])[0] for _ in range(repeat)]
+    results["python -c pass"] = {"wall_ms": statistics.median(baseline), "import_ms": 0.0}
+
+    for name, (modules, args) in ENTRY_POINTS.items():
+        code = "import sys; sys.argv[1:] = " + repr(args) + "; " + "; ".join(f"import {module}" for module in modules)
+
+        wall_times, import_times = [], []
+        for _ in range(repeat):
+            wall_ms, stderr = run_interpreter(code, args)
+            wall_times.append(wall_ms)
+            import_times.append(parse_import_time(stderr, modules))
+
+        results[name] = {"wall_ms": statistics.median(wall_times), "import_ms": statistics.median(import_times)}
+
+    return results
+
+
+def main():
+    repeat = int(sys.argv[sys.argv.index("--repeat") + 1]) if "--repeat" in sys.argv else 10
+
+    results = benchmark(repeat)
+
+    print(f"{'entry point':<28}{'wall (ms)':>12}{'imports (ms)':>15}")
+    for name, result in results.items():
+        print(f"{name:<28}{result['wall_ms']:>12.1f}{result['import_ms']:>15.1f}")
+
+    if "--json" in sys.argv:
+        output_path = sys.argv[sys.argv.index("--json") + 1]
+        with open(output_path, "a") as file:
+            file.write(json.dumps({"date": datetime.now().isoformat(), "repeat": repeat, "results": results}) + "\n")
+
+
+if __name__ == "__main__":
+    main()
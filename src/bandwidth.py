@@ -0,0 +1,92 @@
+"""
+The upload bandwidth budget shared by every upload in the process (and every channel).
+
+A token bucket refilled at the configured rate: video data is only sent once the bucket has
+enough bytes for it, so the combined upload speed stays under the limit.
+"""
+
+import time
+import threading
+
+from config import config
+
+import logging
+logger = logging.getLogger()
+
+# bytes sent per read, and so per token bucket check
+BLOCK_SIZE = 64 * 1024
+
+bandwidth_budget = None
+
+
+class BandwidthBudget():
+    def __init__(self, bytes_per_second: float = None):
+        self.lock = threading.Lock()
+        self.bytes_per_second = None
+        self.tokens = 0
+        self.last_refill = time.monotonic()
+        self.set_rate(bytes_per_second)
+
+    def set_rate(self, bytes_per_second: float = None):
+        """Changes the limit (None or 0 for unlimited), taking effect right away."""
+        with self.lock:
+            self.bytes_per_second = bytes_per_second if bytes_per_second else None
+            # At most a second's worth of data can be sent in a burst
+            self.tokens = min(self.tokens, self.bytes_per_second or 0)
+            self.last_refill = time.monotonic()
+
+    def is_limited(self) -> bool:
+        return self.bytes_per_second is not None
+
+    def consume(self, amount: int):
+        """Blocks until amount bytes can be sent."""
+        while 1:
+            with self.lock:
+                if self.bytes_per_second is None:
+                    return
+
+                now = time.monotonic()
+                self.tokens = min(self.tokens + (now - self.last_refill) * self.bytes_per_second, max(self.bytes_per_second, amount))
+                self.last_refill = now
+
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+
+                wait_seconds = (amount - self.tokens) / self.bytes_per_second
+
+            time.sleep(wait_seconds)
+
+
+class ThrottledBody():
+    """
+    A chunk of video data that Requests streams through read() (its length is known, so the
+    request still has a Content-Length), consuming the budget as it goes.
+    """
+
+    def __init__(self, data: bytes, budget: BandwidthBudget):
+        self.data = memoryview(data)
+        self.budget = budget
+        self.position = 0
+
+    def __len__(self):
+        return len(self.data) - self.position
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0 or size > BLOCK_SIZE:
+            size = BLOCK_SIZE
+
+        block = self.data[self.position:self.position + size]
+        self.position += len(block)
+        if block:
+            self.budget.consume(len(block))
+        return bytes(block)
+
+
+def get_bandwidth_budget() -> BandwidthBudget:
+    global bandwidth_budget
+
+    if bandwidth_budget is None:
+        bandwidth_budget = BandwidthBudget(config["upload_bandwidth_limit"] * 1_000_000)
+
+    return bandwidth_budget
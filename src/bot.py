@@ -8,32 +8,51 @@ import os
 import sys
 import time
 import json
-from datetime import datetime, timedelta
-import pytz
+import logging
+import threading
+from bisect import bisect_left, bisect_right
+from datetime import datetime
 
-import twitch_api
-from resumable_upload import ResumableUpload
-from youtube_auth import init_google_session
-
-from upload import quick_upload_video
+import requests
 
-from state import check_in_progress_uploads, move_video_to_uploaded_folder
-from state import check_vod_uploaded
-
-from config import config
+import twitch_api
+import metrics
+
+from state import move_video_to_uploaded_folder
+from state import check_vod_uploaded, get_fingerprint_index, get_in_progress_upload
+from fingerprint import fingerprint_files
+
+from config import config, ConfigLoadError
+from quota import QUOTA_COSTS, get_configured_ledgers, get_time_until_quota_reset
+from upload_queue import estimate_upload_times, get_upload_queue
+from scheduler import Scheduler
+from post_upload import get_post_upload_pipeline
+from processing_status import ProcessingStatusPoller, MIN_POLL_INTERVAL
+from shutdown import install_signal_handlers, is_shutting_down, on_shutdown
+from channels import get_channels, get_vod_channel
+from upload_control import get_upload_controller
+from retention import RetentionManager
+from metadata_resync import MetadataResync
+from throughput import get_throughput_model
+import profiling
 
 from logs import setup_logger
 
+# The Google auth and upload modules (requests_oauthlib, etc) are imported in main(),
+# so --match-vods-only and other short lived invocations don't pay for them.
+
 # Command Line Arguments
 DRY_RUN_ENABLED = "--dry-run" in sys.argv
 DEBUG_ENABLED = "--debug" in sys.argv
 
 MATCH_VODS_ONLY = "--match-vods-only" in sys.argv
 IGNORE_FILE_SIZE_AND_AGE = "--no-size-age" in sys.argv
+# time the pipeline stages, and capture a cProfile / tracemalloc profile for profile_window seconds (see profiling.py)
+PROFILE_ENABLED = "--profile" in sys.argv
 
-# Google APIs reset quota at midnight PT
-pacific_tz = pytz.timezone("America/Los_Angeles")
-
+# --pin <VOD ID> / --unpin <VOD ID>: move a VOD to the front of the upload queue (or back)
+PIN_VOD_ID = sys.argv[sys.argv.index("--pin") + 1] if "--pin" in sys.argv[:-1] else None
+UNPIN_VOD_ID = sys.argv[sys.argv.index("--unpin") + 1] if "--unpin" in sys.argv[:-1] else None
 
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__ + "/.."))
 
@@ -41,127 +60,520 @@ STATE_FILE_PATH = ROOT_DIR + "/data/state.json"
 CONFIG_FILE_PATH = ROOT_DIR + "/data/config.json"
 UPLOAD_HISTORY_PATH = ROOT_DIR + "/data/upload_history.txt"
 
-logger = setup_logger(debug_enabled=DEBUG_ENABLED)
+logger = logging.getLogger()
 
 
-def watch_recordings_folder(google: dict):
+class RecordingsWatcher():
     """
-    Watches the recodings folder for new video files to show up that need to be uploaded.
-    Once a Twitch VOD corresponding to a video file is found, the video is uploaded using
-    the metadata from the Twitch VOD as it's own.
-
-    Refreshes the Twitch VOD information every twitch_vod_refresh_rate seconds (specified in config.json).
-    If no YouTube API quota remains, sleeps until midnight PT (+ 10 minutes to be safe).
+    Watches the recodings folders of the channels (see channels.py) for new video files to show up
+    that need to be uploaded. Once a Twitch VOD corresponding to a video file is found, the video is
+    uploaded using the metadata from the Twitch VOD as it's own.
+
+    Scanning, refreshing Twitch VODs, uploading, moving uploaded files and waiting for the quota
+    reset are separate scheduler tasks, so waiting on one (e.g. for quota) never stops the others.
+    Every channel shares the same tasks, which loop over the channels (uploads run one at a time).
+    Only uploads that fit in the remaining YouTube API quota (see quota.py) are started,
+    the others are started after the quota resets at midnight PT.
     """
 
-    logger.debug(f"config: {config}")
+    def __init__(self, credential_pool, scheduler: Scheduler, channels: list = None):
+        self.credential_pool = credential_pool
+        self.scheduler = scheduler
+        self.channels = channels if channels else get_channels()
+        self.upload_queue = get_upload_queue()
+        self.post_upload_pipeline = get_post_upload_pipeline()
+        self.processing_poller = ProcessingStatusPoller(credential_pool)
+        # pauses and cancellations requested through the control API (see control.py)
+        self.upload_controller = get_upload_controller()
+
+        self.lock = threading.Lock()
+        # video files of VODs that were uploaded before, waiting to be moved ({video path: uploaded folder})
+        self.files_to_move = {}
+        # the video file currently being uploaded
+        self.uploading_path = None
+        # names of the channels the next Twitch refresh is limited to (all of them when empty)
+        self.channels_to_refresh = set()
+
+        self.previous_deferred_count = 0
+        # video path -> estimated (start, finish) of the queued uploads, as of the last plan
+        self.upload_estimates = {}
+
+    def register_tasks(self):
+        self.scheduler.add_task("refresh_twitch", self.refresh_twitch_vods, config["twitch_vod_refresh_rate"])
+        # The first scan is triggered by the first successful Twitch refresh
+        self.scheduler.add_task("scan", self.scan_recordings_folder, config["check_folder_interval"], delay=None)
+        self.scheduler.add_task("upload", self.upload_queued_videos, config["check_folder_interval"], delay=None)
+        self.scheduler.add_task("move_uploaded", self.move_uploaded_videos, delay=None)
+        self.scheduler.add_task("quota_reset", self.on_quota_reset, delay=get_time_until_quota_reset().total_seconds())
+        self.scheduler.add_task("live_status", self.check_live_status, config["offline_check_interval"])
+        if config["processing_status_polling"]:
+            self.scheduler.add_task("processing_status", self.processing_poller.poll, delay=MIN_POLL_INTERVAL)
+        if config["retention_min_free_gb"]:
+            if config["retention_require_processed"] and not config["processing_status_polling"]:
+                logger.warning("retention_require_processed needs processing_status_polling, no recordings will be deleted")
+            retention_manager = RetentionManager(self.channels, self.scheduler)
+            self.scheduler.add_task("retention", retention_manager.check, config["retention_check_interval"])
+        if config["metadata_resync_quota_share"]:
+            metadata_resync = MetadataResync(self.credential_pool)
+            self.scheduler.add_task("metadata_resync", metadata_resync.run, config["metadata_resync_interval"])
+
+    def refresh_twitch_vods(self):
+        """
+        Fetches the channels' VODs. Retries the channels Twitch failed for (or that couldn't reach it)
+        with an increasing delay (up to 10 minutes).
+        """
+        with self.lock:
+            names, self.channels_to_refresh = self.channels_to_refresh, set()
+        channels = [channel for channel in self.channels if not names or channel.name in names]
+
+        refreshed = False
+        failed = []
+        for channel in channels:
+            try:
+                channel.twitch_videos = fetch_twitch_vods(channel.twitch_user_id)
+            except (twitch_api.TwitchAPIError, requests.RequestException) as e:
+                channel.twitch_failures += 1
+                failed.append(channel)
+                logger.error(f"Twitch API request unsuccessful for channel \"{channel.name}\" ({e})")
+                continue
+
+            channel.twitch_failures = 0
+            refreshed = True
+            logger.debug(f"Refreshed Twitch VODs of channel \"{channel.name}\" ({len(channel.twitch_videos)})")
+
+        if refreshed:
+            self.scheduler.trigger("scan")
+
+        if failed:
+            with self.lock:
+                self.channels_to_refresh.update(channel.name for channel in failed)
+            retry_delay = min(min(channel.twitch_failures for channel in failed) * 60, 600)
+            logger.info(f"Trying again in {retry_delay} seconds")
+            return retry_delay
+
+    def check_live_status(self):
+        """
+        Checks whether the channels are live (all of them in one request): often while one is,
+        rarely while none are. When a stream ends, its VOD is fetched and the channel's folder is
+        scanned right away, and scanned again once the recording is old enough to pass file_age_threshold.
+        """
+        try:
+            streams = twitch_api.fetch_streams([channel.twitch_user_id for channel in self.channels])
+        except (twitch_api.TwitchAPIError, requests.RequestException) as e:
+            logger.error(f"Unable to check whether the channels are live ({e})")
+            return config["offline_check_interval"]
+
+        any_live = False
+        for channel in self.channels:
+            stream = streams.get(channel.twitch_user_id)
+            live = stream is not None
+            metrics.stream_live.set(1 if live else 0, channel=channel.name)
+
+            if live and channel.stream_live is not True:
+                logger.info(f"Channel \"{channel.name}\" is live: {stream.get('title', '')}")
+            elif not live and channel.stream_live:
+                logger.info(f"The stream of channel \"{channel.name}\" ended, refreshing its Twitch VODs")
+                if not self.refresh_stream_vods(channel):
+                    with self.lock:
+                        self.channels_to_refresh.add(channel.name)
+                    self.scheduler.trigger("refresh_twitch")
+                self.scheduler.trigger("scan", delay=config["file_age_threshold"] + 5)
+
+            channel.stream_live = live
+            channel.live_stream = stream if live else channel.live_stream
+            any_live = any_live or live
+
+        return config["live_check_interval"] if any_live else config["offline_check_interval"]
+
+    def refresh_stream_vods(self, channel) -> bool:
+        """
+        Re-fetches (by ID) the already known VODs of the channel's stream that just ended, to get their final duration.
+        Returns False if there aren't any (or the request failed), in which case the channel's VODs have to be listed.
+        """
+        if not channel.twitch_videos or not channel.live_stream or "started_at" not in channel.live_stream:
+            return False
+
+        started_at = twitch_api.get_video_timestamp({"created_at": channel.live_stream["started_at"]})
+        # The VOD is created when the stream starts
+        stream_vod_ids = [vod["id"] for vod in channel.twitch_videos if twitch_api.get_video_timestamp(vod) >= started_at - 60]
+        if not stream_vod_ids:
+            return False
 
-    folder_to_move_completed_uploads = config["folder_to_move_completed_uploads"]
+        try:
+            refreshed = {vod["id"]: vod for vod in twitch_api.fetch_videos_by_id(stream_vod_ids)}
+        except (twitch_api.TwitchAPIError, requests.RequestException) as e:
+            logger.error(f"Unable to refresh the VODs of the stream ({e})")
+            return False
 
-    check_interval = config["check_folder_interval"]
+        channel.twitch_videos = [refreshed.get(vod["id"], vod) for vod in channel.twitch_videos]
+        logger.debug(f"Refreshed the VODs of the stream: {stream_vod_ids}")
+        self.scheduler.trigger("scan")
+        return True
 
-    if not os.path.isdir(folder_to_move_completed_uploads):
-        os.mkdir(folder_to_move_completed_uploads)
+    def scan_recordings_folder(self):
+        """Scans every channel's folder, skipping the channels whose Twitch VODs haven't been fetched yet."""
+        queued = False
+        for channel in self.channels:
+            if channel.twitch_videos is None:
+                logger.debug(f"Skipping the scan of channel \"{channel.name}\", its Twitch VODs haven't been fetched yet")
+                continue
 
-    twitch_videos = get_twitch_vod_information()
+            queued = self.scan_channel_folder(channel) or queued
 
-    checks_count = 0
+        metrics.queue_length.set(len(self.upload_queue))
 
-    while 1:
+        if queued:
+            self.scheduler.trigger("upload")
 
+    def scan_channel_folder(self, channel) -> bool:
+        """Queues the channel's videos that need to be uploaded. Returns whether there are any."""
         videos_needing_upload: dict = {}
 
-        if checks_count * config["check_folder_interval"] >= config["twitch_vod_refresh_rate"]:
+        with metrics.folder_scan_seconds.time(), profiling.stage("scan"):
+            video_files: dict = get_valid_videos_in_watch_folder(channel.folder_to_watch)
 
-            logger.debug(f"Refreshing twitch vods {checks_count}")
+        with profiling.stage("match"):
+            vod_index = VodIndex(channel.twitch_videos)
+            matches = {
+                file_path: match_video_with_vod(file_path, file_modified_time, vod_index)
+                for file_path, file_modified_time in video_files.items()
+                if not self.upload_controller.is_cancelled(file_path)
+            }
 
-            twitch_videos = [
-                vid for vid in twitch_api.fetch_videos()
-                if twitch_api.get_video_duration(vid) > config["twitch_video_duration_threshold"]
-            ]
-            checks_count = 0
+        for file_path, vod in matches.items():
+            file_modified_time = video_files[file_path]
 
-        video_files: set = get_valid_videos_in_watch_folder()
-
-        for file_path in video_files:
-            file_modified_time = os.path.getmtime(file_path)
-            vod = match_video_with_vod(file_path, file_modified_time, twitch_videos)
+            if not vod:
+                continue
 
             vod_tstamp = twitch_api.get_video_timestamp(vod)
 
+            # Uploaded, but its post upload steps (which move the file) haven't finished yet
+            if self.post_upload_pipeline and self.post_upload_pipeline.has_video(file_path):
+                continue
+
             if check_vod_uploaded(vod["id"]):
+                with self.lock:
+                    if file_path == self.uploading_path or file_path in self.files_to_move:
+                        continue
+                    self.files_to_move[file_path] = channel.folder_to_move_completed_uploads
+
                 print_video_vod_info("VIDEO UPLOADED PREVIOUSLY", file_path, file_modified_time, vod["title"], vod_tstamp, vod["id"])
                 logger.info(f"Video was already uploaded: {vod['id']}. Moving to uploaded folder.")
-                move_video_to_uploaded_folder(file_path)
+                self.scheduler.trigger("move_uploaded")
 
             elif file_path not in videos_needing_upload:
-                print_video_vod_info("ADDING VIDEO", file_path, file_modified_time, vod["title"], vod_tstamp, vod["id"])
+                if file_path not in channel.previous_videos_needing_upload:
+                    print_video_vod_info("ADDING VIDEO", file_path, file_modified_time, vod["title"], vod_tstamp, vod["id"])
                 videos_needing_upload[file_path] = vod
 
-        logger.debug(f"Files that should be uploaded: {json.dumps(videos_needing_upload, indent=4)}")
-
-        for video_path in videos_needing_upload:
-            video_meta = videos_needing_upload[video_path]
+        self.skip_uploaded_copies(videos_needing_upload, channel)
+
+        # Only logged when the set of files changes, instead of on every check
+        if set(videos_needing_upload) != channel.previous_videos_needing_upload:
+            logger.debug(f"Files of channel \"{channel.name}\" that should be uploaded: {json.dumps(list(videos_needing_upload), indent=4)}")
+            channel.previous_videos_needing_upload = set(videos_needing_upload)
+
+        self.upload_queue.sync(videos_needing_upload, channel=channel.name)
+
+        return bool(videos_needing_upload)
+
+    def skip_uploaded_copies(self, videos_needing_upload: dict, channel):
+        """
+        Removes videos with the same contents as an uploaded one (a copied or renamed recording,
+        or one matched with a different VOD) from videos_needing_upload, and moves them instead.
+        """
+        fingerprint_index = get_fingerprint_index()
+        if not fingerprint_index:
+            return
+
+        for file_path, fingerprint in fingerprint_files(videos_needing_upload).items():
+            uploaded_vod_id = fingerprint_index.get(fingerprint)
+            if not uploaded_vod_id:
+                continue
+
+            del videos_needing_upload[file_path]
+            with self.lock:
+                if file_path == self.uploading_path or file_path in self.files_to_move:
+                    continue
+                self.files_to_move[file_path] = channel.folder_to_move_completed_uploads
+
+            logger.info(f"{file_path} has the same contents as the video uploaded for VOD {uploaded_vod_id}. Moving to uploaded folder.")
+            self.scheduler.trigger("move_uploaded")
+
+    def plan_uploads(self) -> tuple:
+        """
+        Returns the queue entries that today's remaining quota (across every credential) can pay for,
+        in upload order, along with their quota costs. Each entry can only use its channel's credentials.
+        Paused and cancelled entries are left out.
+        """
+        from upload import get_video_upload_cost
+
+        entries = [entry for entry in self.upload_queue.ordered() if not self.upload_controller.is_held(entry["video_path"])]
+        # Resuming an interrupted upload doesn't need a new videos.insert call
+        upload_costs = [
+            get_video_upload_cost(entry["twitch_vod"]) - (QUOTA_COSTS["videos.insert"] if entry.get("upload_url") else 0)
+            for entry in entries
+        ]
+        allowed_names = [get_vod_channel(entry["twitch_vod"]).youtube_credentials for entry in entries]
+        planned, deferred = self.credential_pool.plan_uploads(upload_costs, allowed_names)
+
+        upload_times = estimate_queue_times(entries, upload_costs, [credential.quota_ledger for credential in self.credential_pool])
+        self.upload_estimates = {entry["video_path"]: times for entry, times in zip(entries, upload_times)}
+        metrics.queue_finish_timestamp.set(upload_times[-1][1] if upload_times else 0)
+
+        metrics.quota_sleeping.set(1 if deferred else 0)
+        metrics.quota_reset_timestamp.set(time.time() + get_time_until_quota_reset().total_seconds())
+
+        if deferred and len(deferred) != self.previous_deferred_count:
+            local_reset = datetime.now() + get_time_until_quota_reset()
+            logger.info(
+                f"{len(deferred)} video(s) don't fit in the remaining quota ({self.credential_pool.remaining()} units). "
+                f"They will be uploaded after midnight Pacific Time ({pretty_print_time(local_reset)} local time)"
+            )
+        self.previous_deferred_count = len(deferred)
+
+        return [(entries[i], upload_costs[i]) for i, _ in planned]
+
+    def upload_queued_videos(self):
+        """
+        Uploads the queued videos one at a time. The queue is re-planned after every upload,
+        so videos queued in the meantime are picked up in the right order.
+        """
+        from resumable_upload import ResumableUpload
+        from upload import quick_upload_video
+
+        attempted = set()
+
+        while not is_shutting_down() and not self.upload_controller.paused_all:
+            planned = [(entry, cost) for entry, cost in self.plan_uploads() if entry["video_path"] not in attempted]
+            if not planned:
+                return
+
+            entry, cost = planned[0]
+            video_path, video_meta = entry["video_path"], entry["twitch_vod"]
+            credential_names = get_vod_channel(video_meta).youtube_credentials
+            attempted.add(video_path)
+
+            if not os.path.isfile(video_path):
+                self.upload_queue.remove(video_path)
+                continue
 
             logger.debug(f"Uploading: {video_path}\nwith VOD: {video_meta}")
 
             if not DEBUG_ENABLED:
                 logger.info(f"Uploading: {video_path}\nwith VOD: {video_meta['title']}\n")
 
+            if video_path in self.upload_estimates:
+                queue_finish = max(finish for _, finish in self.upload_estimates.values())
+                logger.info(
+                    f"Estimated to finish at {pretty_print_time(datetime.fromtimestamp(self.upload_estimates[video_path][1]))}, "
+                    f"the {len(self.upload_estimates)} queued video(s) by {datetime.fromtimestamp(queue_finish).strftime('%Y-%m-%d %I:%M %p')}"
+                )
+
+            with self.lock:
+                self.uploading_path = video_path
+
+            # The credential with the most quota left, moving on to the next one if YouTube reports
+            # that its quota ran out anyway (its ledger is marked as exhausted when that happens).
+            # Interrupted uploads are resumed with the credentials that started them.
+            upload_url = entry.get("upload_url")
+            credential = self.credential_pool.get(entry["credential"]) if upload_url else None
+            if not credential:
+                credential, upload_url = self.credential_pool.pick(cost, credential_names), None
+            interrupted = False
             try:
-                quick_upload_video(google, video_path, video_meta, DRY_RUN_ENABLED=DRY_RUN_ENABLED)
-            except ResumableUpload.ExceededQuota:
-                time_until_reset = get_time_until_quota_reset()
-
-                local_reset = datetime.now() + time_until_reset
+                while credential:
+                    try:
+                        quick_upload_video(credential, video_path, video_meta, upload_url, entry.get("uploaded_bytes"), DRY_RUN_ENABLED=DRY_RUN_ENABLED)
+                        break
+                    except ResumableUpload.Interrupted:
+                        interrupted = True
+                        break
+                    except ResumableUpload.ExceededQuota:
+                        logger.warning(f"The daily quota limit of the \"{credential.name}\" YouTube credentials has been reached.")
+                        credential, upload_url = self.credential_pool.pick(cost, credential_names), None
+                        if credential:
+                            logger.info(f"Retrying with the \"{credential.name}\" YouTube credentials")
+            finally:
+                with self.lock:
+                    self.uploading_path = None
+                self.upload_queue.clear_session(video_path)
+
+            if interrupted:
+                if is_shutting_down():
+                    # Resumed from state.json on the next start
+                    return
+                self.on_upload_held(entry)
+                continue
+
+            if not credential:
+                # The quota_reset task starts uploading again. Scanning (and moving already uploaded files)
+                # carries on in the meantime.
+                local_reset = datetime.now() + get_time_until_quota_reset()
                 logger.warning(f"The daily quota limit has been reached.")
-                logger.info(f"Sleeping until midnight Pacific Time ({pretty_print_time(local_reset)} local time)")
-                time.sleep(time_until_reset.total_seconds())
+                logger.info(f"Uploads will continue after midnight Pacific Time ({pretty_print_time(local_reset)} local time)")
+
+                metrics.quota_sleeping.set(1)
+                return
+
+            # YouTube takes a while to process the video, see processing_status.py
+            if config["processing_status_polling"]:
+                self.processing_poller.on_upload_finished()
+                self.scheduler.trigger("processing_status", delay=MIN_POLL_INTERVAL)
+
+            if not os.path.isfile(video_path):
+                self.upload_queue.remove(video_path)
+            metrics.queue_length.set(len(self.upload_queue))
+
+    def on_upload_held(self, entry: dict):
+        """Handles an upload stopped through the control API: a cancelled one is dropped, a paused one keeps its session."""
+        video_path, twitch_vod = entry["video_path"], entry["twitch_vod"]
+
+        if self.upload_controller.is_cancelled(video_path):
+            self.upload_queue.remove(video_path)
+        else:
+            in_progress = get_in_progress_upload(twitch_vod["id"])
+            if in_progress.get("upload_url"):
+                self.upload_queue.add(video_path, twitch_vod, in_progress["upload_url"], in_progress.get("credential"), in_progress.get("uploaded_bytes"))
+
+        metrics.queue_length.set(len(self.upload_queue))
+
+    def move_uploaded_videos(self):
+        while 1:
+            with self.lock:
+                if not self.files_to_move:
+                    return
+                file_path, folder = self.files_to_move.popitem()
+
+            try:
+                move_video_to_uploaded_folder(file_path, folder)
+            except OSError:
+                logger.error(f"Unable to move {file_path} to the uploaded folder", exc_info=True)
+
+    def on_quota_reset(self):
+        """Runs shortly after midnight PT, returning the time until the next reset."""
+        logger.info("The YouTube API quota has been reset")
+        metrics.quota_sleeping.set(0)
+        self.scheduler.trigger("upload")
+        return get_time_until_quota_reset().total_seconds()
+
+
+def watch_recordings_folder(credential_pool):
+    """Runs the RecordingsWatcher's tasks until the process exits."""
+
+    logger.debug(f"config: {config}")
+
+    for channel in get_channels():
+        if not os.path.isdir(channel.folder_to_move_completed_uploads):
+            os.mkdir(channel.folder_to_move_completed_uploads)
+
+    scheduler = Scheduler()
+    watcher = RecordingsWatcher(credential_pool, scheduler)
+    watcher.register_tasks()
+
+    if config["control_port"]:
+        from control import start_control_server
+        start_control_server(watcher, config["control_port"], config["control_host"])
 
-        time.sleep(check_interval)
+    on_shutdown(scheduler.stop)
+    if is_shutting_down():
+        return
+    scheduler.run()
 
-        checks_count += 1
+    # Lets the upload finish sending its current chunk (and checkpoint it)
+    unfinished = scheduler.wait_for_tasks(config["shutdown_timeout"])
+    if unfinished:
+        logger.warning(f"Tasks still running after {config['shutdown_timeout']} seconds, exiting anyway: {unfinished}")
+    if profiling.is_enabled():
+        logger.info(f"Pipeline stage timers:\n{profiling.format_stage_timers()}")
+    logger.info("Shut down")
 
 
-def get_valid_videos_in_watch_folder() -> set:
-    folder_to_watch = config["folder_to_watch"]
+def get_valid_videos_in_watch_folder(folder_to_watch: str = None) -> dict:
+    """
+    Returns {video path: modified time} for the MP4s in the folder that are big and old enough.
+    Every file is only stat'ed once (by its scandir entry), see benchmarks/scan_scale.py.
+    """
+    folder_to_watch = folder_to_watch or config["folder_to_watch"]
     file_size_threshold = config["file_size_threshold"]
     file_age_threshold = config["file_age_threshold"]
 
-    video_files = set(
-        os.path.join(folder_to_watch, path) for path in os.listdir(folder_to_watch)
-        if os.path.isfile(os.path.join(folder_to_watch, path)) and path.endswith(".mp4")
-    )
+    video_files = {}
+    now = time.time()
 
-    def filter_videos(file_path):
-        # File creation time isn't used here because unix
-        file_modified_time = os.path.getmtime(file_path)
-        file_modified_relative = time.time() - file_modified_time
-        file_size = os.path.getsize(file_path)
+    with os.scandir(folder_to_watch) as entries:
+        for entry in entries:
+            if not entry.name.endswith(".mp4") or not entry.is_file():
+                continue
 
-        logger.debug(f"{file_path}: {file_modified_time} | {file_modified_relative} | {file_size}")
+            stat = entry.stat()
+            file_path = os.path.join(folder_to_watch, entry.name)
 
-        meets_file_size = file_size >= file_size_threshold
-        meets_file_age = file_modified_relative >= file_age_threshold
+            # File creation time isn't used here because unix
+            file_modified_time = stat.st_mtime
+            file_modified_relative = now - file_modified_time
+            file_size = stat.st_size
 
-        if not (meets_file_size and meets_file_age) and not IGNORE_FILE_SIZE_AND_AGE:
-            return False
-        else:
-            return True
+            logger.debug(f"{file_path}: {file_modified_time} | {file_modified_relative} | {file_size}")
 
-    return set(filter(filter_videos, video_files))
+            meets_file_size = file_size >= file_size_threshold
+            meets_file_age = file_modified_relative >= file_age_threshold
 
+            if (meets_file_size and meets_file_age) or IGNORE_FILE_SIZE_AND_AGE:
+                video_files[file_path] = file_modified_time
+
+    return video_files
+
+
+def get_vod_match_window(video: dict) -> tuple:
+    """The (start, end) timestamps a video file's modified time has to fall between to match the VOD."""
+    vid_tstamp = twitch_api.get_video_timestamp(video)
+    vid_duration = twitch_api.get_video_duration(video)
+
+    # The start date and time of the VOD minus a bit of padding for margin of error
+    min_video_start_date = (vid_tstamp - config["file_modified_start_max_delta"])
+
+    # The end date and time of the VOD plus a bit of padding for margin of error
+    max_video_end_date = (vid_tstamp + (vid_duration + config["file_modified_end_max_delta"]))
+
+    return min_video_start_date, max_video_end_date
 
-def match_video_with_vod(file_path, file_modified_time, twitch_vods):
-    for video in twitch_vods:
-        vid_tstamp = twitch_api.get_video_timestamp(video)
-        vid_duration = twitch_api.get_video_duration(video)
 
-        # The start date and time of the VOD minus a bit of padding for margin of error
-        min_video_start_date = (vid_tstamp - config["file_modified_start_max_delta"])
+class VodIndex():
+    """
+    Twitch VODs sorted by the start of their match windows, so matching a video bisects instead of
+    checking every VOD. Matches the same VOD as a linear search: the first one (in the given order)
+    whose window contains the video's modified time.
+    """
+
+    def __init__(self, twitch_vods: list):
+        self.twitch_vods = twitch_vods
+        # (window start, position in twitch_vods, window end)
+        self.windows = []
+        for position, video in enumerate(twitch_vods):
+            start, end = get_vod_match_window(video)
+            self.windows.append((start, position, end))
+        self.windows.sort()
+        self.starts = [start for start, _, _ in self.windows]
+        self.max_window = max((end - start for start, _, end in self.windows), default=0)
+
+    def match(self, file_modified_time: float):
+        # Only windows starting at most max_window before the modified time can contain it
+        first = bisect_left(self.starts, file_modified_time - self.max_window)
+        last = bisect_right(self.starts, file_modified_time)
 
-        # The end date and time of the VOD plus a bit of padding for margin of error
-        max_video_end_date = (vid_tstamp + (vid_duration + config["file_modified_end_max_delta"]))
+        positions = [position for _, position, end in self.windows[first:last] if file_modified_time < end]
+        return self.twitch_vods[min(positions)] if positions else None
+
+
+def match_video_with_vod(file_path, file_modified_time, twitch_vods):
+    """twitch_vods is a list of VODs, or a VodIndex of them when matching many videos."""
+    if isinstance(twitch_vods, VodIndex):
+        return twitch_vods.match(file_modified_time)
+
+    for video in twitch_vods:
+        min_video_start_date, max_video_end_date = get_vod_match_window(video)
 
         # Check if the current VOD and video start and end near eachother
         if file_modified_time >= min_video_start_date and file_modified_time < max_video_end_date:
@@ -170,16 +582,21 @@ def match_video_with_vod(file_path, file_modified_time, twitch_vods):
     return None
 
 
-def get_twitch_vod_information():
-    """Retrieves and filters VOD information for the channel specified in config.json"""
+def fetch_twitch_vods(user_id: str = None):
+    """Fetches the VODs of the given Twitch user (or the one in config.json) that are long enough to be uploaded."""
+    return [
+        vid for vid in twitch_api.fetch_videos(user_id)
+        if twitch_api.get_video_duration(vid) > config["twitch_video_duration_threshold"]
+    ]
+
+
+def get_twitch_vod_information(user_id: str = None):
+    """Retrieves and filters VOD information for the given Twitch user, or the channel specified in config.json"""
     twitch_retries = 10
 
     for i in range(twitch_retries):
         try:
-            return [
-                vid for vid in twitch_api.fetch_videos()
-                if twitch_api.get_video_duration(vid) > config["twitch_video_duration_threshold"]
-            ]
+            return fetch_twitch_vods(user_id)
         except twitch_api.TwitchAPIError as e:
             logger.error(f"Twitch API request unsuccessful ({e})")
             if i + 1 == twitch_retries:
@@ -192,22 +609,6 @@ def get_twitch_vod_information():
                 time.sleep(time_to_sleep)
 
 
-def get_time_until_quota_reset():
-    """Calculates the amount of time until midnight Pacific Time (+10 minutes to be safe)"""
-
-    dt = datetime.now().astimezone(pacific_tz)
-    quota_reset = (dt + timedelta(days=1)).replace(hour=0, minute=10, second=0).astimezone(pacific_tz)
-
-    time_to_quota_reset = quota_reset - dt
-
-    if DEBUG_ENABLED:
-        logger.debug(f"current time: {dt}")
-        logger.debug(f"quota reset: {quota_reset}")
-        logger.debug(f"time to quota reset: {time_to_quota_reset}")
-
-    return time_to_quota_reset
-
-
 def pretty_print_time(dt):
     return dt.strftime('%I:%M %p').lstrip("0")
 
@@ -222,23 +623,53 @@ def print_video_vod_info(message, video_path, video_modified, vod_title, vod_dat
     | VOD Timestamp:  {vod_date_created}\n""")
 
 
+def check_twitch_config():
+    """Exits if the Twitch API can't be used with the config, before any task (thread) needs it."""
+    try:
+        twitch_api.check_twitch_config()
+    except twitch_api.TwitchAPIError as e:
+        logger.critical(e)
+        sys.exit(1)
+
+
 def match_vods_only():
+    check_twitch_config()
+
     videos_needing_upload: dict = {}
     videos_not_matched: list = []
     videos_already_uploaded: list = []
 
-    twitch_videos = get_twitch_vod_information()
-    video_files: set = get_valid_videos_in_watch_folder()
+    video_files: set = set()
+    file_count = 0
+
+    for channel in get_channels():
+        twitch_videos = get_twitch_vod_information(channel.twitch_user_id)
+        channel_video_files: dict = get_valid_videos_in_watch_folder(channel.folder_to_watch)
+        video_files.update(channel_video_files)
+
+        folder_to_watch = channel.folder_to_watch
+        file_count += len([
+            f for f in os.listdir(folder_to_watch)
+            if os.path.isfile(os.path.join(folder_to_watch, f)) and f.endswith(".mp4")
+        ])
+
+        match_channel_videos(channel_video_files, twitch_videos, videos_needing_upload, videos_not_matched, videos_already_uploaded)
+
+    logger.info(f"{len(video_files)}/{file_count} valid MP4s")
+    logger.info(f"{len(videos_needing_upload)}/{len(video_files)} valid video(s) were added to upload queue")
+    logger.info(f"{len(videos_already_uploaded)}/{len(video_files)} valid video(s) were already uploaded")
+
+    full_video_text = "\n    ".join(videos_not_matched)
+    logger.info(f"{len(videos_not_matched)}/{len(video_files)} valid video(s) were not added to queue: \n    {full_video_text}")
 
-    folder_to_watch = config["folder_to_watch"]
-    file_count = len([
-        f for f in os.listdir(folder_to_watch)
-        if os.path.isfile(os.path.join(folder_to_watch, f)) and f.endswith(".mp4")
-    ])
+    print_upload_queue(videos_needing_upload)
 
-    for file_path in video_files:
-        file_modified_time = os.path.getmtime(file_path)
-        vod = match_video_with_vod(file_path, file_modified_time, twitch_videos)
+
+def match_channel_videos(video_files: dict, twitch_videos: list, videos_needing_upload: dict, videos_not_matched: list, videos_already_uploaded: list):
+    """Sorts a channel's video files ({video path: modified time}) into the match_vods_only() report's lists."""
+    vod_index = VodIndex(twitch_videos)
+    for file_path, file_modified_time in video_files.items():
+        vod = match_video_with_vod(file_path, file_modified_time, vod_index)
 
         if vod:
             vod_tstamp = twitch_api.get_video_timestamp(vod)
@@ -255,32 +686,108 @@ def match_vods_only():
         else:
             videos_not_matched.append(file_path)
 
-    logger.info(f"{len(video_files)}/{file_count} valid MP4s")
-    logger.info(f"{len(videos_needing_upload)}/{len(video_files)} valid video(s) were added to upload queue")
-    logger.info(f"{len(videos_already_uploaded)}/{len(video_files)} valid video(s) were already uploaded")
 
-    full_video_text = "\n    ".join(videos_not_matched)
-    logger.info(f"{len(videos_not_matched)}/{len(video_files)} valid video(s) were not added to queue: \n    {full_video_text}")
+def estimate_queue_times(entries: list, upload_costs: list, ledgers: list) -> list:
+    """Estimates the (start, finish) times of the ordered queue entries, with the throughput model and the ledgers' quota."""
+    return estimate_upload_times(
+        entries,
+        get_throughput_model(),
+        upload_costs,
+        sum(ledger.remaining() for ledger in ledgers),
+        sum(ledger.daily_limit for ledger in ledgers),
+        get_time_until_quota_reset().total_seconds()
+    )
+
+
+def print_upload_queue(videos_needing_upload: dict):
+    """Logs the order the videos will be uploaded in, and roughly when each upload will start and finish."""
+    from upload import get_video_upload_cost
+
+    # Ordered with the saved pins and queue times, without changing the saved queue
+    upload_queue = get_upload_queue()
+    upload_queue.sync(videos_needing_upload, persist=False)
+    entries = upload_queue.ordered()
+
+    upload_times = estimate_queue_times(entries, [get_video_upload_cost(entry["twitch_vod"]) for entry in entries], get_configured_ledgers())
+
+    def format_time(timestamp: float) -> str:
+        return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %I:%M %p')
+
+    lines = [
+        f"{position}. {entry['twitch_vod']['id']}{' (pinned)' if entry['pinned'] else ''} | "
+        f"{entry['file_size'] / 1024 ** 3:.2f} GiB | starts ~{format_time(start_time)} | done ~{format_time(finish_time)} | "
+        f"{entry['video_path']}"
+        for position, (entry, (start_time, finish_time)) in enumerate(zip(entries, upload_times), start=1)
+    ]
+    queue_text = "\n    ".join(lines)
+
+    model = get_throughput_model()
+    hourly_rates = model.get_hourly_rates()
+    speed_text = (
+        f"~{min(hourly_rates):.1f}-{max(hourly_rates):.1f} MB/s depending on the time of day, from {model.sample_count} throughput sample(s)"
+        if model.sample_count else f"~{config['estimated_upload_speed']} MB/s, no uploads measured yet"
+    )
+    logger.info(f"Upload queue (at {speed_text}): \n    {queue_text}")
+    if upload_times:
+        logger.info(f"The {len(entries)} queued video(s) are estimated to be uploaded by {format_time(upload_times[-1][1])}")
 
 
 def main():
+    from youtube_auth import init_credential_pool
+    from upload_sessions import resume_interrupted_uploads
+
     if DRY_RUN_ENABLED:
         logger.warning("[DRY RUN] Dry run enabled. Nothing will be uploaded")
         logger.warning("[DRY RUN] Dry run enabled. Nothing will be uploaded")
 
-    google = init_google_session()
-    for file_path, twitch_vod, upload_url in check_in_progress_uploads():
-        quick_upload_video(google, file_path, twitch_vod, upload_url, DRY_RUN_ENABLED=DRY_RUN_ENABLED)
+    check_twitch_config()
+    install_signal_handlers()
+
+    if PROFILE_ENABLED:
+        profiling.enable()
+        if config["profile_window"]:
+            profiling.start_capture(config["profile_window"])
+
+    if config["metrics_port"]:
+        metrics.start_metrics_server(config["metrics_port"], config["metrics_host"])
+
+    credential_pool = init_credential_pool()
+    if not credential_pool:
+        logger.critical("Unable to initialize a Google session")
+        sys.exit(1)
+
+    # Starts the post upload workers, which also pick up jobs interrupted by a restart
+    get_post_upload_pipeline(credential_pool)
+
+    # Checks every interrupted upload at once, then lets the upload task resume them
+    resume_interrupted_uploads(credential_pool, get_upload_queue(), DRY_RUN_ENABLED=DRY_RUN_ENABLED)
 
     logger.info("Watching recordings folder...")
-    watch_recordings_folder(google)
+    watch_recordings_folder(credential_pool)
+
+    # Writes a capture that's still running, now that the tasks stopped (shutdown callbacks run in the
+    # signal handler, which isn't the place for writing profiles)
+    profiling.end_capture()
 
 
 if __name__ == "__main__":
 
+    setup_logger(debug_enabled=DEBUG_ENABLED, json_format=config["log_format"] == "json")
     logger.info("Starting up...")
 
-    if MATCH_VODS_ONLY:
+    try:
+        get_channels()
+    except ConfigLoadError as e:
+        logger.critical(e)
+        sys.exit(1)
+
+    if PIN_VOD_ID:
+        get_upload_queue().pin(PIN_VOD_ID)
+        logger.info(f"Pinned VOD {PIN_VOD_ID} to the front of the upload queue")
+    elif UNPIN_VOD_ID:
+        get_upload_queue().unpin(UNPIN_VOD_ID)
+        logger.info(f"Unpinned VOD {UNPIN_VOD_ID}")
+    elif MATCH_VODS_ONLY:
         match_vods_only()
     else:
         main()
@@ -1,13 +1,27 @@
 """
 Provides access to additional variables for use in upload_categories.json.
 Can be treated as a regular python file (imports, module variables, etc).
+
+Variables can also be declared in the "_variables" section of upload_categories.json,
+using one of the providers registered below (or your own, via @variable_provider).
+Variables are only computed when a template actually references them, and the
+results are cached per VOD ID (and variable declarations).
 """
 
+import json
+import re
 from datetime import datetime, timezone
+from functools import lru_cache
 import pytz
 
 pacific_tz = pytz.timezone("America/Los_Angeles")
 
+# provider type name -> function(twitch_vod: dict, options: dict) -> value
+variable_providers = {}
+
+# (VOD ID, declarations signature) -> (VOD signature, {variable name: value})
+_variable_cache = {}
+
 
 def generate_variables(twitch_vod: dict):
     """
@@ -17,8 +31,7 @@ def generate_variables(twitch_vod: dict):
     """
 
     # For example: a human friendly(ish) version of the date and time the VOD was created (in PT)
-    created_time = datetime.strptime(twitch_vod["created_at"], "%Y-%m-%dT%H:%M:%SZ")
-    created_time = created_time.replace(tzinfo=timezone.utc)
+    created_time = parse_twitch_time(twitch_vod["created_at"])
     pt_time = created_time.astimezone(pacific_tz)
 
     return {
@@ -27,6 +40,150 @@ def generate_variables(twitch_vod: dict):
     }
 
 
+def variable_provider(type_name: str):
+    """Registers the decorated function as the provider for "_variables" entries of the given type."""
+
+    def decorator(func):
+        variable_providers[type_name] = func
+        return func
+
+    return decorator
+
+
+@lru_cache(maxsize=1024)
+def parse_twitch_time(time_string: str) -> datetime:
+    """Parses a Twitch API datetime string into an aware (UTC) datetime."""
+    return datetime.strptime(time_string, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
+
+
+@lru_cache(maxsize=256)
+def compile_pattern(pattern: str, ignore_case: bool):
+    return re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+
+
+@variable_provider("date")
+def date_variable(twitch_vod: dict, options: dict) -> str:
+    """
+    A VOD date in any time zone.
+    options: field (default created_at), format (strftime, default "%B %d, %Y"), timezone (default UTC)
+    """
+    dt = parse_twitch_time(twitch_vod[options.get("field", "created_at")])
+    dt = dt.astimezone(pytz.timezone(options.get("timezone", "UTC")))
+    return dt.strftime(options.get("format", "%B %d, %Y"))
+
+
+@variable_provider("duration")
+def duration_variable(twitch_vod: dict, options: dict) -> str:
+    """
+    The VOD length, formatted with str.format.
+    options: format (default "{hours}:{minutes:02}:{seconds:02}")
+    Available fields: hours, minutes, seconds, total_minutes, total_seconds
+    """
+    from twitch_api import get_video_duration
+
+    total_seconds = get_video_duration(twitch_vod)
+    hours, remainder = divmod(total_seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+
+    return options.get("format", "{hours}:{minutes:02}:{seconds:02}").format(
+        hours=hours,
+        minutes=minutes,
+        seconds=seconds,
+        total_minutes=total_seconds // 60,
+        total_seconds=total_seconds
+    )
+
+
+@variable_provider("title_regex")
+def title_regex_variable(twitch_vod: dict, options: dict) -> str:
+    """
+    A capture group from a regex search over the VOD title (or another field).
+    options: pattern, group (default 1), default (used when nothing matches, default ""),
+             ignore_case (default false), field (default title)
+    """
+    pattern = compile_pattern(options["pattern"], options.get("ignore_case", False))
+    match = pattern.search(twitch_vod.get(options.get("field", "title"), ""))
+
+    if match and match.group(options.get("group", 1)) is not None:
+        return match.group(options.get("group", 1)).strip()
+
+    return options.get("default", "")
+
+
+def get_vod_signature(twitch_vod: dict) -> tuple:
+    """The VOD fields that variables are derived from. Cached values are discarded when these change."""
+    return (twitch_vod.get("created_at"), twitch_vod.get("duration"), twitch_vod.get("title"))
+
+
+def get_declarations_signature(declared_variables: dict) -> str:
+    """
+    Identifies the variable declarations ("_variables") the values were computed with, so categories
+    files declaring a variable differently (other channels, edited files) don't share cached values.
+    """
+    return json.dumps(declared_variables, sort_keys=True, default=str)
+
+
+def get_cached_variables(twitch_vod: dict, declared_variables: dict) -> dict:
+    signature = get_vod_signature(twitch_vod)
+    key = (twitch_vod.get("id"), get_declarations_signature(declared_variables))
+    cached = _variable_cache.get(key)
+
+    if not cached or cached[0] != signature:
+        cached = (signature, {})
+        _variable_cache[key] = cached
+
+    return cached[1]
+
+
+def clear_variable_cache():
+    """Drops the cached values, e.g. when the categories files were (re)loaded and old declarations are unused."""
+    _variable_cache.clear()
+
+
+def resolve_variable(twitch_vod: dict, name: str, declared_variables: dict):
+    """
+    Computes a single variable for the VOD. Declared variables ("_variables" in upload_categories.json)
+    are checked first, then the output of generate_variables. Raises KeyError if neither has it.
+    """
+
+    cached = get_cached_variables(twitch_vod, declared_variables)
+    if name in cached:
+        return cached[name]
+
+    if name in declared_variables:
+        options = declared_variables[name]
+        provider = variable_providers.get(options.get("type"))
+        if not provider:
+            raise ValueError(f"Unknown variable type \"{options.get('type')}\" for variable \"{name}\"")
+
+        value = provider(twitch_vod, options)
+    else:
+        if "__generated__" not in cached:
+            cached["__generated__"] = generate_variables(twitch_vod) or {}
+
+        value = cached["__generated__"][name]
+
+    cached[name] = value
+    return value
+
+
+class TemplateVariables(dict):
+    """
+    The mapping given to str.format_map when rendering categories. Fields of the Twitch VOD are
+    available as-is, anything else is resolved lazily (see resolve_variable).
+    """
+
+    def __init__(self, twitch_vod: dict, declared_variables: dict = None):
+        super().__init__(twitch_vod)
+        self.twitch_vod = twitch_vod
+        self.declared_variables = declared_variables or {}
+
+    def __missing__(self, name):
+        value = resolve_variable(self.twitch_vod, name, self.declared_variables)
+        self[name] = value
+        return value
+
+
 # For checking the resulting variables
 if __name__ == "__main__":
     test_vod_data = {
@@ -47,3 +204,11 @@ if __name__ == "__main__":
     }
 
     print(generate_variables(test_vod_data))
+
+    example_variables = {
+        "pt_date": {"type": "date", "format": "%B %d, %Y %I:%M %p", "timezone": "America/Los_Angeles"},
+        "length": {"type": "duration", "format": "{hours}h {minutes}m"},
+        "run_category": {"type": "title_regex", "pattern": r"Speedrun of (.+?%)"}
+    }
+    variables = TemplateVariables(test_vod_data, example_variables)
+    print("{pt_date} | {length} | {run_category} | {friendly_created_at}".format_map(variables))
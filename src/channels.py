@@ -0,0 +1,99 @@
+"""
+The Twitch channels handled by this process.
+
+Each channel has its own Twitch user, watch folder, uploaded folder, upload categories and
+YouTube credentials. Everything else is shared between them: the Twitch and Google sessions
+(and their connection pools), the scheduler and its tasks, the upload task and the bandwidth
+budget. So ten channels cost about the same memory and wake ups as one.
+
+Channels are listed in "channels" (config.json). Options a channel leaves out fall back to the top
+level ones, and without any channels the top level options form a single "default" channel. With
+several channels, every one of them has to list its youtube_credentials, since credentials are tied
+to a YouTube channel and uploading with every one of them would mix up the channels' videos.
+State files are shared too, since they're keyed by Twitch VOD ID (unique across channels) or by
+video path. Queue entries record their channel.
+"""
+
+import os
+
+from config import config, ConfigLoadError
+
+import logging
+logger = logging.getLogger()
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__ + "/.."))
+
+DEFAULT_CHANNEL_NAME = "default"
+
+channels = None
+
+
+class Channel():
+    def __init__(self, name: str, twitch_user_id: str, folder_to_watch: str, folder_to_move_completed_uploads: str,
+                 youtube_credentials: list, upload_categories: str):
+        self.name = name
+        self.twitch_user_id = twitch_user_id
+        self.folder_to_watch = folder_to_watch
+        self.folder_to_move_completed_uploads = folder_to_move_completed_uploads
+        # names of the YouTube credentials (see youtube_auth.py) this channel uploads with
+        self.youtube_credentials = youtube_credentials
+        self.categories_path = ROOT_DIR + "/data/" + upload_categories
+
+        # Watcher state (see bot.py)
+        self.twitch_videos = None
+        self.twitch_failures = 0
+        # None until the first live status check
+        self.stream_live = None
+        self.live_stream = None
+        self.previous_videos_needing_upload: set = set()
+
+    def __repr__(self):
+        return f"Channel({self.name})"
+
+
+def create_channel(entry: dict, only_channel: bool = True) -> Channel:
+    """
+    Creates a channel from an entry of "channels", filling in missing options from the top level ones.
+    The only channel uploads with every credential by default, one of several has to list its own.
+    """
+    all_credentials = [DEFAULT_CHANNEL_NAME] + [credential["name"] for credential in config["youtube_credentials"]]
+    if "youtube_credentials" not in entry and not only_channel:
+        raise ConfigLoadError(f"Channel \"{entry.get('name', DEFAULT_CHANNEL_NAME)}\" must list its youtube_credentials, since there are several channels (see the README)")
+
+    return Channel(
+        entry.get("name", DEFAULT_CHANNEL_NAME),
+        entry.get("twitch_user_id", config["twitch_user_id"]),
+        entry.get("folder_to_watch", config["folder_to_watch"]),
+        entry.get("folder_to_move_completed_uploads", config["folder_to_move_completed_uploads"]),
+        entry.get("youtube_credentials", all_credentials),
+        entry.get("upload_categories", "upload_categories.json")
+    )
+
+
+def get_channels() -> list:
+    global channels
+
+    if channels is None:
+        entries = config["channels"] or [{}]
+        channels = [create_channel(entry, only_channel=len(entries) == 1) for entry in entries]
+
+        names = [channel.name for channel in channels]
+        if len(set(names)) != len(names):
+            logger.error(f"Channel names must be unique: {names}")
+
+    return channels
+
+
+def get_channel(name: str):
+    for channel in get_channels():
+        if channel.name == name:
+            return channel
+    return None
+
+
+def get_vod_channel(twitch_vod: dict) -> Channel:
+    """The channel a Twitch VOD belongs to (by its user_id), or the first channel if it doesn't match any."""
+    for channel in get_channels():
+        if channel.twitch_user_id == twitch_vod.get("user_id"):
+            return channel
+    return get_channels()[0]
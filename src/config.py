@@ -6,6 +6,7 @@ import json
 
 import logging
 
+from collections.abc import MutableMapping
 from pathlib import Path
 
 
@@ -26,11 +27,27 @@ DEFAULT_CONFIG = {
     "youtube_client_id": "",
     "youtube_client_secret": "",
 
+    # more OAuth clients (Google API projects), each with its own quota:
+    # [{"name": "second", "client_id": "", "client_secret": ""}, ...]
+    "youtube_credentials": [],
+
+    # the Twitch channels handled by this process (without any, the top level options form a single channel),
+    # each with its own folders, categories file (in data/) and YouTube credentials. Options that are left out
+    # use the top level ones, except youtube_credentials, which every one of several channels has to list:
+    # [{"name": "second", "twitch_user_id": "", "folder_to_watch": "", "folder_to_move_completed_uploads": "",
+    #   "upload_categories": "upload_categories_second.json", "youtube_credentials": ["second"]}, ...]
+    "channels": [],
+
     "twitch_client_id": "",
+    # used to get an app access token for the Twitch API
+    "twitch_client_secret": "",
     "twitch_user_id": "",
 
     "folder_to_watch": DEFAULT_WATCH_FOLDER,
     "folder_to_move_completed_uploads": DEFAULT_WATCH_FOLDER + "/uploaded",
+    # how a copy is checked before the original is deleted, when the uploaded folder is on another disk:
+    # "size" or "digest" (SHA-256 of both files)
+    "move_verify": "size",
     # check the folder for video files that can be uploaded every X seconds
     "check_folder_interval": 300,
     # # Video files must be at least 1GiB to be uploaded
@@ -39,19 +56,114 @@ DEFAULT_CONFIG = {
     "file_age_threshold": 60 * 5,
     # upload with the specified chunk size instead of filesize / 10
     "file_chunk_size_override": False,
+    # drop video data from the page cache once it's been uploaded
+    "upload_drop_page_cache": True,
+    # read videos with O_DIRECT, bypassing the page cache entirely
+    "upload_direct_io": False,
+    # combined upload speed limit of every upload (in MB/s, 0 for unlimited)
+    "upload_bandwidth_limit": 0,
+    # threads setting thumbnails, updating the upload history and moving files after uploads
+    "post_upload_workers": 2,
+    # processes hashing video files to recognise recordings that were already uploaded (even if renamed or copied)
+    "fingerprint_workers": 2,
+    # 1 MiB blocks sampled between the head and tail of a video for its fingerprint
+    "fingerprint_sample_blocks": 16,
 
     "twitch_video_duration_threshold": 3_600,
     "file_modified_start_max_delta": 120,
     "file_modified_end_max_delta": 1_800,
     # how often we should call the Twitch API and fetch new VODs
     "twitch_vod_refresh_rate": 3 * 60 * 60,
+    # how often to check whether the channel is live (in seconds) while it's live, and while it's offline.
+    # When a stream ends, the Twitch VODs are refreshed and the folder is scanned right away
+    "live_check_interval": 60,
+    "offline_check_interval": 600,
     # how long to wait before making the video public (in minutes)
-    "scheduled_upload_wait_time": 1440
+    "scheduled_upload_wait_time": 1440,
+    # the order videos are uploaded in, see upload_queue.py for the available scorers
+    "upload_queue_order": ["resuming", "pinned", "pressure", "release", "size", "age"],
+    # the default scorers config.json has seen. Default scorers added in newer versions are inserted into
+    # upload_queue_order (where the default order has them) once, so removing a scorer from it sticks
+    "upload_queue_known_scorers": ["resuming", "pinned", "pressure", "release", "size", "age"],
+    # used to estimate when queued videos will be uploaded (in MB/s) until uploads were measured, see throughput.py
+    "estimated_upload_speed": 5,
+    # throughput samples of past uploads kept to estimate upload times (data/throughput_samples.json)
+    "throughput_sample_limit": 1000,
+    # YouTube Data API quota units available per day (reset at midnight PT)
+    "youtube_daily_quota": 10_000,
+
+    # serve Prometheus metrics at http://metrics_host:metrics_port/metrics (0 disables the server)
+    "metrics_port": 0,
+    "metrics_host": "localhost",
+
+    # serve the control API (see control.py and control_client.py) at http://control_host:control_port (0 disables it)
+    "control_port": 0,
+    "control_host": "localhost",
+
+    # seconds of cProfile / tracemalloc data to capture into logs/ when started with --profile (0 for only the stage timers)
+    "profile_window": 300,
+
+    # poll YouTube for the processing status of uploaded videos (see processing_status.py). Needs the youtube.force-ssl
+    # scope, which tokens saved before it was requested get with "python src/youtube_auth.py --grant <name>"
+    "processing_status_polling": True,
+
+    # free space (GB) to keep on the disks of the recordings and uploaded folders, by deleting uploaded recordings
+    # (oldest first) from the uploaded folders (0 disables it, see retention.py)
+    "retention_min_free_gb": 0,
+    # once a disk is under retention_min_free_gb, recordings are deleted until this much is free (0 for the minimum)
+    "retention_target_free_gb": 0,
+    # the newest recordings of every uploaded folder that are never deleted
+    "retention_keep_last": 5,
+    # only delete recordings YouTube finished processing, besides checking their fingerprint
+    "retention_require_processed": True,
+    "retention_check_interval": 600,
+
+    # share of every credential's daily quota that updating the title, description, tags and category of uploaded
+    # videos may use when their Twitch VOD or upload_categories.json changed (0 disables it, see metadata_resync.py)
+    "metadata_resync_quota_share": 0,
+    "metadata_resync_interval": 6 * 60 * 60,
+
+    # seconds to wait on SIGTERM for the upload chunk being sent to finish (and be checkpointed) before exiting
+    "shutdown_timeout": 120,
+
+    # "text" or "json" (JSON lines) for the files in logs/
+    "log_format": "text",
+    # log upload progress at most once every X seconds
+    "progress_log_interval": 30
 }
 
+# the default scorers of upload_queue_order before upload_queue_known_scorers was saved
+LEGACY_QUEUE_SCORERS = ["pinned", "release", "size", "age"]
+
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__ + "/.."))
 
 
+def add_new_queue_scorers(config_dict: dict) -> list:
+    """
+    Inserts the default scorers config_dict hasn't seen into its upload_queue_order, ahead of the
+    first scorer that follows them in the default order, and returns their names. Without
+    upload_queue_known_scorers (config.json written by an older version), the scorers it lists and
+    the original default ones count as seen.
+    """
+    order = config_dict["upload_queue_order"]
+    known = config_dict.get("upload_queue_known_scorers")
+    if known is None:
+        known = LEGACY_QUEUE_SCORERS + [name for name in order if name not in LEGACY_QUEUE_SCORERS]
+
+    default_order = DEFAULT_CONFIG["upload_queue_order"]
+    added = []
+    for i, name in enumerate(default_order):
+        if name in known or name in order:
+            continue
+
+        following = next((later for later in default_order[i + 1:] if later in order), None)
+        order.insert(order.index(following) if following else len(order), name)
+        added.append(name)
+
+    config_dict["upload_queue_known_scorers"] = known + [name for name in default_order if name not in known]
+    return added
+
+
 def create_default_config():
     with open(ROOT_DIR + "/data/config.json", "w") as file:
         file.write(json.dumps(DEFAULT_CONFIG, indent=4))
@@ -66,19 +178,74 @@ def load_config() -> dict:
         with open(ROOT_DIR + "/data/config.json", "r") as config_file:
             try:
                 config_dict = json.loads(config_file.read())
-                for key in DEFAULT_CONFIG:
-                    if key not in config_dict:
-                        logger.error(f"Invalid config: {config_dict}")
-                        raise ConfigLoadError("A key is missing from the config file. Reverting to defaults...")
+                if not isinstance(config_dict, dict):
+                    logger.error(f"Invalid config: {config_dict}")
+                    raise ConfigLoadError("The config file must contain a JSON object. Reverting to defaults...")
 
-                return config_dict
             except (json.decoder.JSONDecodeError, ConfigLoadError):
                 logger.error("There was an error with the config file. Reverting to defaults...", exc_info=True)
                 create_default_config()
                 return load_config()
+
+        # Scorers added to the default upload_queue_order in newer versions are inserted into the user's order
+        known_scorers = config_dict.get("upload_queue_known_scorers")
+        added_scorers = add_new_queue_scorers(config_dict) if isinstance(config_dict.get("upload_queue_order"), list) else []
+        if added_scorers:
+            logger.warning(f"Adding new scorers to upload_queue_order: {added_scorers} ({config_dict['upload_queue_order']})")
+
+        # Options added in newer versions are filled in with their defaults,
+        # instead of throwing away the user's credentials and paths
+        missing_keys = [key for key in DEFAULT_CONFIG if key not in config_dict]
+        if missing_keys or config_dict.get("upload_queue_known_scorers") != known_scorers:
+            if missing_keys:
+                logger.warning(f"Adding missing config options with their default values: {missing_keys}")
+            for key in missing_keys:
+                config_dict[key] = DEFAULT_CONFIG[key]
+
+            with open(ROOT_DIR + "/data/config.json", "w") as config_file:
+                config_file.write(json.dumps(config_dict, indent=4))
+
+        return config_dict
     else:
         create_default_config()
         return load_config()
 
 
-config = load_config()
+class LazyConfig(MutableMapping):
+    """
+    Behaves like the dict returned by load_config, but only loads (or creates) the config file
+    the first time a value is accessed, so importing this module is free of side effects.
+    """
+
+    def __init__(self):
+        self._data = None
+
+    @property
+    def data(self) -> dict:
+        if self._data is None:
+            self._data = load_config()
+        return self._data
+
+    def reload(self):
+        self._data = None
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+
+    def __delitem__(self, key):
+        del self.data[key]
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return repr(self.data)
+
+
+config = LazyConfig()
@@ -0,0 +1,309 @@
+"""
+A small JSON API for steering the running daemon, enabled with "control_port" in config.json
+(control_client.py is its command line client). Like the metrics server, it only listens on
+localhost by default.
+
+Every request needs the token in data/control_token.txt (created on start, only readable by its
+owner) as "Authorization: Bearer <token>", so web pages opened in a local browser can't use the API.
+Commands that change anything are POST only, with a JSON body (Content-Type: application/json).
+
+GET /<command> (read only commands) or POST /<command> with a JSON object of arguments:
+    status, queue, uploads              list the queue and the in flight uploads, with their estimated finish times
+    pause, resume [video_path]          pause or resume one upload (queued or in flight), or all of them
+    cancel <video_path>                 drop an upload, and its upload session
+    bandwidth <limit>                   change the upload bandwidth limit (MB/s, 0 for no limit)
+    refresh                             fetch the Twitch VODs right away
+    pin, unpin <vod_id>                 move a VOD to the front of the upload queue (or back)
+    profile [action] [seconds]          the stage timers, "on" / "off" to toggle them, or "capture" a
+                                        cProfile / tracemalloc profile (profile_window seconds by default)
+"""
+
+import os
+import hmac
+import json
+import secrets
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from state import remove_in_progress_upload
+from upload_queue import get_entry_channel
+from upload_control import get_upload_controller
+from bandwidth import get_bandwidth_budget
+from throughput import get_upload_eta, get_throughput_model
+from config import config
+import profiling
+
+import logging
+logger = logging.getLogger()
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__ + "/.."))
+CONTROL_TOKEN_PATH = ROOT_DIR + "/data/control_token.txt"
+
+# name -> function(watcher, arguments) returning a JSON serializable result
+commands = {}
+# commands that only read, which can also be run with GET
+read_only_commands = set()
+control_server = None
+
+
+class ControlError(Exception):
+    pass
+
+
+def control_command(name: str, read_only: bool = False):
+    """Registers a control API command."""
+
+    def decorator(func):
+        commands[name] = func
+        if read_only:
+            read_only_commands.add(name)
+        return func
+
+    return decorator
+
+
+def get_video_path(arguments: dict) -> str:
+    video_path = arguments.get("video_path")
+    if not video_path:
+        raise ControlError("video_path is required")
+    return video_path
+
+
+@control_command("uploads", read_only=True)
+def list_uploads(watcher, arguments: dict) -> list:
+    return [
+        dict(
+            {key: value for key, value in upload.items() if key != "hours"},
+            progress=upload["uploaded_bytes"] / upload["file_size"] if upload["file_size"] else 0,
+            eta=get_upload_eta(upload)
+        )
+        for upload in get_upload_controller().get_active_uploads()
+    ]
+
+
+@control_command("queue", read_only=True)
+def list_queue(watcher, arguments: dict) -> list:
+    controller = get_upload_controller()
+    active = {upload["video_path"]: upload for upload in list_uploads(watcher, arguments)}
+
+    queue = []
+    for position, entry in enumerate(watcher.upload_queue.ordered(), start=1):
+        video_path = entry["video_path"]
+        # as of the upload task's last plan (see RecordingsWatcher.plan_uploads)
+        estimated_start, estimated_finish = watcher.upload_estimates.get(video_path, (None, None))
+        queue.append({
+            "position": position,
+            "video_path": video_path,
+            "twitch_vod_id": entry["twitch_vod"]["id"],
+            "channel": get_entry_channel(entry),
+            "file_size": entry.get("file_size"),
+            "uploaded_bytes": active[video_path]["uploaded_bytes"] if video_path in active else entry.get("uploaded_bytes"),
+            "pinned": entry.get("pinned", False),
+            "uploading": video_path in active,
+            "paused": controller.is_paused(video_path),
+            "estimated_start": estimated_start,
+            "estimated_finish": active[video_path]["eta"] if video_path in active else estimated_finish
+        })
+
+    return queue
+
+
+@control_command("status", read_only=True)
+def get_status(watcher, arguments: dict) -> dict:
+    budget = get_bandwidth_budget()
+    queue = list_queue(watcher, arguments)
+    model = get_throughput_model()
+    return {
+        "paused_all": get_upload_controller().paused_all,
+        "bandwidth_limit": budget.bytes_per_second / 1_000_000 if budget.is_limited() else 0,
+        "uploads": list_uploads(watcher, arguments),
+        "queue": queue,
+        "queue_finish": max((entry["estimated_finish"] for entry in queue if entry["estimated_finish"]), default=None),
+        "throughput": {"samples": model.sample_count, "hourly_mb_per_second": model.get_hourly_rates()}
+    }
+
+
+@control_command("pause")
+def pause_uploads(watcher, arguments: dict) -> dict:
+    video_path = arguments.get("video_path")
+    get_upload_controller().pause(video_path)
+    logger.info(f"Paused {'the upload of ' + video_path if video_path else 'all uploads'} (control API)")
+    return {"paused": video_path or "all"}
+
+
+@control_command("resume")
+def resume_uploads(watcher, arguments: dict) -> dict:
+    video_path = arguments.get("video_path")
+    get_upload_controller().resume(video_path)
+    logger.info(f"Resumed {'the upload of ' + video_path if video_path else 'all uploads'} (control API)")
+
+    # Cancelled videos are queued again by the next scan
+    watcher.scheduler.trigger("scan")
+    watcher.scheduler.trigger("upload")
+    return {"resumed": video_path or "all"}
+
+
+@control_command("cancel")
+def cancel_upload(watcher, arguments: dict) -> dict:
+    """An upload in flight stops after its current chunk, and the upload task drops it from the queue."""
+    video_path = get_video_path(arguments)
+    controller = get_upload_controller()
+    controller.cancel(video_path)
+    logger.info(f"Cancelling the upload of {video_path} (control API)")
+
+    if not any(upload["video_path"] == video_path for upload in controller.get_active_uploads()):
+        entry = next((entry for entry in watcher.upload_queue.ordered() if entry["video_path"] == video_path), None)
+        if entry and entry.get("upload_url"):
+            remove_in_progress_upload(entry["twitch_vod"]["id"])
+        watcher.upload_queue.remove(video_path)
+
+    return {"cancelled": video_path}
+
+
+@control_command("bandwidth")
+def set_bandwidth_limit(watcher, arguments: dict) -> dict:
+    try:
+        limit = float(arguments.get("limit"))
+    except (TypeError, ValueError):
+        raise ControlError("limit (MB/s) is required")
+
+    get_bandwidth_budget().set_rate(limit * 1_000_000)
+    logger.info(f"Changed the upload bandwidth limit to {limit} MB/s (control API)" if limit else "Removed the upload bandwidth limit (control API)")
+    return {"bandwidth_limit": limit}
+
+
+@control_command("refresh")
+def refresh_twitch(watcher, arguments: dict) -> dict:
+    watcher.scheduler.trigger("refresh_twitch")
+    return {"refreshing": True}
+
+
+@control_command("pin")
+def pin_vod(watcher, arguments: dict) -> dict:
+    if not arguments.get("vod_id"):
+        raise ControlError("vod_id is required")
+
+    watcher.upload_queue.pin(arguments["vod_id"])
+    return {"pinned": arguments["vod_id"]}
+
+
+@control_command("unpin")
+def unpin_vod(watcher, arguments: dict) -> dict:
+    if not arguments.get("vod_id"):
+        raise ControlError("vod_id is required")
+
+    watcher.upload_queue.unpin(arguments["vod_id"])
+    return {"unpinned": arguments["vod_id"]}
+
+
+@control_command("profile", read_only=True)
+def control_profiling(watcher, arguments: dict) -> dict:
+    action = arguments.get("action")
+    if action == "on":
+        profiling.enable()
+    elif action == "off":
+        profiling.disable()
+    elif action == "capture":
+        try:
+            seconds = float(arguments.get("seconds") or config["profile_window"] or 60)
+        except ValueError:
+            raise ControlError("seconds must be a number")
+        if not profiling.start_capture(seconds):
+            raise ControlError("A capture is already running")
+    elif action:
+        raise ControlError("action must be on, off or capture")
+
+    return {"enabled": profiling.is_enabled(), "stage_timers": profiling.get_stage_timers()}
+
+
+class ControlHandler(BaseHTTPRequestHandler):
+    # set by start_control_server()
+    watcher = None
+    token = None
+
+    def do_GET(self):
+        if self.get_command_name() not in read_only_commands:
+            self.send_json(405, {"error": "This command is POST only"})
+            return
+
+        self.run_command({})
+
+    def do_POST(self):
+        if self.headers.get("Content-Type", "").split(";")[0].strip() != "application/json":
+            self.send_json(415, {"error": "The body must be JSON (Content-Type: application/json)"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            arguments = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(arguments, dict):
+                raise ValueError
+        except ValueError:
+            self.send_json(400, {"error": "The body must be a JSON object"})
+            return
+
+        self.run_command(arguments)
+
+    def get_command_name(self) -> str:
+        return self.path.split("?")[0].strip("/")
+
+    def is_authorized(self) -> bool:
+        authorization = self.headers.get("Authorization", "")
+        return authorization.startswith("Bearer ") and hmac.compare_digest(authorization[len("Bearer "):], self.token)
+
+    def run_command(self, arguments: dict):
+        if not self.is_authorized():
+            self.send_json(401, {"error": f"Missing or wrong token (see {CONTROL_TOKEN_PATH})"})
+            return
+
+        command = commands.get(self.get_command_name())
+        if not command:
+            self.send_json(404, {"error": f"Unknown command, available: {sorted(commands)}"})
+            return
+
+        try:
+            self.send_json(200, command(self.watcher, arguments))
+        except ControlError as e:
+            self.send_json(400, {"error": str(e)})
+        except Exception as e:
+            logger.error(f"Control API command {self.path} failed", exc_info=True)
+            self.send_json(500, {"error": str(e)})
+
+    def send_json(self, status: int, result):
+        body = json.dumps(result, indent=4).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return
+
+
+def get_control_token() -> str:
+    """The token clients have to send, created (only readable by its owner) the first time it's needed."""
+    if os.path.isfile(CONTROL_TOKEN_PATH):
+        with open(CONTROL_TOKEN_PATH, "r", encoding="utf8") as file:
+            token = file.read().strip()
+        if token:
+            return token
+
+    token = secrets.token_urlsafe(32)
+    fd = os.open(CONTROL_TOKEN_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf8") as file:
+        file.write(token)
+    return token
+
+
+def start_control_server(watcher, port: int, host: str = "localhost"):
+    """Serves the control API for the given RecordingsWatcher from a daemon thread. Returns the server address."""
+    global control_server
+
+    handler = type("WatcherControlHandler", (ControlHandler,), {"watcher": watcher, "token": get_control_token()})
+    control_server = HTTPServer((host, port), handler)
+    thread = threading.Thread(target=control_server.serve_forever, name="control-server", daemon=True)
+    thread.start()
+
+    logger.info(f"Serving the control API at http://{control_server.server_address[0]}:{control_server.server_address[1]}")
+    return control_server.server_address
@@ -0,0 +1,151 @@
+"""
+Command line client for the control API of a running bot.py (see control.py).
+
+Usage: python src/control_client.py <command> [argument]
+    status                      the queue and the in flight uploads, with their estimated finish times
+    queue / uploads             only one of them
+    pause [video path]          pause an upload, or all of them
+    resume [video path]         resume an upload (also a cancelled one), or all of them
+    cancel <video path>         drop an upload
+    bandwidth <MB/s>            change the upload bandwidth limit (0 for no limit)
+    refresh                     fetch the Twitch VODs right away
+    pin / unpin <VOD ID>        move a VOD to the front of the upload queue (or back)
+    profile [on / off]          the pipeline stage timers, or turn them on or off
+    profile capture [seconds]   write a cProfile / tracemalloc profile to logs/ (see profiling.py)
+"""
+
+import os
+import sys
+import json
+import urllib.request
+import urllib.error
+from datetime import datetime
+
+from config import config
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__ + "/.."))
+CONTROL_TOKEN_PATH = ROOT_DIR + "/data/control_token.txt"
+
+# the argument each command takes
+COMMAND_ARGUMENTS = {
+    "status": None,
+    "queue": None,
+    "uploads": None,
+    "pause": "video_path",
+    "resume": "video_path",
+    "cancel": "video_path",
+    "bandwidth": "limit",
+    "refresh": None,
+    "pin": "vod_id",
+    "unpin": "vod_id",
+    "profile": "action"
+}
+
+
+def send_command(command: str, arguments: dict = None):
+    """Runs a control API command, returning its result. Raises RuntimeError with the API's error message."""
+    url = f"http://{config['control_host']}:{config['control_port']}/{command}"
+    try:
+        with open(CONTROL_TOKEN_PATH, "r", encoding="utf8") as file:
+            token = file.read().strip()
+    except OSError:
+        raise RuntimeError(f"Unable to read the control API token ({CONTROL_TOKEN_PATH}), is bot.py running?")
+
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(arguments or {}).encode("utf-8"),
+        headers={"Content-Type": "application/json", "Authorization": f"Bearer {token}"}
+    )
+
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        raise RuntimeError(json.loads(e.read()).get("error", e.reason))
+
+
+def format_size(size) -> str:
+    return f"{size / 1024 ** 3:.2f} GiB" if size else "-"
+
+
+def format_time(timestamp) -> str:
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %I:%M %p") if timestamp else "-"
+
+
+def print_uploads(uploads: list):
+    if not uploads:
+        print("No uploads in flight")
+
+    for upload in uploads:
+        state = "paused after this chunk" if upload["paused"] else f"{upload['rate'] / 1_000_000:.2f} MB/s"
+        print(
+            f"UPLOADING {upload['twitch_vod_id']} | {upload['progress'] * 100:.1f}% "
+            f"({upload['uploaded_bytes']}/{upload['file_size']} bytes) | {state} | ETA {format_time(upload['eta'])} | {upload['video_path']}"
+        )
+
+
+def print_queue(queue: list):
+    if not queue:
+        print("The upload queue is empty")
+
+    for entry in queue:
+        flags = [flag for flag in ("uploading", "paused", "pinned") if entry[flag]]
+        offset = f" | resumes at {entry['uploaded_bytes']} bytes" if entry["uploaded_bytes"] and not entry["uploading"] else ""
+        print(
+            f"{entry['position']}. {entry['twitch_vod_id']} ({entry['channel']}){' [' + ', '.join(flags) + ']' if flags else ''} | "
+            f"{format_size(entry['file_size'])}{offset} | done ~{format_time(entry['estimated_finish'])} | {entry['video_path']}"
+        )
+
+
+def print_stage_timers(result: dict):
+    print(f"Profiling {'enabled' if result['enabled'] else 'disabled'}")
+    if result["stage_timers"]:
+        print(f"{'stage':<28}{'runs':>8}{'total (s)':>12}{'mean (ms)':>12}{'max (ms)':>12}")
+    for name, timer in result["stage_timers"].items():
+        print(f"{name:<28}{timer['runs']:>8}{timer['total_seconds']:>12.3f}{timer['mean_seconds'] * 1000:>12.2f}{timer['max_seconds'] * 1000:>12.2f}")
+
+
+def main(argv: list) -> int:
+    if not argv or argv[0] not in COMMAND_ARGUMENTS:
+        print(__doc__.strip())
+        return 2
+
+    command = argv[0]
+    if not config["control_port"]:
+        print("The control API is disabled, set control_port in data/config.json")
+        return 1
+
+    arguments = {}
+    if COMMAND_ARGUMENTS[command] and len(argv) > 1:
+        arguments[COMMAND_ARGUMENTS[command]] = argv[1]
+    if command == "profile" and len(argv) > 2:
+        arguments["seconds"] = argv[2]
+
+    try:
+        result = send_command(command, arguments)
+    except RuntimeError as e:
+        print(f"Error: {e}")
+        return 1
+    except OSError as e:
+        print(f"Unable to reach bot.py at {config['control_host']}:{config['control_port']} ({e})")
+        return 1
+
+    if command == "status":
+        limit = f"{result['bandwidth_limit']} MB/s" if result["bandwidth_limit"] else "none"
+        print(f"Uploads {'paused' if result['paused_all'] else 'running'} | bandwidth limit: {limit} | queue done ~{format_time(result['queue_finish'])}")
+        print_uploads(result["uploads"])
+        print_queue(result["queue"])
+    elif command == "uploads":
+        print_uploads(result)
+    elif command == "queue":
+        print_queue(result)
+    elif command == "profile":
+        print_stage_timers(result)
+    else:
+        print(json.dumps(result))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
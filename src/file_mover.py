@@ -0,0 +1,215 @@
+"""
+Moves completed uploads to the uploaded folder, even when it's on another disk.
+
+A rename is tried first. When that fails with EXDEV (a different filesystem), the file is copied
+in the kernel (copy_file_range, or sendfile) to "<destination>.partial", synced to disk, verified
+(by size, or by SHA-256 digest) and only then renamed into place and removed from the source.
+An interrupted copy is resumed from the partial file on the next attempt.
+
+Moves run one at a time on a background thread with the lowest CPU and I/O priority, so they
+don't compete with recording or uploading.
+"""
+
+import os
+import sys
+import errno
+import ctypes
+import hashlib
+import platform
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from shutdown import is_shutting_down
+
+import logging
+logger = logging.getLogger()
+
+PARTIAL_SUFFIX = ".partial"
+
+# bytes copied per copy_file_range / sendfile call
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+# an interrupted copy is resumed this many bytes before the end of the partial file,
+# in case the last writes didn't make it to disk
+RESUME_OVERLAP = 64 * 1024 * 1024
+
+# ioprio_set(2) syscall numbers
+IOPRIO_SET_SYSCALLS = {"x86_64": 251, "aarch64": 30, "i386": 289, "i686": 289, "armv7l": 314}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+move_executor = None
+move_executor_lock = threading.Lock()
+
+
+class VerificationError(Exception):
+    pass
+
+
+def lower_thread_priority():
+    """Gives the calling thread the lowest CPU (nice 19) and I/O (idle class) priority, where supported."""
+    if not sys.platform.startswith("linux"):
+        return
+
+    thread_id = threading.get_native_id()
+
+    try:
+        os.setpriority(os.PRIO_PROCESS, thread_id, 19)
+    except OSError:
+        logger.debug("Unable to lower the CPU priority of the move thread", exc_info=True)
+
+    syscall_number = IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if syscall_number is None:
+        return
+
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.syscall(syscall_number, IOPRIO_WHO_PROCESS, thread_id, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT) != 0:
+            logger.debug(f"ioprio_set failed: {os.strerror(ctypes.get_errno())}")
+    except (OSError, AttributeError):
+        logger.debug("Unable to lower the I/O priority of the move thread", exc_info=True)
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(8 * 1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def fsync_directory(path: str):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def copy_range(source_fd: int, destination_fd: int, offset: int, count: int) -> int:
+    """Copies up to count bytes at offset between the files without going through user space. Returns the bytes copied."""
+    if hasattr(os, "copy_file_range"):
+        try:
+            return os.copy_file_range(source_fd, destination_fd, count, offset, offset)
+        except OSError as e:
+            # Not supported between these filesystems (or kernels), fall through to sendfile
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+
+    if hasattr(os, "sendfile") and sys.platform.startswith("linux"):
+        os.lseek(destination_fd, offset, os.SEEK_SET)
+        return os.sendfile(destination_fd, source_fd, offset, count)
+
+    data = os.pread(source_fd, min(count, 8 * 1024 * 1024), offset)
+    return os.pwrite(destination_fd, data, offset)
+
+
+def copy_file(source: str, partial_path: str):
+    """Copies source to partial_path, continuing from what an earlier (interrupted) copy left behind."""
+    source_size = os.path.getsize(source)
+
+    offset = 0
+    if os.path.isfile(partial_path):
+        offset = max(min(os.path.getsize(partial_path), source_size) - RESUME_OVERLAP, 0)
+        if offset:
+            logger.info(f"Resuming the copy of {source} at {offset} bytes")
+
+    source_fd = os.open(source, os.O_RDONLY)
+    try:
+        destination_fd = os.open(partial_path, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(destination_fd, offset)
+
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(source_fd, offset, 0, os.POSIX_FADV_SEQUENTIAL)
+
+            while offset < source_size:
+                # The partial copy is picked up again on the next start
+                if is_shutting_down():
+                    raise InterruptedError(f"Copy of {source} stopped for shutdown at {offset}/{source_size} bytes")
+
+                copied = copy_range(source_fd, destination_fd, offset, min(COPY_CHUNK_SIZE, source_size - offset))
+                if copied == 0:
+                    raise OSError(f"Unexpected end of file while copying {source} ({offset}/{source_size} bytes)")
+
+                # The copied data won't be read again, don't keep it in the page cache
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(source_fd, offset, copied, os.POSIX_FADV_DONTNEED)
+                offset += copied
+
+            os.fsync(destination_fd)
+        finally:
+            os.close(destination_fd)
+    finally:
+        os.close(source_fd)
+
+
+def verify_copy(source: str, copy_path: str, verify: str):
+    if os.path.getsize(source) != os.path.getsize(copy_path):
+        raise VerificationError(f"Size mismatch between {source} and {copy_path}")
+
+    if verify == "digest" and file_digest(source) != file_digest(copy_path):
+        raise VerificationError(f"SHA-256 mismatch between {source} and {copy_path}")
+
+
+def move_file(source: str, destination: str, verify: str = "size"):
+    """
+    Moves source to destination (a file path). Falls back to a verified copy followed by removing
+    the source if they are on different filesystems.
+    verify: "size" or "digest"
+    """
+    try:
+        os.rename(source, destination)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    # An earlier attempt may have crashed after renaming the copy into place, but before removing the source
+    if os.path.isfile(destination) and os.path.getsize(destination) == os.path.getsize(source):
+        try:
+            verify_copy(source, destination, verify)
+            logger.info(f"{destination} was already copied, removing {source}")
+            os.remove(source)
+            return
+        except VerificationError:
+            pass
+
+    logger.info(f"{destination} is on another filesystem, copying {source}")
+
+    partial_path = destination + PARTIAL_SUFFIX
+    copy_file(source, partial_path)
+
+    try:
+        verify_copy(source, partial_path, verify)
+    except VerificationError:
+        # Start over from scratch next time
+        os.remove(partial_path)
+        raise
+
+    os.replace(partial_path, destination)
+    fsync_directory(os.path.dirname(os.path.abspath(destination)))
+
+    os.remove(source)
+    logger.info(f"Moved {source} to {destination}")
+
+
+def get_move_executor() -> ThreadPoolExecutor:
+    global move_executor
+
+    with move_executor_lock:
+        if move_executor is None:
+            move_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="file-mover", initializer=lower_thread_priority)
+
+    return move_executor
+
+
+def move_file_in_background(source: str, destination: str, verify: str = "size"):
+    """Queues a move on the low priority mover thread, returning a Future."""
+    return get_move_executor().submit(move_file, source, destination, verify)
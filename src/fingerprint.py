@@ -0,0 +1,122 @@
+"""
+Content fingerprints of video files, used to notice that a recording was already uploaded
+even when it was copied, renamed, or matched with a different Twitch VOD.
+
+Hashing whole recordings would read tens of GiB per scan, so a fingerprint is the file size
+plus a SHA-256 of sampled blocks: the head, the tail, and evenly strided blocks in between.
+Fingerprints are computed in a process pool and cached by (size, modification time), so a
+file is only read once while it sits in the folder.
+"""
+
+import os
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import logging
+logger = logging.getLogger()
+
+# bytes read for each sampled block
+SAMPLE_BLOCK_SIZE = 1024 * 1024
+
+fingerprint_executor = None
+fingerprint_executor_lock = threading.Lock()
+
+# file path -> (size, mtime_ns, fingerprint)
+fingerprint_cache = {}
+fingerprint_cache_lock = threading.Lock()
+
+
+def get_sample_offsets(size: int, sample_count: int) -> list:
+    """The offsets of the head block, sample_count strided blocks, and the tail block."""
+    if size <= SAMPLE_BLOCK_SIZE * (sample_count + 2):
+        # Small enough to hash the whole file
+        return list(range(0, size, SAMPLE_BLOCK_SIZE))
+
+    last_offset = size - SAMPLE_BLOCK_SIZE
+    stride = last_offset // (sample_count + 1)
+    return [0] + [stride * i for i in range(1, sample_count + 1)] + [last_offset]
+
+
+def compute_fingerprint(path: str, sample_count: int) -> str:
+    """Returns "<size>-<sample count>-<SHA-256 of the sampled blocks>". Runs in the worker processes."""
+    digest = hashlib.sha256()
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        digest.update(size.to_bytes(8, "little"))
+
+        for offset in get_sample_offsets(size, sample_count):
+            digest.update(os.pread(fd, SAMPLE_BLOCK_SIZE, offset))
+            # The samples won't be read again (until the upload streams the file)
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(fd, offset, SAMPLE_BLOCK_SIZE, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+    return f"{size}-{sample_count}-{digest.hexdigest()}"
+
+
+def get_fingerprint_executor() -> ProcessPoolExecutor:
+    global fingerprint_executor
+    from config import config
+
+    with fingerprint_executor_lock:
+        if fingerprint_executor is None:
+            # spawn instead of fork, since the daemon forks from a process full of threads
+            fingerprint_executor = ProcessPoolExecutor(
+                max_workers=config["fingerprint_workers"],
+                mp_context=multiprocessing.get_context("spawn")
+            )
+
+    return fingerprint_executor
+
+
+def get_cached_fingerprint(path: str, stat: os.stat_result):
+    with fingerprint_cache_lock:
+        cached = fingerprint_cache.get(path)
+    if cached and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+        return cached[2]
+    return None
+
+
+def fingerprint_files(paths) -> dict:
+    """
+    Returns {path: fingerprint} for the given files, hashing the ones that changed since they
+    were last fingerprinted in the process pool. Files that can't be read are left out.
+    """
+    from config import config
+
+    fingerprints = {}
+    futures = {}
+
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+
+        fingerprint = get_cached_fingerprint(path, stat)
+        if fingerprint:
+            fingerprints[path] = fingerprint
+        else:
+            futures[path] = (stat, get_fingerprint_executor().submit(compute_fingerprint, path, config["fingerprint_sample_blocks"]))
+
+    for path, (stat, future) in futures.items():
+        try:
+            fingerprints[path] = future.result()
+        except OSError:
+            logger.error(f"Unable to fingerprint {path}", exc_info=True)
+            continue
+
+        with fingerprint_cache_lock:
+            fingerprint_cache[path] = (stat.st_size, stat.st_mtime_ns, fingerprints[path])
+
+    return fingerprints
+
+
+def get_fingerprint(path: str):
+    """The fingerprint of a single file, or None if it can't be read."""
+    return fingerprint_files([path]).get(path)
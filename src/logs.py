@@ -1,10 +1,19 @@
 """
 Handles setting up the root logger so all modules can have
 consistent log formatting and filtering.
+
+Records are handed to a QueueListener thread, so file and console I/O never happens on the
+thread doing the logging (such as the one uploading). Log files are named after the current
+date and switch over at midnight.
 """
 
 import os
+import copy
+import json
+import atexit
 import logging
+import logging.handlers
+import queue
 import time
 import sys
 from datetime import date
@@ -13,8 +22,7 @@ ROOT_DIR = os.path.dirname(os.path.abspath(__file__ + "/.."))
 
 LOGS_FILE_PATH = ROOT_DIR + "/logs"
 
-if not os.path.exists(LOGS_FILE_PATH):
-    os.mkdir(LOGS_FILE_PATH)
+log_listener = None
 
 
 class StreamFilter():
@@ -26,25 +34,125 @@ class StreamFilter():
         return logRecord.levelno != 10 or self.__debug_enabled
 
 
-def setup_logger(debug_enabled=False):
+class DailyFileHandler(logging.FileHandler):
+    """Writes to logs/<date>.log, moving on to a new file when the date changes."""
+
+    def __init__(self, directory: str, suffix: str = ".log", encoding="utf8"):
+        self.directory = directory
+        self.suffix = suffix
+        self.current_date = date.today()
+        super().__init__(self.get_file_path(), encoding=encoding, delay=True)
+
+    def get_file_path(self) -> str:
+        return f"{self.directory}/{self.current_date}{self.suffix}"
+
+    def emit(self, record):
+        today = date.today()
+        if today != self.current_date:
+            self.current_date = today
+            self.close()
+            self.baseFilename = os.path.abspath(self.get_file_path())
+
+        super().emit(record)
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as JSON lines (one object per record)."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%SZ"),
+            "level": record.levelname,
+            "module": record.module,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class LocalQueueHandler(logging.handlers.QueueHandler):
+    """
+    A QueueHandler for a queue read in the same process. QueueHandler.prepare() formats the traceback
+    into the message and drops exc_info (records have to be picklable for other queues), which left the
+    JSON formatter without its "exception" field. Here only the message's arguments are merged in, the
+    handlers behind the QueueListener format everything else.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        return record
+
+
+class ProgressRateLimiter():
+    """
+    Decides whether a progress update is worth logging, so the amount of progress output
+    stays the same no matter how many chunks a file is split into.
+    Logs at most once every interval seconds, plus the first and final update.
+    """
+
+    def __init__(self, interval: float = 30):
+        self.interval = interval
+        self.last_logged = None
+
+    def should_log(self, fraction_done: float) -> bool:
+        now = time.monotonic()
+
+        if self.last_logged is None or fraction_done >= 1 or now - self.last_logged >= self.interval:
+            self.last_logged = now
+            return True
+
+        return False
+
+
+def stop_logger():
+    """Flushes any queued records. Registered with atexit by setup_logger."""
+    global log_listener
+
+    if log_listener:
+        log_listener.stop()
+        log_listener = None
+
+
+def setup_logger(debug_enabled=False, json_format=False):
+    global log_listener
+
+    if not os.path.exists(LOGS_FILE_PATH):
+        os.mkdir(LOGS_FILE_PATH)
+
     formatter = logging.Formatter("%(asctime)s %(levelname)s | [%(module)s.py]: %(message)s", "%Y-%m-%d %H:%M:%S")
     logging.Formatter.converter = time.gmtime
 
     logger = logging.getLogger()
     logger.setLevel(logging.DEBUG)
 
-    fileHandler = logging.FileHandler(f"{LOGS_FILE_PATH}/{date.today()}.log")
-    streamHandler = logging.StreamHandler(sys.stdout)
+    if json_format:
+        fileHandler = DailyFileHandler(LOGS_FILE_PATH, ".jsonl")
+        fileHandler.setFormatter(JsonFormatter())
+    else:
+        fileHandler = DailyFileHandler(LOGS_FILE_PATH)
+        fileHandler.setFormatter(formatter)
 
-    for handler in (fileHandler, streamHandler):
-        handler.setFormatter(formatter)
+    streamHandler = logging.StreamHandler(sys.stdout)
+    streamHandler.setFormatter(formatter)
 
     fileHandler.setLevel(logging.DEBUG)
 
     streamFilter = StreamFilter(debug_enabled)
     streamHandler.addFilter(streamFilter)
 
-    logger.addHandler(fileHandler)
-    logger.addHandler(streamHandler)
+    # Only the queue handler runs on the logging thread, the listener thread does the writing
+    log_queue = queue.SimpleQueue()
+    log_listener = logging.handlers.QueueListener(log_queue, fileHandler, streamHandler, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(stop_logger)
+
+    logger.addHandler(LocalQueueHandler(log_queue))
 
     return logger
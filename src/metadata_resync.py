@@ -0,0 +1,179 @@
+"""
+Keeps the titles, descriptions, tags and categories of uploaded videos in sync with their Twitch
+VODs and upload_categories.json. Enabled with "metadata_resync_quota_share" in config.json.
+
+Every run re-renders the metadata of every uploaded video (see upload_categories.py) from its
+current Twitch VOD, fetched by ID (100 per request), and compares it with the snippet saved in its
+upload record when it was uploaded (or last synced). Only videos whose rendered metadata actually
+changed are updated: their current snippets are fetched with videos.list (50 per call, 1 unit),
+every changed field is applied at once, and each video costs one videos.update call (50 units).
+Updates stop once a credential used its share of the daily quota, the rest wait for the next run.
+"""
+
+import time
+
+import twitch_api
+from config import config
+from quota import QUOTA_COSTS
+from state import get_upload_records, update_upload_records
+from channels import get_vod_channel
+from upload_categories import get_categories, get_formatted_metadata, reload_categories
+from processing_status import FAILED_UPLOAD_STATUSES
+
+import logging
+logger = logging.getLogger()
+
+VIDEOS_ENDPOINT = "https://www.googleapis.com/youtube/v3/videos"
+# videos.list accepts up to 50 IDs per call
+BATCH_SIZE = 50
+
+# the snippet fields rendered from upload_categories.json
+SYNCED_FIELDS = ("title", "description", "tags", "categoryId")
+# the snippet fields videos.update accepts (the others are read only)
+WRITABLE_FIELDS = ("title", "description", "tags", "categoryId", "defaultLanguage")
+
+
+def render_snippet(twitch_vod: dict) -> dict:
+    """The snippet an upload of the VOD would get now."""
+    from upload import shorten_video_title
+
+    snippet, _ = get_formatted_metadata(get_categories(get_vod_channel(twitch_vod).categories_path), twitch_vod)
+    if "title" in snippet and len(snippet["title"]) > 100:
+        snippet["title"] = shorten_video_title(snippet["title"])
+
+    return {field: snippet[field] for field in SYNCED_FIELDS if field in snippet}
+
+
+def get_changes(saved: dict, rendered: dict) -> dict:
+    """
+    The rendered fields that differ from the saved ones. Fields that weren't saved (records from
+    before tags and categories were saved) are left alone, since what YouTube has isn't known.
+    """
+    return {field: value for field, value in rendered.items() if field in saved and saved[field] != value}
+
+
+class MetadataResync():
+    def __init__(self, credential_pool):
+        self.credential_pool = credential_pool
+        self.quota_share = config["metadata_resync_quota_share"]
+
+    def get_budget(self, credential) -> int:
+        """The quota units the credential can still spend on updates today."""
+        ledger = credential.quota_ledger
+        share_left = int(ledger.daily_limit * self.quota_share) - ledger.used_by("videos.update")
+        return max(min(share_left, ledger.remaining()), 0)
+
+    def find_changes(self) -> dict:
+        """Returns {Twitch VOD ID: (upload record, rendered snippet, changed fields)} for the videos whose metadata changed."""
+        records = {
+            twitch_vod_id: record for twitch_vod_id, record in get_upload_records().items()
+            if record.get("video_id") and record.get("snippet") and record.get("upload_status") not in FAILED_UPLOAD_STATUSES
+        }
+        if not records:
+            return {}
+
+        # Picks up edits to the categories files
+        reload_categories()
+
+        try:
+            twitch_vods = twitch_api.fetch_videos_by_id(list(records))
+        except twitch_api.TwitchAPIError as e:
+            logger.error(f"Unable to fetch the Twitch VODs of the uploaded videos ({e})")
+            return {}
+
+        changes = {}
+        for twitch_vod in twitch_vods:
+            record = records[twitch_vod["id"]]
+            try:
+                rendered = render_snippet(twitch_vod)
+            except Exception:
+                logger.error(f"Unable to render the metadata of VOD {twitch_vod['id']}", exc_info=True)
+                continue
+
+            changed = get_changes(record["snippet"], rendered)
+            if changed:
+                changes[twitch_vod["id"]] = (record, rendered, changed)
+
+        return changes
+
+    def run(self):
+        """Scheduler task: updates the videos whose metadata changed, within the quota share."""
+        changes = self.find_changes()
+        if not changes:
+            logger.debug("The metadata of every uploaded video is up to date")
+            return
+
+        logger.info(f"The metadata of {len(changes)} uploaded video(s) changed")
+
+        # Videos can only be updated with the credentials (channel) that uploaded them
+        by_credential = {}
+        for twitch_vod_id, (record, _, _) in changes.items():
+            by_credential.setdefault(record.get("credential", "default"), []).append(twitch_vod_id)
+
+        updates = {}
+        for credential_name, twitch_vod_ids in by_credential.items():
+            credential = self.credential_pool.get(credential_name)
+            if not credential:
+                continue
+            if credential.missing_scopes():
+                # videos.list and videos.update would only get 403s (and still be charged)
+                logger.error(f"Unable to update the metadata of uploaded videos, the \"{credential_name}\" credentials weren't granted {', '.join(credential.missing_scopes())}")
+                continue
+
+            affordable = self.get_budget(credential) // QUOTA_COSTS["videos.update"]
+            if affordable < len(twitch_vod_ids):
+                logger.info(f"{len(twitch_vod_ids) - affordable} metadata update(s) of the \"{credential_name}\" credentials wait for the next run (quota share used)")
+            if affordable <= 0:
+                continue
+
+            for i in range(0, min(affordable, len(twitch_vod_ids)), BATCH_SIZE):
+                batch = twitch_vod_ids[i:min(i + BATCH_SIZE, affordable)]
+                updates.update(self.update_batch(credential, {twitch_vod_id: changes[twitch_vod_id] for twitch_vod_id in batch}))
+
+        if updates:
+            update_upload_records(updates)
+
+    def update_batch(self, credential, changes: dict) -> dict:
+        """Updates up to 50 videos, returning the upload record updates of those that succeeded."""
+        video_ids = {record["video_id"]: twitch_vod_id for twitch_vod_id, (record, _, _) in changes.items()}
+
+        try:
+            response = credential.session.get(VIDEOS_ENDPOINT, params={"part": "snippet", "id": ",".join(video_ids)})
+            credential.quota_ledger.charge("videos.list")
+            if response.status_code == 403:
+                logger.error(f"Unable to fetch the snippets of uploaded videos ({response.text})")
+                return {}
+            response.raise_for_status()
+            current = {item["id"]: item["snippet"] for item in response.json().get("items", [])}
+        except Exception:
+            logger.error("Unable to fetch the snippets of uploaded videos", exc_info=True)
+            return {}
+
+        updates = {}
+        for video_id, twitch_vod_id in video_ids.items():
+            if video_id not in current:
+                logger.warning(f"Skipping the metadata update of {video_id} (VOD {twitch_vod_id}), it no longer exists")
+                continue
+
+            record, _, changed = changes[twitch_vod_id]
+            snippet = {field: current[video_id][field] for field in WRITABLE_FIELDS if field in current[video_id]}
+            snippet.update(changed)
+
+            try:
+                response = credential.session.put(VIDEOS_ENDPOINT, params={"part": "snippet"}, json={"id": video_id, "snippet": snippet})
+                credential.quota_ledger.charge("videos.update")
+            except Exception:
+                logger.error(f"Unable to update the metadata of {video_id}", exc_info=True)
+                continue
+
+            if response.status_code == 403:
+                logger.error(f"Unable to update the metadata of {video_id} ({response.text})")
+                break
+            if not response.ok:
+                logger.error(f"Unable to update the metadata of {video_id}: {response.status_code} {response.text}")
+                continue
+
+            logger.info(f"Updated {', '.join(changed)} of {video_id} (VOD {twitch_vod_id})")
+            updates[twitch_vod_id] = {"snippet": dict(record["snippet"], **changed), "metadata_synced_at": time.time()}
+
+        return updates
@@ -0,0 +1,185 @@
+"""
+Simple metrics (counters, gauges and histograms) that are exposed in the Prometheus text
+format by a small local HTTP server, enabled with "metrics_port" in config.json.
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import logging
+logger = logging.getLogger()
+
+METRIC_PREFIX = "vod_auto_upload_"
+
+# Buckets (in seconds) for anything network related, from a quick status PUT to a 512MiB chunk
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+registry = []
+metrics_server = None
+
+
+def escape_label_value(value) -> str:
+    """Escapes backslashes, double quotes and line feeds, as the text format requires (e.g. Windows folder paths)."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(label_names: tuple, label_values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label_value(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric():
+    metric_type = "untyped"
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()):
+        self.name = METRIC_PREFIX + name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+
+        self.lock = threading.Lock()
+        self.values = {}
+
+        registry.append(self)
+
+    def get_label_values(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render_samples(self) -> list:
+        with self.lock:
+            return [
+                f"{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}"
+                for label_values, value in self.values.items()
+            ]
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        return "\n".join(lines + self.render_samples())
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        label_values = self.get_label_values(labels)
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[self.get_label_values(labels)] = value
+
+    def get(self, **labels) -> float:
+        with self.lock:
+            return self.values.get(self.get_label_values(labels), 0)
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels):
+        label_values = self.get_label_values(labels)
+        with self.lock:
+            # [bucket counts..., sum, count]
+            entry = self.values.setdefault(label_values, [0] * len(self.buckets) + [0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[i] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the duration (in seconds) of the with block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render_samples(self) -> list:
+        lines = []
+        with self.lock:
+            for label_values, entry in self.values.items():
+                for bound, count in zip(self.buckets, entry):
+                    labels = format_labels(self.label_names, label_values, f'le="{format_value(bound)}"')
+                    lines.append(f"{self.name}_bucket{labels} {count}")
+
+                labels = format_labels(self.label_names, label_values)
+                lines.append(f"{self.name}_sum{labels} {format_value(entry[-2])}")
+                lines.append(f"{self.name}_count{labels} {entry[-1]}")
+        return lines
+
+
+def render_metrics() -> str:
+    """Returns every registered metric in the Prometheus text exposition format."""
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+# Upload
+upload_bytes_sent = Counter("upload_bytes_sent_total", "Bytes of video data accepted by YouTube")
+upload_chunk_seconds = Histogram("upload_chunk_put_seconds", "Duration of video data chunk PUT requests")
+upload_throughput = Gauge("upload_throughput_megabytes_per_second", "Upload speed of the most recent chunk (MB/s)")
+upload_retries = Counter("upload_retries_total", "Upload requests that had to be retried, by response status", ("status",))
+uploads_finished = Counter("uploads_finished_total", "Uploads that finished, by result", ("result",))
+videos_processed = Counter("videos_processed_total", "Uploaded videos YouTube finished processing, by result", ("result",))
+
+# Quota
+quota_sleeping = Gauge("quota_sleeping", "1 while uploads are paused until the YouTube API quota resets")
+quota_reset_timestamp = Gauge("quota_reset_timestamp_seconds", "Unix time of the next expected quota reset")
+
+# Queue and scanning
+queue_length = Gauge("queue_length", "Videos waiting to be uploaded")
+queue_finish_timestamp = Gauge("queue_finish_timestamp_seconds", "Estimated Unix time the queued videos will all be uploaded by (see throughput.py)")
+folder_scan_seconds = Histogram("folder_scan_seconds", "Duration of recordings folder scans", buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+stream_live = Gauge("stream_live", "1 while the Twitch channel is live", ("channel",))
+disk_free_bytes = Gauge("disk_free_bytes", "Free space on the disk of a recordings or uploaded folder", ("folder",))
+retention_deleted_bytes = Counter("retention_deleted_bytes_total", "Bytes of uploaded recordings deleted to free disk space")
+twitch_fetch_seconds = Histogram("twitch_fetch_seconds", "Duration of Twitch API requests", ("endpoint",))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return
+
+
+def start_metrics_server(port: int, host: str = "localhost"):
+    """Serves the metrics at http://host:port/metrics from a daemon thread. Returns the server address."""
+    global metrics_server
+
+    metrics_server = HTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=metrics_server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+
+    logger.info(f"Serving metrics at http://{metrics_server.server_address[0]}:{metrics_server.server_address[1]}/metrics")
+    return metrics_server.server_address
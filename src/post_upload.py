@@ -0,0 +1,220 @@
+"""
+The work done after a video finishes uploading (recording it in the upload history, moving the
+file to the uploaded folder, setting the thumbnail) runs in its own worker threads, so the next
+upload can start right away. The thumbnail is set last, so a thumbnail that can't be set never
+keeps the video from being recorded as uploaded and moved.
+
+Jobs are persisted in data/post_upload.json along with the steps they've completed, so a crash
+between the upload finishing and (for example) the thumbnail being set is picked up on restart.
+"""
+
+import os
+import json
+import time
+import queue
+import threading
+
+from config import config
+from state import mark_twitch_vod_as_uploaded, check_vod_uploaded, move_video_to_uploaded_folder
+from state import update_upload_record, write_json_atomic
+from channels import get_vod_channel
+import profiling
+
+import logging
+logger = logging.getLogger()
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__ + "/.."))
+POST_UPLOAD_PATH = ROOT_DIR + "/data/post_upload.json"
+
+STEPS = ("history", "move", "thumbnail")
+
+MAX_ATTEMPTS = 5
+# seconds to wait before retrying a failed step, multiplied by the attempt number
+RETRY_DELAY = 60
+
+
+def create_job(credential_name: str, video_path: str, twitch_vod: dict, response_json: dict, thumbnail_path: str = None, fingerprint: str = None) -> dict:
+    return {
+        "credential": credential_name,
+        "video_path": video_path,
+        "twitch_vod": twitch_vod,
+        "video_id": response_json["id"],
+        # What was set on YouTube, which the metadata resync (see metadata_resync.py) compares with
+        "snippet": {key: response_json["snippet"].get(key) for key in ("title", "description", "tags", "categoryId") if key in response_json["snippet"]},
+        "thumbnail": thumbnail_path,
+        "uploaded_at": time.time(),
+        "file_size": os.path.getsize(video_path) if os.path.isfile(video_path) else None,
+        "fingerprint": fingerprint,
+        "steps_done": [],
+        "attempts": 0
+    }
+
+
+def run_step(step: str, job: dict, credential) -> bool:
+    """Runs one step of a job, returning False if it should be retried later."""
+    from upload import set_video_thumbnail
+
+    if step == "thumbnail":
+        if not job["thumbnail"]:
+            return True
+        if not credential:
+            logger.error(f"The \"{job['credential']}\" YouTube credentials are no longer configured, unable to set the thumbnail of {job['video_id']}")
+            return True
+        return set_video_thumbnail(credential, job["video_id"], job["thumbnail"])
+
+    elif step == "history":
+        update_upload_record(
+            job["twitch_vod"]["id"],
+            video_id=job["video_id"],
+            credential=job["credential"],
+            snippet=job["snippet"],
+            uploaded_at=job["uploaded_at"],
+            file_size=job["file_size"],
+            video_path=job["video_path"],
+            fingerprint=job.get("fingerprint")
+        )
+        if not check_vod_uploaded(job["twitch_vod"]["id"]):
+            mark_twitch_vod_as_uploaded(job["twitch_vod"]["id"])
+        return True
+
+    elif step == "move":
+        if os.path.isfile(job["video_path"]):
+            move_video_to_uploaded_folder(job["video_path"], get_vod_channel(job["twitch_vod"]).folder_to_move_completed_uploads)
+        return True
+
+    raise ValueError(f"Unknown post upload step: {step}")
+
+
+def run_job_steps(job: dict, credential, on_step_done=None) -> bool:
+    """Runs the remaining steps of a job in order. Returns True once every step is done."""
+    for step in STEPS:
+        if step in job["steps_done"]:
+            continue
+
+        try:
+            with profiling.stage("post_upload." + step):
+                done = run_step(step, job, credential)
+        except Exception:
+            logger.error(f"Post upload step \"{step}\" failed for {job['video_id']}", exc_info=True)
+            done = False
+
+        if not done:
+            return False
+
+        job["steps_done"].append(step)
+        if on_step_done:
+            on_step_done(job)
+
+    return True
+
+
+class PostUploadPipeline():
+    """Runs post upload jobs on worker threads, retrying failed steps with a delay."""
+
+    def __init__(self, credential_pool, workers: int = 2, file_path: str = POST_UPLOAD_PATH):
+        self.credential_pool = credential_pool
+        self.file_path = file_path
+        self.lock = threading.Lock()
+
+        # Twitch VOD ID -> job
+        self.jobs = {}
+        self.job_queue = queue.Queue()
+
+        self.load()
+
+        for i in range(workers):
+            threading.Thread(target=self.worker, name=f"post-upload-{i}", daemon=True).start()
+
+        # Jobs from before a restart
+        for twitch_vod_id in list(self.jobs):
+            logger.info(f"Resuming post upload steps for VOD {twitch_vod_id}")
+            self.job_queue.put(twitch_vod_id)
+
+    def load(self):
+        if not os.path.isfile(self.file_path):
+            return
+
+        try:
+            with open(self.file_path, "r", encoding="utf8") as file:
+                self.jobs = json.loads(file.read())
+        except json.decoder.JSONDecodeError:
+            logger.error(f"Unable to read {self.file_path}", exc_info=True)
+
+    def save(self):
+        """Must be called with self.lock held."""
+        write_json_atomic(self.file_path, self.jobs)
+
+    def submit(self, job: dict):
+        twitch_vod_id = job["twitch_vod"]["id"]
+        with self.lock:
+            self.jobs[twitch_vod_id] = job
+            self.save()
+        self.job_queue.put(twitch_vod_id)
+
+    def has_job(self, twitch_vod_id: str) -> bool:
+        with self.lock:
+            return twitch_vod_id in self.jobs
+
+    def has_video(self, video_path: str) -> bool:
+        with self.lock:
+            return any(job["video_path"] == video_path for job in self.jobs.values())
+
+    def __len__(self):
+        with self.lock:
+            return len(self.jobs)
+
+    def on_step_done(self, job: dict):
+        with self.lock:
+            self.save()
+
+    def worker(self):
+        while 1:
+            twitch_vod_id = self.job_queue.get()
+
+            with self.lock:
+                job = self.jobs.get(twitch_vod_id)
+            if not job:
+                continue
+
+            credential = self.credential_pool.get(job["credential"])
+            if run_job_steps(job, credential, self.on_step_done):
+                logger.info(f"Finished post upload steps for {job['video_id']} (VOD {twitch_vod_id})")
+                with self.lock:
+                    self.jobs.pop(twitch_vod_id, None)
+                    self.save()
+                continue
+
+            with self.lock:
+                job["attempts"] += 1
+                self.save()
+
+            if job["attempts"] >= MAX_ATTEMPTS and job["steps_done"] == list(STEPS[:-1]):
+                # Only the thumbnail is left, which isn't worth retrying (and paying for) on every start
+                logger.error(f"Giving up on setting the thumbnail of {job['video_id']} after {job['attempts']} attempts")
+                with self.lock:
+                    self.jobs.pop(twitch_vod_id, None)
+                    self.save()
+                continue
+
+            if job["attempts"] >= MAX_ATTEMPTS:
+                logger.error(f"Giving up on the post upload steps for {job['video_id']} after {job['attempts']} attempts. They'll be retried on the next start")
+                continue
+
+            retry_delay = RETRY_DELAY * job["attempts"]
+            logger.info(f"Retrying the post upload steps for {job['video_id']} in {retry_delay} seconds")
+            timer = threading.Timer(retry_delay, self.job_queue.put, args=(twitch_vod_id,))
+            timer.daemon = True
+            timer.start()
+
+
+post_upload_pipeline = None
+
+
+def get_post_upload_pipeline(credential_pool=None):
+    """Creates the pipeline (starting its workers) the first time it's called with a credential pool."""
+    global post_upload_pipeline
+
+    if post_upload_pipeline is None and credential_pool is not None:
+        post_upload_pipeline = PostUploadPipeline(credential_pool, config["post_upload_workers"])
+
+    return post_upload_pipeline
@@ -0,0 +1,137 @@
+"""
+Follows up on uploaded videos until YouTube has finished processing them.
+
+A finished upload only means YouTube received the file. Processing can still fail (or the video
+can be rejected) hours later. Videos in the upload records without a final processing status are
+looked up with videos.list, up to 50 IDs per call (1 quota unit each), and the results are saved
+in their upload record. Polling backs off while nothing changes.
+"""
+
+import time
+
+import metrics
+from state import get_upload_records, update_upload_records
+
+import logging
+logger = logging.getLogger()
+
+VIDEOS_ENDPOINT = "https://www.googleapis.com/youtube/v3/videos"
+# videos.list accepts up to 50 IDs per call
+BATCH_SIZE = 50
+
+# seconds between polls: starting at the minimum, doubling every poll that changes nothing
+MIN_POLL_INTERVAL = 60
+MAX_POLL_INTERVAL = 60 * 60
+# how often the upload records are checked for new videos when none are processing (no API calls)
+IDLE_POLL_INTERVAL = 10 * 60
+# videos still processing this long after their upload are no longer polled
+MAX_POLL_AGE = 7 * 24 * 60 * 60
+
+FINAL_PROCESSING_STATUSES = ("succeeded", "failed", "terminated")
+FAILED_UPLOAD_STATUSES = ("failed", "rejected", "deleted")
+
+
+def is_pending(record: dict, now: float) -> bool:
+    if not record.get("video_id") or record.get("processing_status") in FINAL_PROCESSING_STATUSES:
+        return False
+    if record.get("upload_status") in FAILED_UPLOAD_STATUSES:
+        return False
+    return now - record.get("uploaded_at", 0) < MAX_POLL_AGE
+
+
+def get_record_update(record: dict, video: dict, now: float) -> dict:
+    """The upload record fields describing a videos.list item's processingDetails and status."""
+    processing = video.get("processingDetails", {})
+    status = video.get("status", {})
+
+    update = {
+        "processing_status": processing.get("processingStatus"),
+        "processing_failure_reason": processing.get("processingFailureReason"),
+        "upload_status": status.get("uploadStatus"),
+        "upload_failure_reason": status.get("failureReason") or status.get("rejectionReason"),
+        "privacy_status": status.get("privacyStatus"),
+        "processing_checked_at": now
+    }
+
+    if update["processing_status"] == "succeeded" and not record.get("processed_at"):
+        update["processed_at"] = now
+
+    return update
+
+
+class ProcessingStatusPoller():
+    def __init__(self, credential_pool):
+        self.credential_pool = credential_pool
+        self.interval = MIN_POLL_INTERVAL
+
+    def fetch_batch(self, credential, video_ids: list) -> dict:
+        """Returns {video ID: videos.list item}. Videos missing from the result were deleted (or never existed)."""
+        response = credential.session.get(VIDEOS_ENDPOINT, params={"part": "processingDetails,status", "id": ",".join(video_ids)})
+        credential.quota_ledger.charge("videos.list")
+        response.raise_for_status()
+        return {item["id"]: item for item in response.json().get("items", [])}
+
+    def poll(self):
+        """Scheduler task: polls the videos that are still processing, returning the seconds until the next poll."""
+        now = time.time()
+        records = get_upload_records()
+        pending = {twitch_vod_id: record for twitch_vod_id, record in records.items() if is_pending(record, now)}
+
+        if not pending:
+            self.interval = MIN_POLL_INTERVAL
+            return IDLE_POLL_INTERVAL
+
+        # Videos can only be looked up with the credentials (channel) that uploaded them
+        by_credential = {}
+        for twitch_vod_id, record in pending.items():
+            by_credential.setdefault(record.get("credential", "default"), []).append(twitch_vod_id)
+
+        updates = {}
+        changed = False
+        for credential_name, twitch_vod_ids in by_credential.items():
+            credential = self.credential_pool.get(credential_name)
+            if not credential or not credential.quota_ledger.can_afford(1):
+                continue
+            if credential.missing_scopes():
+                # videos.list would only get 403s (and still be charged)
+                logger.error(f"Unable to poll the processing status of uploaded videos, the \"{credential_name}\" credentials weren't granted {', '.join(credential.missing_scopes())}")
+                continue
+
+            for i in range(0, len(twitch_vod_ids), BATCH_SIZE):
+                batch = {pending[twitch_vod_id]["video_id"]: twitch_vod_id for twitch_vod_id in twitch_vod_ids[i:i + BATCH_SIZE]}
+                try:
+                    videos = self.fetch_batch(credential, list(batch))
+                except Exception:
+                    logger.error("Unable to fetch the processing status of uploaded videos", exc_info=True)
+                    continue
+
+                for video_id, twitch_vod_id in batch.items():
+                    video = videos.get(video_id, {"status": {"uploadStatus": "deleted"}})
+                    update = get_record_update(pending[twitch_vod_id], video, now)
+
+                    previous = pending[twitch_vod_id]
+                    if (update["processing_status"], update["upload_status"]) != (previous.get("processing_status"), previous.get("upload_status")):
+                        self.log_change(video_id, twitch_vod_id, update)
+                        changed = True
+                    updates[twitch_vod_id] = update
+
+        if updates:
+            update_upload_records(updates)
+
+        self.interval = MIN_POLL_INTERVAL if changed else min(self.interval * 2, MAX_POLL_INTERVAL)
+        return self.interval
+
+    def log_change(self, video_id: str, twitch_vod_id: str, update: dict):
+        if update["processing_status"] == "succeeded":
+            logger.info(f"YouTube finished processing {video_id} (VOD {twitch_vod_id})")
+            metrics.videos_processed.inc(result="succeeded")
+        elif update["processing_status"] in ("failed", "terminated") or update["upload_status"] in FAILED_UPLOAD_STATUSES:
+            reason = update["processing_failure_reason"] or update["upload_failure_reason"] or update["upload_status"]
+            logger.error(f"YouTube processing failed for {video_id} (VOD {twitch_vod_id}): {reason}")
+            metrics.videos_processed.inc(result="failed")
+        else:
+            logger.debug(f"Processing status of {video_id} (VOD {twitch_vod_id}): {update['processing_status']} / {update['upload_status']}")
+
+    def on_upload_finished(self):
+        """Polls from the minimum interval again, since a new video is processing."""
+        self.interval = MIN_POLL_INTERVAL
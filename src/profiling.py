@@ -0,0 +1,265 @@
+"""
+Profiling hooks for the daemon's pipeline stages, enabled with --profile or at runtime through the
+control API (see control.py).
+
+Stages (scan, match, metadata, session_request, chunk_read, chunk_send, sync, post_upload.<step>)
+are wrapped in stage(), which times them while profiling is enabled and costs a flag check when
+it isn't. A capture additionally records cProfile and tracemalloc data for a window of time and
+dumps it to logs/:
+    profile-<time>.prof             cProfile stats (pstats / snakeviz), of the profiled stages' threads
+    profile-<time>.txt              the stage timers and the top functions by cumulative time
+    profile-<time>-memory.txt       the lines that allocated the most memory during the window
+
+Up to Python 3.11 cProfile can only profile the thread it's enabled in, so each thread gets its
+own profiler, which runs while the thread is inside a stage. The stats are combined once every
+stage that was running at the end of the window finishes. From Python 3.12 cProfile is built on
+sys.monitoring, which only allows one profiler per interpreter but sees every thread, so a single
+profiler runs for the whole window instead (covering everything the daemon did, not only its stages).
+"""
+
+import os
+import sys
+import time
+import threading
+from contextlib import nullcontext
+from datetime import datetime
+
+import logging
+logger = logging.getLogger()
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__ + "/.."))
+LOGS_FILE_PATH = ROOT_DIR + "/logs"
+
+# functions listed in the text dump
+TOP_FUNCTIONS = 50
+# allocation sites listed in the memory dump
+TOP_ALLOCATIONS = 50
+TRACEMALLOC_FRAMES = 10
+# one profiler for every thread (sys.monitoring), instead of one per thread
+PROCESS_WIDE_PROFILER = sys.version_info >= (3, 12)
+
+enabled = False
+lock = threading.Lock()
+# stage name -> [runs, total seconds, longest run]
+stage_timers = {}
+
+capture = None
+thread_state = threading.local()
+no_stage = nullcontext()
+
+
+class Capture():
+    def __init__(self, seconds: float):
+        self.started_at = time.time()
+        self.seconds = seconds
+        self.profilers = []
+        # profiled stages still running (their profilers can only be stopped by their own threads)
+        self.active = 0
+        self.ended = False
+        self.dumped = False
+
+
+class Stage():
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.profiler = start_stage_profiler()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        seconds = time.perf_counter() - self.start
+        with lock:
+            timer = stage_timers.setdefault(self.name, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+        stop_stage_profiler(self.profiler)
+
+
+def stage(name: str):
+    """Times a pipeline stage: with profiling.stage("chunk_send"): ..."""
+    return Stage(name) if enabled else no_stage
+
+
+def start_stage_profiler():
+    """
+    Starts profiling the current thread if a capture is running, returning (profiler, capture).
+    Stages nested in a profiled one are profiled by it.
+    """
+    with lock:
+        depth = getattr(thread_state, "depth", 0)
+        if depth:
+            thread_state.depth = depth + 1
+            return None
+        if not capture or capture.ended or PROCESS_WIDE_PROFILER:
+            return None
+
+        if getattr(thread_state, "capture", None) is not capture:
+            import cProfile
+            thread_state.capture = capture
+            thread_state.profiler = cProfile.Profile()
+            capture.profilers.append(thread_state.profiler)
+
+        capture.active += 1
+        thread_state.depth = 1
+        started = (thread_state.profiler, capture)
+
+    try:
+        started[0].enable()
+    except ValueError:
+        # Another profiler is already active (e.g. one started outside of this module)
+        stop_stage_profiler(started)
+        return None
+    return started
+
+
+def stop_stage_profiler(started: tuple):
+    if not started:
+        if getattr(thread_state, "depth", 0):
+            thread_state.depth -= 1
+        return
+
+    profiler, stage_capture = started
+    profiler.disable()
+
+    with lock:
+        thread_state.depth = 0
+        stage_capture.active -= 1
+        should_dump = stage_capture.ended and not stage_capture.active and not stage_capture.dumped
+        stage_capture.dumped = stage_capture.dumped or should_dump
+
+    if should_dump:
+        dump_capture(stage_capture)
+
+
+def enable():
+    global enabled
+    enabled = True
+    logger.info("Profiling enabled")
+
+
+def disable():
+    global enabled
+    enabled = False
+    logger.info("Profiling disabled")
+
+
+def is_enabled() -> bool:
+    return enabled
+
+
+def get_stage_timers() -> dict:
+    """Returns {stage: {"runs", "total_seconds", "mean_seconds", "max_seconds"}}."""
+    with lock:
+        return {
+            name: {"runs": runs, "total_seconds": total, "mean_seconds": total / runs if runs else 0, "max_seconds": longest}
+            for name, (runs, total, longest) in sorted(stage_timers.items())
+        }
+
+
+def reset_stage_timers():
+    with lock:
+        stage_timers.clear()
+
+
+def format_stage_timers() -> str:
+    lines = [f"{'stage':<28}{'runs':>8}{'total (s)':>12}{'mean (ms)':>12}{'max (ms)':>12}"]
+    for name, timer in get_stage_timers().items():
+        lines.append(
+            f"{name:<28}{timer['runs']:>8}{timer['total_seconds']:>12.3f}"
+            f"{timer['mean_seconds'] * 1000:>12.2f}{timer['max_seconds'] * 1000:>12.2f}"
+        )
+    return "\n".join(lines)
+
+
+def start_capture(seconds: float) -> bool:
+    """
+    Enables profiling and records cProfile and tracemalloc data for the given amount of seconds,
+    dumping it to logs/ afterwards. Returns False if a capture is already running.
+    """
+    global capture
+
+    import tracemalloc
+
+    with lock:
+        if capture and not capture.dumped:
+            return False
+        capture = Capture(seconds)
+        current_capture = capture
+
+    enable()
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+
+    if PROCESS_WIDE_PROFILER:
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            current_capture.profilers.append(profiler)
+        except ValueError:
+            logger.error("Unable to start profiling, another profiler is already active")
+
+    timer = threading.Timer(seconds, end_capture, args=(current_capture,))
+    timer.name = "profile-capture"
+    timer.daemon = True
+    timer.start()
+
+    logger.info(f"Capturing a profile for {seconds} seconds")
+    return True
+
+
+def end_capture(ended_capture: Capture = None):
+    """Ends the capture window. The capture is dumped right away, or once the profiled stages still running finish."""
+    ended_capture = ended_capture or capture
+    if not ended_capture:
+        return
+
+    with lock:
+        if ended_capture.ended:
+            return
+        ended_capture.ended = True
+        if PROCESS_WIDE_PROFILER:
+            for profiler in ended_capture.profilers:
+                profiler.disable()
+        should_dump = not ended_capture.active and not ended_capture.dumped
+        ended_capture.dumped = ended_capture.dumped or should_dump
+
+    if should_dump:
+        dump_capture(ended_capture)
+    else:
+        logger.info("The profile will be written once the stages that are running finish")
+
+
+def dump_capture(dumped_capture: Capture):
+    import pstats
+    import tracemalloc
+
+    file_prefix = f"{LOGS_FILE_PATH}/profile-{datetime.fromtimestamp(dumped_capture.started_at).strftime('%Y-%m-%d_%H-%M-%S')}"
+    os.makedirs(LOGS_FILE_PATH, exist_ok=True)
+
+    try:
+        with open(file_prefix + ".txt", "w", encoding="utf8") as file:
+            file.write(f"Stage timers (since profiling was enabled):\n{format_stage_timers()}\n\n")
+
+            profilers = [profiler for profiler in dumped_capture.profilers if profiler.getstats()]
+            if profilers:
+                stats = pstats.Stats(*profilers, stream=file)
+                stats.dump_stats(file_prefix + ".prof")
+                stats.sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+            else:
+                file.write("No stages ran during the capture\n")
+
+        if tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            with open(file_prefix + "-memory.txt", "w", encoding="utf8") as file:
+                for statistic in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+                    file.write(f"{statistic}\n")
+
+        logger.info(f"Wrote the profile to {file_prefix}.*")
+    except Exception:
+        logger.error("Unable to write the profile", exc_info=True)
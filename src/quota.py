@@ -0,0 +1,175 @@
+"""
+Keeps track of how much YouTube Data API quota has been used today (data/quota.json),
+so uploads are only started when there's enough quota left for them to complete,
+instead of finding out through a 403 response.
+"""
+
+import os
+import json
+import threading
+from datetime import datetime, timedelta
+import pytz
+
+from config import config
+from state import write_json_atomic
+
+import logging
+logger = logging.getLogger()
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__ + "/.."))
+QUOTA_FILE_PATH = ROOT_DIR + "/data/quota.json"
+
+# Google APIs reset quota at midnight PT
+pacific_tz = pytz.timezone("America/Los_Angeles")
+
+# Quota units charged per call (https://developers.google.com/youtube/v3/determine_quota_cost)
+QUOTA_COSTS = {
+    "videos.insert": 1600,
+    "thumbnails.set": 50,
+    "videos.list": 1,
+    "videos.update": 50,
+}
+
+# credential name -> QuotaLedger
+quota_ledgers = {}
+
+
+def get_quota_day(dt: datetime = None) -> str:
+    """The date (in Pacific Time) that quota usage at the given time counts towards."""
+    dt = dt if dt else datetime.now(pytz.utc)
+    return dt.astimezone(pacific_tz).strftime("%Y-%m-%d")
+
+
+def get_time_until_quota_reset() -> timedelta:
+    """Calculates the amount of time until midnight Pacific Time (+10 minutes to be safe)"""
+
+    dt = datetime.now(pytz.utc).astimezone(pacific_tz)
+    next_day = (dt + timedelta(days=1)).replace(hour=0, minute=10, second=0, microsecond=0, tzinfo=None)
+    quota_reset = pacific_tz.localize(next_day)
+
+    return quota_reset - dt
+
+
+def get_upload_cost(has_thumbnail: bool = False) -> int:
+    """Quota units needed to upload a video (and set its thumbnail)."""
+    return QUOTA_COSTS["videos.insert"] + (QUOTA_COSTS["thumbnails.set"] if has_thumbnail else 0)
+
+
+class QuotaLedger():
+    """Charges API calls against the daily quota, persisting usage across restarts."""
+
+    def __init__(self, file_path: str = QUOTA_FILE_PATH, daily_limit: int = 10_000):
+        self.file_path = file_path
+        self.daily_limit = daily_limit
+        self.lock = threading.Lock()
+
+        self.quota_day = get_quota_day()
+        self.used = 0
+        self.exhausted = False
+        self.calls = {}
+
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.file_path):
+            return
+
+        try:
+            with open(self.file_path, "r", encoding="utf8") as file:
+                contents = json.loads(file.read())
+        except json.decoder.JSONDecodeError:
+            logger.error(f"Unable to read {self.file_path}, starting with no quota used", exc_info=True)
+            return
+
+        if contents.get("quota_day") == self.quota_day:
+            self.used = contents.get("used", 0)
+            self.exhausted = contents.get("exhausted", False)
+            self.calls = contents.get("calls", {})
+
+    def save(self):
+        write_json_atomic(self.file_path, {
+            "quota_day": self.quota_day,
+            "used": self.used,
+            "exhausted": self.exhausted,
+            "calls": self.calls
+        })
+
+    def roll_over(self):
+        """Resets usage once the Pacific Time date changes. Must be called with self.lock held."""
+        today = get_quota_day()
+        if today != self.quota_day:
+            logger.info(f"YouTube API quota reset ({self.used} units were used on {self.quota_day})")
+            self.quota_day = today
+            self.used = 0
+            self.exhausted = False
+            self.calls = {}
+            self.save()
+
+    def charge(self, operation: str, count: int = 1):
+        """Records count calls of an operation (a key of QUOTA_COSTS)."""
+        with self.lock:
+            self.roll_over()
+            self.used += QUOTA_COSTS[operation] * count
+            self.calls[operation] = self.calls.get(operation, 0) + count
+            self.save()
+
+        logger.debug(f"Charged {QUOTA_COSTS[operation] * count} quota units for {operation} ({self.used}/{self.daily_limit} used)")
+
+    def mark_exhausted(self):
+        """Called when YouTube reports that the quota ran out anyway (e.g. usage from outside this bot)."""
+        with self.lock:
+            self.roll_over()
+            self.exhausted = True
+            self.save()
+
+    def remaining(self) -> int:
+        with self.lock:
+            self.roll_over()
+            return 0 if self.exhausted else max(self.daily_limit - self.used, 0)
+
+    def used_by(self, operation: str) -> int:
+        """The quota units the calls of an operation used today."""
+        with self.lock:
+            self.roll_over()
+            return self.calls.get(operation, 0) * QUOTA_COSTS[operation]
+
+    def can_afford(self, units: int) -> bool:
+        return self.remaining() >= units
+
+    def plan_uploads(self, costs: list) -> tuple:
+        """
+        Given the quota cost of each upload (in queue order), returns the indexes of the uploads that
+        fit in today's remaining quota and the indexes of those that have to wait for the next reset.
+        """
+        budget = self.remaining()
+        planned, deferred = [], []
+
+        for i, cost in enumerate(costs):
+            if cost <= budget:
+                planned.append(i)
+                budget -= cost
+            else:
+                deferred.append(i)
+
+        return planned, deferred
+
+
+def get_quota_file_path(credential_name: str) -> str:
+    if credential_name == "default":
+        return QUOTA_FILE_PATH
+    return ROOT_DIR + f"/data/quota_{credential_name}.json"
+
+
+def get_configured_ledgers() -> list:
+    """The quota ledgers of the default YouTube credentials and every entry of youtube_credentials."""
+    names = ["default"] + [entry["name"] for entry in config["youtube_credentials"]]
+    return [get_quota_ledger(name) for name in names]
+
+
+def get_quota_ledger(credential_name: str = "default") -> QuotaLedger:
+    """Every YouTube credential (Google API project) has its own daily quota."""
+
+    if credential_name not in quota_ledgers:
+        quota_ledgers[credential_name] = QuotaLedger(get_quota_file_path(credential_name), config["youtube_daily_quota"])
+
+    return quota_ledgers[credential_name]
@@ -49,7 +49,8 @@ class MyHandler(BaseHTTPRequestHandler):
 
 
 def start_server():
-    global my_server
+    global my_server, server_should_stop
+    server_should_stop = False
     my_server = HTTPServer((host_name, host_port), MyHandler)
     return my_server.server_address
 
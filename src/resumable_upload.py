@@ -9,6 +9,10 @@ import os
 import random
 import json
 
+import metrics
+from bandwidth import ThrottledBody
+import profiling
+
 import logging
 logger = logging.getLogger()
 
@@ -22,14 +26,26 @@ class ResumableUpload():
     class ExceededQuota(Exception):
         pass
 
-    def __init__(self, video_metadata: dict, file_handle, chunk_size=None, session=requests.Session(), upload_url: str = None):
+    class Interrupted(Exception):
+        """Raised between chunks once should_stop returns True (e.g. on SIGTERM)."""
+        pass
+
+    def __init__(self, video_metadata: dict, file_handle, chunk_size=None, session=None, upload_url: str = None,
+                 uploaded_bytes: int = None, checkpoint_callback=None, should_stop=None, bandwidth_budget=None):
+        """
+        uploaded_bytes: the offset YouTube confirmed for upload_url (from a checkpoint or a status request
+        made beforehand), which saves the status request upload() would otherwise start with
+        checkpoint_callback: called with the confirmed offset after every chunk
+        should_stop: checked before every chunk, ResumableUpload.Interrupted is raised when it returns True
+        bandwidth_budget: a BandwidthBudget (see bandwidth.py) chunks are sent within, when it has a limit
+        """
         self.video_metadata = video_metadata
         self.file_handle = file_handle
 
         self.max_retries = 4
         self.retries = 0
 
-        self.session = session
+        self.session = session if session else requests.Session()
 
         self.file_size = os.path.getsize(self.file_handle.name)
 
@@ -43,7 +59,12 @@ class ResumableUpload():
         self.success_statuses = (200, 201)
         self.retry_statuses = (500, 502, 503, 504)
 
-        self.uploaded_bytes = 0
+        self.uploaded_bytes = uploaded_bytes if uploaded_bytes is not None else 0
+        self.offset_known = uploaded_bytes is not None and upload_url is not None
+
+        self.checkpoint_callback = checkpoint_callback
+        self.should_stop = should_stop
+        self.bandwidth_budget = bandwidth_budget
 
     def request_upload_url(self):
         """
@@ -63,12 +84,13 @@ class ResumableUpload():
 
         for i in range(self.max_retries):
             try:
-                r = self.session.post(
-                    "https://www.googleapis.com/upload/youtube/v3/videos",
-                    data=json.dumps(self.video_metadata),
-                    params=params,
-                    headers=headers
-                )
+                with profiling.stage("session_request"):
+                    r = self.session.post(
+                        "https://www.googleapis.com/upload/youtube/v3/videos",
+                        data=json.dumps(self.video_metadata),
+                        params=params,
+                        headers=headers
+                    )
 
                 if r.status_code == 200 and "Location" in r.headers:
                     upload_url = r.headers["Location"]
@@ -83,6 +105,7 @@ class ResumableUpload():
                 elif r.status_code == 403:
                     raise ResumableUpload.ExceededQuota("Exceeded quota")
                 else:
+                    metrics.upload_retries.inc(status=r.status_code)
                     logger.error(f"Server responded unsuccessfully ({r.status_code}) while requesting upload url. Retrying...")
                     try:
                         error_message = r.json()["error"]["errors"][0]["message"]
@@ -107,7 +130,7 @@ class ResumableUpload():
         headers = {"Content-Length": "0", "Content-Range": f"bytes */{self.file_size}"}
         for i in range(self.max_retries):
             try:
-                with self.session.put(self.upload_url, headers=headers) as response:
+                with profiling.stage("sync"), self.session.put(self.upload_url, headers=headers) as response:
                     return response
             except Exception:
                 sleep_seconds = self.get_next_retry_sleep()
@@ -156,10 +179,14 @@ class ResumableUpload():
         is uploaded, raising any errors and synchronizing with the server as needed.
         """
 
-        upload_status = self.get_upload_status()
-        self.sync_with_upload_status(upload_status)
+        if self.offset_known:
+            logger.info(f"Resuming the upload at {self.uploaded_bytes} bytes")
+            upload_status = None
+        else:
+            upload_status = self.get_upload_status()
+            self.sync_with_upload_status(upload_status)
 
-        if upload_status.status_code in self.success_statuses:
+        if upload_status is not None and upload_status.status_code in self.success_statuses:
             logger.info("The file has already been uploaded")
             return upload_status
         else:
@@ -177,13 +204,16 @@ class ResumableUpload():
                         time.sleep(20)
 
                 if status == 308:
-                    logger.info(f"Server is ready for next chunk ({status}). Uploading...")
+                    logger.debug(f"Server is ready for next chunk ({status}). Uploaded bytes: {self.uploaded_bytes}")
                     self.sync_with_upload_status(response)
+                    if self.checkpoint_callback:
+                        self.checkpoint_callback(self.uploaded_bytes)
 
                 elif status in self.success_statuses:
                     logger.info("The file was successfully uploaded")
                     return response
                 elif status in self.retry_statuses:
+                    metrics.upload_retries.inc(status=status)
                     sleep_seconds = self.get_next_retry_sleep()
                     logger.warning(f"The server responded with a {status}. Retrying in {sleep_seconds:.2f} seconds...")
 
@@ -200,16 +230,24 @@ class ResumableUpload():
         """Uploads chunks of the file (size according to self.chunk_size) to self.upload_url"""
         self.file_handle.seek(self.uploaded_bytes)
         while self.uploaded_bytes < self.file_size:
-            chunk = self.file_handle.read(self.chunk_size)
+            if self.should_stop and self.should_stop():
+                raise ResumableUpload.Interrupted(f"Upload stopped at {self.uploaded_bytes} bytes")
+
+            with profiling.stage("chunk_read"):
+                chunk = self.file_handle.read(self.chunk_size)
             chunk_len = len(chunk)
-            logger.debug(f"Position in file: {self.file_handle.tell()}, Uploaded bytes: {self.uploaded_bytes}")
             if chunk:
                 headers = {
                     "Content-Length": str(chunk_len),
                     "Content-Type": "video/*"
                 }
 
-                req = requests.Request("PUT", self.upload_url, data=chunk, headers=headers)
+                body = chunk
+                if self.bandwidth_budget and self.bandwidth_budget.is_limited():
+                    body = ThrottledBody(chunk, self.bandwidth_budget)
+
+                req = requests.Request("PUT", self.upload_url, data=body, headers=headers)
+                del body
                 del chunk
                 prepped = self.session.prepare_request(req)
 
@@ -217,15 +255,24 @@ class ResumableUpload():
                 prepped.headers["Content-Range"] = f"bytes {self.uploaded_bytes}-{(self.uploaded_bytes + chunk_len) - 1}/{self.file_size}"
 
                 try:
-                    response = self.session.send(prepped)
+                    send_start = time.perf_counter()
+                    with profiling.stage("chunk_send"):
+                        response = self.session.send(prepped)
                     response.request.body = None
 
+                    send_seconds = time.perf_counter() - send_start
+                    metrics.upload_chunk_seconds.observe(send_seconds)
+                    if response.status_code == 308 or response.status_code in self.success_statuses:
+                        metrics.upload_bytes_sent.inc(chunk_len)
+                        metrics.upload_throughput.set(chunk_len / send_seconds / 1_000_000 if send_seconds else 0)
+
                     yield response.status_code, response
 
                     if response.status_code in self.success_statuses:
                         break
 
                 except Exception:
+                    metrics.upload_retries.inc(status="error")
                     sleep_seconds = self.get_next_retry_sleep()
                     logger.error(f"There was an error while uploading video data. Retrying in {sleep_seconds} seconds...")
                     logger.debug("Upload Video Data Error:", exc_info=True)
@@ -0,0 +1,150 @@
+"""
+Keeps free space on the disks of the recordings and uploaded folders, so a full disk never stops
+a recording. Enabled with "retention_min_free_gb" in config.json.
+
+When a disk has less than retention_min_free_gb free, the uploaded recordings in the uploaded
+folders on it are deleted, oldest first, until retention_target_free_gb is free. A recording is
+only deleted once it's verified against its upload record: its fingerprint (see fingerprint.py)
+has to match the uploaded file's (or its size, for uploads from before fingerprints were recorded),
+and YouTube has to have finished processing the video (retention_require_processed). The newest
+retention_keep_last recordings of every uploaded folder are always kept.
+
+While a recordings folder's disk is low on space, its videos are moved ahead in the upload queue
+(the "pressure" scorer in upload_queue.py), so they're moved off the disk sooner.
+"""
+
+import os
+import time
+import shutil
+
+import metrics
+import upload_queue
+from config import config
+from state import get_upload_records, update_upload_record
+from fingerprint import fingerprint_files
+
+import logging
+logger = logging.getLogger()
+
+GB = 1_000_000_000
+
+
+def get_device(folder: str):
+    try:
+        return os.stat(folder).st_dev
+    except OSError:
+        return None
+
+
+class RetentionManager():
+    def __init__(self, channels: list, scheduler=None):
+        self.channels = channels
+        self.scheduler = scheduler
+        self.min_free = config["retention_min_free_gb"] * GB
+        self.target_free = max(config["retention_target_free_gb"] * GB, self.min_free)
+
+    def check(self):
+        """Scheduler task: frees space on the disks that are running out of it."""
+        watch_folders = {channel.folder_to_watch for channel in self.channels}
+        uploaded_folders = {channel.folder_to_move_completed_uploads for channel in self.channels}
+
+        # device -> folders on it
+        devices = {}
+        for folder in watch_folders | uploaded_folders:
+            device = get_device(folder)
+            if device is not None:
+                devices.setdefault(device, []).append(folder)
+
+        pressured_folders = set()
+        for folders in devices.values():
+            free = shutil.disk_usage(folders[0]).free
+            for folder in folders:
+                metrics.disk_free_bytes.set(free, folder=folder)
+
+            if free >= self.min_free:
+                continue
+
+            logger.warning(f"Only {free / GB:.1f} GB free on the disk of {', '.join(sorted(folders))}")
+            free = self.free_space(sorted(folder for folder in folders if folder in uploaded_folders), free)
+
+            if free < self.min_free:
+                pressured_folders.update(folder for folder in folders if folder in watch_folders)
+
+        self.set_pressured_folders(pressured_folders)
+
+    def set_pressured_folders(self, pressured_folders: set):
+        if pressured_folders == upload_queue.pressured_folders:
+            return
+
+        if pressured_folders - upload_queue.pressured_folders:
+            logger.warning(f"Uploading the videos in {', '.join(sorted(pressured_folders))} first, their disk is low on space")
+        upload_queue.pressured_folders.clear()
+        upload_queue.pressured_folders.update(pressured_folders)
+
+        if self.scheduler:
+            self.scheduler.trigger("upload")
+
+    def get_candidates(self, uploaded_folders: list) -> list:
+        """Returns the (modified time, path, Twitch VOD ID, upload record) of the deletable recordings, oldest first."""
+        records = {
+            os.path.basename(record["video_path"]): (twitch_vod_id, record)
+            for twitch_vod_id, record in get_upload_records().items()
+            if record.get("video_path") and not record.get("deleted_at")
+        }
+
+        candidates = []
+        for folder in uploaded_folders:
+            files = []
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_file() and entry.name in records:
+                        files.append((entry.stat().st_mtime, entry.path) + records[entry.name])
+
+            files.sort()
+            keep_last = config["retention_keep_last"]
+            candidates += files[:-keep_last] if keep_last > 0 else files
+
+        return sorted(candidates, key=lambda candidate: candidate[:2])
+
+    def is_verified(self, path: str, record: dict, fingerprint: str) -> bool:
+        """Whether the file is the one that was uploaded (and processed, if required)."""
+        if config["retention_require_processed"] and record.get("processing_status") != "succeeded":
+            return False
+
+        if record.get("fingerprint"):
+            return fingerprint == record["fingerprint"]
+        return record.get("file_size") is not None and os.path.getsize(path) == record["file_size"]
+
+    def free_space(self, uploaded_folders: list, free: int) -> int:
+        """Deletes verified recordings from the uploaded folders, oldest first, until target_free is free. Returns the free space."""
+        candidates = self.get_candidates(uploaded_folders)
+        if not candidates:
+            return free
+
+        fingerprints = fingerprint_files([path for _, path, _, record in candidates if record.get("fingerprint")])
+
+        for _, path, twitch_vod_id, record in candidates:
+            if free >= self.target_free:
+                break
+
+            if not self.is_verified(path, record, fingerprints.get(path)):
+                logger.debug(f"Keeping {path}, it couldn't be verified against the upload of VOD {twitch_vod_id}")
+                continue
+
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except OSError:
+                logger.error(f"Unable to delete {path}", exc_info=True)
+                continue
+
+            logger.info(f"Deleted {path} ({size / GB:.1f} GB, uploaded as {record.get('video_id')}) to free disk space")
+            metrics.retention_deleted_bytes.inc(size)
+            update_upload_record(twitch_vod_id, deleted_at=time.time())
+
+            free = shutil.disk_usage(uploaded_folders[0]).free
+
+        if free < self.min_free:
+            logger.warning(f"Still only {free / GB:.1f} GB free after deleting the verified uploaded recordings")
+
+        return free
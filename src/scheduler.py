@@ -0,0 +1,130 @@
+"""
+A small scheduler for the daemon's independent jobs (scanning, refreshing Twitch VODs, uploading, ...).
+
+Every task has its own cadence and runs in its own thread, so a task that blocks (like a
+multi hour upload) only holds up itself. Tasks can also be triggered by events, for example
+a finished scan waking up the upload task right away.
+"""
+
+import time
+import threading
+
+import logging
+logger = logging.getLogger()
+
+
+class ScheduledTask():
+    def __init__(self, name: str, func, interval: float = None, delay: float = 0):
+        self.name = name
+        self.func = func
+        # seconds between runs, or None if the task only runs when triggered
+        self.interval = interval
+
+        self.next_run = time.monotonic() + delay if delay is not None else None
+        self.running = False
+        # when the task was triggered to run while it was running (the earliest of those times), so it
+        # runs again then (or right after the current run), unless its next run is earlier anyway
+        self.pending_run = None
+
+        self.last_started = None
+        self.last_duration = None
+        self.thread = None
+
+
+class Scheduler():
+    def __init__(self):
+        self.tasks = {}
+        self.condition = threading.Condition()
+        self.should_stop = False
+
+    def add_task(self, name: str, func, interval: float = None, delay: float = 0):
+        """
+        Adds a task that first runs after delay seconds (never, if delay is None, until triggered),
+        then every interval seconds. If func returns a number, it's used as the amount of seconds
+        until the next run instead of interval.
+        """
+        with self.condition:
+            self.tasks[name] = ScheduledTask(name, func, interval, delay)
+            self.condition.notify()
+
+    def trigger(self, name: str, delay: float = 0):
+        """Makes a task run within delay seconds (or right after its current run ends, if that is later)."""
+        with self.condition:
+            task = self.tasks[name]
+            run_at = time.monotonic() + delay
+
+            if task.running:
+                task.pending_run = run_at if task.pending_run is None else min(task.pending_run, run_at)
+            elif task.next_run is None or run_at < task.next_run:
+                task.next_run = run_at
+
+            self.condition.notify()
+
+    def is_running(self, name: str) -> bool:
+        with self.condition:
+            return self.tasks[name].running
+
+    def run_task(self, task: ScheduledTask):
+        delay = None
+        try:
+            delay = task.func()
+        except Exception:
+            logger.error(f"Scheduled task \"{task.name}\" failed", exc_info=True)
+
+        with self.condition:
+            now = time.monotonic()
+            task.running = False
+            task.last_duration = now - task.last_started
+
+            if isinstance(delay, (int, float)) and not isinstance(delay, bool):
+                task.next_run = now + delay
+            elif task.interval is not None:
+                task.next_run = now + task.interval
+            else:
+                task.next_run = None
+
+            if task.pending_run is not None:
+                task.next_run = task.pending_run if task.next_run is None else min(task.next_run, task.pending_run)
+                task.pending_run = None
+
+            self.condition.notify()
+
+    def start_task(self, task: ScheduledTask):
+        """Must be called with self.condition held."""
+        task.running = True
+        task.next_run = None
+        task.last_started = time.monotonic()
+        task.thread = threading.Thread(target=self.run_task, args=(task,), name=f"task-{task.name}", daemon=True)
+        task.thread.start()
+
+    def run(self):
+        """Runs the tasks until stop() is called."""
+        with self.condition:
+            while not self.should_stop:
+                now = time.monotonic()
+
+                for task in self.tasks.values():
+                    if not task.running and task.next_run is not None and task.next_run <= now:
+                        logger.debug(f"Running scheduled task: {task.name}")
+                        self.start_task(task)
+
+                upcoming = [task.next_run for task in self.tasks.values() if not task.running and task.next_run is not None]
+                self.condition.wait(max(min(upcoming) - now, 0) if upcoming else None)
+
+    def stop(self):
+        """Stops starting tasks. Tasks that are running carry on, see wait_for_tasks()."""
+        with self.condition:
+            self.should_stop = True
+            self.condition.notify()
+
+    def wait_for_tasks(self, timeout: float) -> list:
+        """Waits up to timeout seconds for the running tasks to finish, returning the names of those that didn't."""
+        deadline = time.monotonic() + timeout
+
+        with self.condition:
+            running = [task for task in self.tasks.values() if task.running]
+
+        for task in running:
+            task.thread.join(max(deadline - time.monotonic(), 0))
+
+        return [task.name for task in running if task.thread.is_alive()]
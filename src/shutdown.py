@@ -0,0 +1,53 @@
+"""
+Graceful shutdown on SIGTERM (e.g. systemctl stop) and SIGINT.
+
+The first signal stops new work from being started: the scheduler stops, and the upload stops
+after the chunk it's sending, checkpointing the offset YouTube confirmed in state.json so the
+next start resumes right where it left off. A second signal exits immediately.
+"""
+
+import os
+import signal
+import threading
+
+import logging
+logger = logging.getLogger()
+
+shutdown_event = threading.Event()
+shutdown_callbacks = []
+
+
+def is_shutting_down() -> bool:
+    return shutdown_event.is_set()
+
+
+def on_shutdown(callback):
+    """Registers a function to call (from the main thread) when a shutdown is requested."""
+    shutdown_callbacks.append(callback)
+
+
+def request_shutdown():
+    if shutdown_event.is_set():
+        return
+
+    shutdown_event.set()
+    for callback in shutdown_callbacks:
+        try:
+            callback()
+        except Exception:
+            logger.error("Error while shutting down", exc_info=True)
+
+
+def signal_handler(signum, frame):
+    if shutdown_event.is_set():
+        logger.warning(f"Received {signal.Signals(signum).name} again, exiting immediately")
+        os._exit(1)
+
+    logger.info(f"Received {signal.Signals(signum).name}, shutting down once the current upload chunk is sent (send it again to exit immediately)")
+    request_shutdown()
+
+
+def install_signal_handlers():
+    """Must be called from the main thread."""
+    signal.signal(signal.SIGTERM, signal_handler)
+    signal.signal(signal.SIGINT, signal_handler)
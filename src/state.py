@@ -5,8 +5,11 @@ have been uploaded in the past.
 
 import os
 import json
+import tempfile
+import threading
 
 from config import config
+from file_mover import move_file_in_background
 
 import logging
 logger = logging.getLogger()
@@ -14,12 +17,40 @@ logger = logging.getLogger()
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__ + "/.."))
 STATE_FILE_PATH = ROOT_DIR + "/data/state.json"
 UPLOAD_HISTORY_PATH = ROOT_DIR + "/data/upload_history.txt"
+UPLOAD_RECORDS_PATH = ROOT_DIR + "/data/upload_records.json"
+THROUGHPUT_SAMPLES_PATH = ROOT_DIR + "/data/throughput_samples.json"
+
+upload_records_lock = threading.Lock()
+throughput_samples_lock = threading.Lock()
+
+# (upload_history.txt's (mtime, size) when it was read, the VOD IDs in it)
+uploaded_vod_ids_cache = (None, frozenset())
+
+
+def write_json_atomic(path: str, data, indent=4):
+    """
+    Writes data as JSON to a temporary file next to path, then renames it over path,
+    so a crash mid-write never leaves a truncated file behind.
+    """
+
+    directory = os.path.dirname(path)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix="." + os.path.basename(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf8") as file:
+            file.write(json.dumps(data, indent=indent))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
 
 
 def check_in_progress_uploads():
     """
     Checks to see if there were any interrupted uploads in state.json,
-    and uploads them if so.
+    and yields the ones whose video file still exists (see upload_sessions.py).
     """
 
     if os.path.isfile(STATE_FILE_PATH):
@@ -31,7 +62,7 @@ def check_in_progress_uploads():
                 file_path = entry["video_path"]
                 if os.path.isfile(file_path):
                     logger.info(f"Resuming incomplete upload: {twitch_video_id} ({file_path})")
-                    yield file_path, entry["twitch_vod"], entry["upload_url"]
+                    yield file_path, entry["twitch_vod"], entry["upload_url"], entry.get("credential", "default")
                 else:
                     logger.error(f"File in incomplete upload no longer exists: {twitch_video_id} ({file_path})")
 
@@ -71,23 +102,36 @@ def mark_twitch_vod_as_uploaded(twitch_vod_id: str):
             file.write(twitch_vod_id + "\n")
 
 
-def check_vod_uploaded(twitch_vod_id: str) -> bool:
-    """Checks upload_history.txt for a given Twitch ID"""
+def get_uploaded_vod_ids() -> frozenset:
+    """
+    Returns the Twitch VOD IDs in upload_history.txt. The file is only read again when it
+    changed, so checking every video of a scan costs one stat instead of one read each.
+    """
+    global uploaded_vod_ids_cache
 
-    if os.path.isfile(UPLOAD_HISTORY_PATH):
+    try:
+        stat = os.stat(UPLOAD_HISTORY_PATH)
+    except FileNotFoundError:
+        return frozenset()
+
+    key = (stat.st_mtime_ns, stat.st_size)
+    if uploaded_vod_ids_cache[0] != key:
         with open(UPLOAD_HISTORY_PATH, "r") as file:
-            for vod_id in file:
-                vod_id = vod_id.strip()
-                if vod_id == twitch_vod_id:
-                    return True
+            uploaded_vod_ids_cache = (key, frozenset(vod_id.strip() for vod_id in file if vod_id.strip()))
+
+    return uploaded_vod_ids_cache[1]
 
-    return False
 
+def check_vod_uploaded(twitch_vod_id: str) -> bool:
+    """Checks upload_history.txt for a given Twitch ID"""
+    return twitch_vod_id in get_uploaded_vod_ids()
 
-def save_in_progress_upload(upload_url: str, video_path: str, twitch_vod: dict):
+
+def save_in_progress_upload(upload_url: str, video_path: str, twitch_vod: dict, credential_name: str = "default", fingerprint: str = None):
     """
     Creates an entry in state.json with a given video's
-    upload url, file path, and Twitch VOD information, so that an
+    upload url, file path, Twitch VOD information, the name of the YouTube
+    credentials the upload url belongs to, and the video's fingerprint, so that an
     interrupted upload can be resumed at a later date.
     """
 
@@ -96,7 +140,9 @@ def save_in_progress_upload(upload_url: str, video_path: str, twitch_vod: dict):
         contents[twitch_vod["id"]] = {
             "upload_url": upload_url,
             "video_path": video_path,
-            "twitch_vod": twitch_vod
+            "twitch_vod": twitch_vod,
+            "credential": credential_name,
+            "fingerprint": fingerprint
         }
 
         file.write(json.dumps(contents, indent=4))
@@ -105,13 +151,20 @@ def save_in_progress_upload(upload_url: str, video_path: str, twitch_vod: dict):
         with open(STATE_FILE_PATH, "r+", encoding="utf8") as file:
             try:
                 contents = json.loads(file.read())
+                previous = contents.get(twitch_vod["id"], {})
 
                 contents[twitch_vod["id"]] = {
                     "upload_url": upload_url,
                     "video_path": video_path,
-                    "twitch_vod": twitch_vod
+                    "twitch_vod": twitch_vod,
+                    "credential": credential_name,
+                    "fingerprint": fingerprint
                 }
 
+                # Keep the checkpoint when the same session is resumed
+                if previous.get("upload_url") == upload_url and "uploaded_bytes" in previous:
+                    contents[twitch_vod["id"]]["uploaded_bytes"] = previous["uploaded_bytes"]
+
                 file.truncate(0)
                 file.seek(0)
 
@@ -126,8 +179,113 @@ def save_in_progress_upload(upload_url: str, video_path: str, twitch_vod: dict):
             create_json_structure(file)
 
 
-def move_video_to_uploaded_folder(video_path):
-    os.rename(video_path, config["folder_to_move_completed_uploads"] + "/" + os.path.basename(video_path))
+def get_in_progress_upload(twitch_vod_id: str) -> dict:
+    """Returns a Twitch VOD's entry in state.json, or an empty dict."""
+
+    if os.path.isfile(STATE_FILE_PATH):
+        with open(STATE_FILE_PATH, "r", encoding="utf8") as file:
+            try:
+                return json.loads(file.read()).get(twitch_vod_id, {})
+            except json.decoder.JSONDecodeError:
+                logger.error(f"Unable to read {STATE_FILE_PATH}", exc_info=True)
+
+    return {}
+
+
+def checkpoint_in_progress_upload(twitch_vod_id: str, uploaded_bytes: int):
+    """Saves the amount of bytes YouTube confirmed receiving for an upload in state.json"""
+
+    if not os.path.isfile(STATE_FILE_PATH):
+        return
+
+    with open(STATE_FILE_PATH, "r", encoding="utf8") as file:
+        try:
+            contents = json.loads(file.read())
+        except json.decoder.JSONDecodeError:
+            return
+
+    if twitch_vod_id in contents:
+        contents[twitch_vod_id]["uploaded_bytes"] = uploaded_bytes
+        write_json_atomic(STATE_FILE_PATH, contents)
+
+
+def get_upload_records() -> dict:
+    """
+    Returns the details saved about each uploaded video (upload_records.json), keyed by Twitch VOD ID.
+    upload_history.txt stays the list of uploaded VOD IDs, this has everything else (YouTube ID, metadata, ...).
+    """
+
+    if os.path.isfile(UPLOAD_RECORDS_PATH):
+        with open(UPLOAD_RECORDS_PATH, "r", encoding="utf8") as file:
+            try:
+                return json.loads(file.read())
+            except json.decoder.JSONDecodeError:
+                logger.error(f"Unable to read {UPLOAD_RECORDS_PATH}", exc_info=True)
+
+    return {}
+
+
+def update_upload_record(twitch_vod_id: str, **fields):
+    """Adds (or updates) fields of a Twitch VOD's entry in upload_records.json"""
+
+    with upload_records_lock:
+        records = get_upload_records()
+        records.setdefault(twitch_vod_id, {}).update(fields)
+        write_json_atomic(UPLOAD_RECORDS_PATH, records)
+
+
+def update_upload_records(updates: dict):
+    """Like update_upload_record, for many Twitch VODs at once: {twitch_vod_id: fields}"""
+
+    with upload_records_lock:
+        records = get_upload_records()
+        for twitch_vod_id, fields in updates.items():
+            records.setdefault(twitch_vod_id, {}).update(fields)
+        write_json_atomic(UPLOAD_RECORDS_PATH, records)
+
+
+def get_throughput_samples() -> list:
+    """Returns the throughput samples of past uploads (throughput_samples.json), oldest first. See throughput.py."""
+
+    if os.path.isfile(THROUGHPUT_SAMPLES_PATH):
+        with open(THROUGHPUT_SAMPLES_PATH, "r", encoding="utf8") as file:
+            try:
+                return json.loads(file.read())
+            except json.decoder.JSONDecodeError:
+                logger.error(f"Unable to read {THROUGHPUT_SAMPLES_PATH}", exc_info=True)
+
+    return []
+
+
+def add_throughput_samples(samples: list, limit: int):
+    """Appends throughput samples to throughput_samples.json, keeping the newest limit of them."""
+
+    with throughput_samples_lock:
+        write_json_atomic(THROUGHPUT_SAMPLES_PATH, (get_throughput_samples() + samples)[-limit:], indent=None)
+
+
+def get_fingerprint_index() -> dict:
+    """Returns {fingerprint: Twitch VOD ID} for the uploaded videos whose fingerprint was recorded (see fingerprint.py)."""
+    return {
+        record["fingerprint"]: twitch_vod_id
+        for twitch_vod_id, record in get_upload_records().items() if record.get("fingerprint")
+    }
+
+
+def find_uploaded_fingerprint(fingerprint: str):
+    """Returns the Twitch VOD ID a video with the given fingerprint was uploaded as, or None."""
+    if not fingerprint:
+        return None
+    return get_fingerprint_index().get(fingerprint)
+
+
+def move_video_to_uploaded_folder(video_path, folder: str = None):
+    """
+    Moves a video to folder (folder_to_move_completed_uploads by default) on the low priority mover thread,
+    waiting for it to finish. Works across filesystems (see file_mover.py).
+    """
+    destination = (folder or config["folder_to_move_completed_uploads"]) + "/" + os.path.basename(video_path)
+    move_file_in_background(video_path, destination, config["move_verify"]).result()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,125 @@
+"""
+Estimates how long uploads take, from the throughput of past uploads: the ETAs of the uploads in
+flight, and when each queued video will be uploaded (see upload_queue.estimate_upload_times()).
+
+Every upload records the bytes it sent and the time that took, for each local hour of the day it ran
+in (throughput_samples.json in the state store, the newest throughput_sample_limit samples are kept).
+The model averages them per hour of the day, weighting recent samples more (their weight halves
+every HALF_LIFE_DAYS), since home connections are often slower in the evening. Hours with less
+than MIN_HOUR_SECONDS of samples fall back on the average over every hour for the rest, and with no
+samples at all estimated_upload_speed is used. Estimates never exceed the upload bandwidth limit.
+"""
+
+import time
+from datetime import datetime, timedelta
+
+from config import config
+from state import get_throughput_samples, add_throughput_samples
+from bandwidth import get_bandwidth_budget
+
+import logging
+logger = logging.getLogger()
+
+HALF_LIFE_DAYS = 14
+# seconds of samples an hour of the day needs for its own average to be trusted fully
+MIN_HOUR_SECONDS = 10 * 60
+# shorter samples aren't recorded, they're mostly the session request and the first chunk
+MIN_SAMPLE_SECONDS = 30
+# how far ahead (in seconds) the current rate of an upload in flight is used for its ETA, instead of the model
+LIVE_RATE_HORIZON = 15 * 60
+
+throughput_model = None
+
+
+class ThroughputModel():
+    def __init__(self, samples: list, now: float = None):
+        now = now or time.time()
+
+        # hour of the day -> [weighted bytes, weighted seconds]
+        self.hours = [[0.0, 0.0] for _ in range(24)]
+        for sample in samples:
+            weight = 0.5 ** ((now - sample["at"]) / (HALF_LIFE_DAYS * 24 * 60 * 60))
+            self.hours[sample["hour"]][0] += sample["bytes"] * weight
+            self.hours[sample["hour"]][1] += sample["seconds"] * weight
+
+        self.sample_count = len(samples)
+        total_bytes = sum(hour[0] for hour in self.hours)
+        total_seconds = sum(hour[1] for hour in self.hours)
+        self.average_rate = total_bytes / total_seconds if total_seconds else config["estimated_upload_speed"] * 1_000_000
+
+    def get_rate(self, hour: int) -> float:
+        """The expected upload speed (bytes per second) during a local hour of the day."""
+        hour_bytes, hour_seconds = self.hours[hour]
+        if hour_seconds >= MIN_HOUR_SECONDS:
+            rate = hour_bytes / hour_seconds
+        else:
+            rate = (hour_bytes + self.average_rate * (MIN_HOUR_SECONDS - hour_seconds)) / MIN_HOUR_SECONDS
+
+        budget = get_bandwidth_budget()
+        return min(rate, budget.bytes_per_second) if budget.is_limited() else rate
+
+    def seconds_to_upload(self, size: int, start_time: float, current_rate: float = None) -> float:
+        """
+        Estimates how long uploading size bytes takes when starting at start_time, hour by hour.
+        current_rate (the rate of an upload in flight) is used for the first LIVE_RATE_HORIZON seconds.
+        """
+        current_time = start_time
+        remaining = size
+        while remaining > 0:
+            if current_rate and current_time < start_time + LIVE_RATE_HORIZON:
+                rate, until = current_rate, start_time + LIVE_RATE_HORIZON
+            else:
+                hour = datetime.fromtimestamp(current_time).replace(minute=0, second=0, microsecond=0)
+                rate, until = self.get_rate(hour.hour), (hour + timedelta(hours=1)).timestamp()
+
+            if rate <= 0:
+                return 0
+            if rate * (until - current_time) >= remaining:
+                return current_time + remaining / rate - start_time
+
+            remaining -= rate * (until - current_time)
+            current_time = until
+
+        return current_time - start_time
+
+    def get_hourly_rates(self) -> list:
+        """The expected upload speed (MB/s) during every hour of the day, for reports."""
+        return [self.get_rate(hour) / 1_000_000 for hour in range(24)]
+
+
+def get_throughput_model() -> ThroughputModel:
+    global throughput_model
+
+    if throughput_model is None:
+        throughput_model = ThroughputModel(get_throughput_samples())
+
+    return throughput_model
+
+
+def record_upload(upload: dict):
+    """Saves the throughput samples of an upload that stopped (see UploadController.finish()), and updates the model."""
+    global throughput_model
+
+    samples = [
+        {"at": upload["started_at"], "hour": hour, "bytes": hour_bytes, "seconds": round(seconds, 3)}
+        for hour, (hour_bytes, seconds) in upload["hours"].items() if seconds >= MIN_SAMPLE_SECONDS
+    ]
+    if not samples:
+        return
+
+    try:
+        add_throughput_samples(samples, config["throughput_sample_limit"])
+    except OSError:
+        logger.error("Unable to save the throughput of the upload", exc_info=True)
+        return
+    throughput_model = None
+
+    total_bytes, total_seconds = sum(sample["bytes"] for sample in samples), sum(sample["seconds"] for sample in samples)
+    logger.debug(f"Uploaded {total_bytes / 1024 ** 3:.2f} GiB at {total_bytes / total_seconds / 1_000_000:.2f} MB/s")
+
+
+def get_upload_eta(upload: dict, now: float = None) -> float:
+    """The Unix time an upload in flight (see UploadController) is expected to finish at."""
+    now = now or time.time()
+    remaining = max(upload["file_size"] - upload["uploaded_bytes"], 0)
+    return now + get_throughput_model().seconds_to_upload(remaining, now, upload["rate"])
@@ -4,47 +4,213 @@ and converting date strings into datetime objects.
 """
 
 import os
+import time
 import requests
 import json
+import threading
 
 from datetime import datetime, timezone
 
 from config import config
+from state import write_json_atomic
+from channels import get_channels
+import metrics
 
 import logging
 logger = logging.getLogger()
 
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__ + "/.."))
+TWITCH_TOKEN_PATH = ROOT_DIR + "/data/twitch_token.json"
 
-TWITCH_CLIENT_ID = config["twitch_client_id"]
-USER_ID = config["twitch_user_id"]
+HELIX_URL = "https://api.twitch.tv/helix/"
+TOKEN_URL = "https://id.twitch.tv/oauth2/token"
 
-twitch_session = requests.Session()
-twitch_session.headers.update({"Client-ID": TWITCH_CLIENT_ID})
+# Helix endpoints accept up to 100 IDs per request
+MAX_IDS_PER_REQUEST = 100
+# requests are held back until the rate limit bucket refills once fewer points than this are left
+RATE_LIMIT_RESERVE = 5
+# retries of a request that was rate limited (429) or rejected because the token expired (401)
+MAX_REQUEST_ATTEMPTS = 3
 
-if not config["twitch_client_id"] or not config["twitch_user_id"]:
-    logger.critical("Please enter your Twitch Client ID and Twitch User ID in data/config.json. (More info in the README)")
-    exit(1)
+twitch_session = None
+twitch_lock = threading.Lock()
+
+# the app access token (client credentials flow), when twitch_client_secret is set
+app_token = None
+# from the Ratelimit-Remaining / Ratelimit-Reset headers of the last response
+rate_limit = {"remaining": None, "reset": 0}
 
 
 class TwitchAPIError(Exception):
     pass
 
 
-def fetch_videos(first=100) -> dict:
+def check_twitch_config():
+    """Raises TwitchAPIError when the Twitch Client ID or a channel's Twitch User ID is missing from config.json."""
+    if not config["twitch_client_id"] or not all(channel.twitch_user_id for channel in get_channels()):
+        raise TwitchAPIError("Please enter your Twitch Client ID and Twitch User ID in data/config.json. (More info in the README)")
+
+
+def get_twitch_session() -> requests.Session:
     """
-    Retrieves the 20 most recent VODs from the
-    channel specified by 'twitch_user_id' in config.json.
+    Creates the Requests Session used for calling the Twitch API on first use. The config is
+    checked on startup (check_twitch_config()), requests from tasks only get a TwitchAPIError.
     """
+    global twitch_session
+
+    if twitch_session is None:
+        check_twitch_config()
+
+        twitch_session = requests.Session()
+        twitch_session.headers.update({"Client-ID": config["twitch_client_id"]})
+
+    return twitch_session
+
+
+def load_app_token():
+    if not os.path.isfile(TWITCH_TOKEN_PATH):
+        return None
+
+    try:
+        with open(TWITCH_TOKEN_PATH, "r", encoding="utf8") as file:
+            token = json.loads(file.read())
+    except json.decoder.JSONDecodeError:
+        return None
+
+    # Tokens of a different client (the config changed) can't be used
+    if token.get("client_id") != config["twitch_client_id"]:
+        return None
+    return token
+
+
+def request_app_token() -> dict:
+    response = get_twitch_session().post(TOKEN_URL, params={
+        "client_id": config["twitch_client_id"],
+        "client_secret": config["twitch_client_secret"],
+        "grant_type": "client_credentials"
+    })
+    if not response.ok:
+        raise TwitchAPIError(f"Unable to get an app access token ({response.status_code})")
+
+    contents = response.json()
+    token = {
+        "client_id": config["twitch_client_id"],
+        "access_token": contents["access_token"],
+        # renewed a minute early
+        "expires_at": time.time() + contents.get("expires_in", 3600) - 60
+    }
+    write_json_atomic(TWITCH_TOKEN_PATH, token)
+    logger.info("Received a Twitch app access token")
+    return token
+
+
+def get_app_token(renew: bool = False):
+    """Returns the cached app access token (renewing it when it expired), or None without twitch_client_secret."""
+    global app_token
+
+    if not config["twitch_client_secret"]:
+        return None
+
+    with twitch_lock:
+        if app_token is None and not renew:
+            app_token = load_app_token()
+
+        if renew or app_token is None or app_token["expires_at"] <= time.time():
+            app_token = request_app_token()
+
+        return app_token["access_token"]
+
+
+def wait_for_rate_limit():
+    """Sleeps until the rate limit bucket refills if it's (almost) empty."""
+    with twitch_lock:
+        remaining, reset = rate_limit["remaining"], rate_limit["reset"]
 
-    endpoint = "https://api.twitch.tv/helix/videos"
-    params = {"user_id": USER_ID, "first": str(first)}
+    if remaining is not None and remaining < RATE_LIMIT_RESERVE:
+        sleep_seconds = reset - time.time()
+        if sleep_seconds > 0:
+            logger.info(f"Twitch API rate limit almost reached, waiting {sleep_seconds:.0f} seconds")
+            time.sleep(sleep_seconds)
 
-    with twitch_session.get(endpoint, params=params) as response:
-        if response.ok:
-            return json.loads(response.text)["data"]
-        else:
-            raise TwitchAPIError(response.status_code)
+
+def update_rate_limit(response: requests.Response):
+    try:
+        remaining = int(response.headers["Ratelimit-Remaining"])
+        reset = int(response.headers["Ratelimit-Reset"])
+    except (KeyError, ValueError):
+        return
+
+    with twitch_lock:
+        rate_limit["remaining"] = remaining
+        rate_limit["reset"] = reset
+
+
+def twitch_get(endpoint: str, params) -> dict:
+    """
+    Calls a Helix endpoint (e.g. "videos") with the app access token, pacing requests by the rate limit
+    headers. Rate limited requests (429) and expired tokens (401) are retried.
+    """
+    token = get_app_token()
+
+    for attempt in range(MAX_REQUEST_ATTEMPTS):
+        wait_for_rate_limit()
+
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+        with metrics.twitch_fetch_seconds.time(endpoint=endpoint), get_twitch_session().get(HELIX_URL + endpoint, params=params, headers=headers) as response:
+            update_rate_limit(response)
+
+            if response.ok:
+                return json.loads(response.text)
+
+            if response.status_code == 401 and token:
+                logger.info("The Twitch app access token was rejected, requesting a new one")
+                token = get_app_token(renew=True)
+            elif response.status_code == 429:
+                with twitch_lock:
+                    rate_limit["remaining"] = 0
+                logger.warning("Twitch API rate limit reached")
+            else:
+                raise TwitchAPIError(response.status_code)
+
+    raise TwitchAPIError(response.status_code)
+
+
+def fetch_videos(user_id: str = None, first=100) -> dict:
+    """
+    Retrieves the 100 most recent VODs from the given Twitch user,
+    or the channel specified by 'twitch_user_id' in config.json.
+    """
+
+    return twitch_get("videos", {"user_id": user_id or config["twitch_user_id"], "first": str(first)})["data"]
+
+
+def fetch_videos_by_id(video_ids: list) -> list:
+    """
+    Retrieves specific VODs (up to 100 per request), e.g. to pick up the final duration of a VOD
+    once its stream ended, without listing the channel's videos again. Deleted VODs are left out.
+    """
+    videos = []
+    for i in range(0, len(video_ids), MAX_IDS_PER_REQUEST):
+        params = [("id", video_id) for video_id in video_ids[i:i + MAX_IDS_PER_REQUEST]]
+        try:
+            videos += twitch_get("videos", params)["data"]
+        except TwitchAPIError as e:
+            # Helix responds with a 404 when none of the IDs exist anymore
+            if e.args[0] != 404:
+                raise
+
+    return videos
+
+
+def fetch_streams(user_ids: list) -> dict:
+    """Returns {user ID: stream} for the given Twitch users that are live (up to 100 users per request)."""
+    streams = {}
+    for i in range(0, len(user_ids), MAX_IDS_PER_REQUEST):
+        params = [("user_id", user_id) for user_id in user_ids[i:i + MAX_IDS_PER_REQUEST]]
+        for stream in twitch_get("streams", params)["data"]:
+            streams[stream["user_id"]] = stream
+
+    return streams
 
 
 def get_video_timestamp(video: dict) -> float:
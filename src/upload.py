@@ -1,15 +1,27 @@
 """Higher level functions for starting video uploads."""
 
 import os
+from datetime import datetime
 
+import metrics
 from resumable_upload import ResumableUpload
-from state import mark_twitch_vod_as_uploaded, move_video_to_uploaded_folder
-from state import save_in_progress_upload, remove_in_progress_upload
+from video_reader import VideoFileReader
+from state import save_in_progress_upload, remove_in_progress_upload, checkpoint_in_progress_upload, find_uploaded_fingerprint
+from fingerprint import get_fingerprint
+from post_upload import create_job, get_post_upload_pipeline, run_job_steps
 
 from config import config
-from upload_categories import categories, get_formatted_metadata
+from quota import get_upload_cost
+from upload_categories import detect_vod_game, get_categories, get_formatted_metadata
 
 from twitch_api import get_contract_release_time, datetime_to_iso
+from logs import ProgressRateLimiter
+from shutdown import is_shutting_down
+from upload_control import get_upload_controller
+from bandwidth import get_bandwidth_budget
+from channels import get_vod_channel
+from throughput import get_upload_eta, record_upload
+import profiling
 
 import logging
 logger = logging.getLogger()
@@ -32,19 +44,30 @@ def shorten_video_title(video_title: str) -> str:
     return video_title
 
 
-def upload_video(google_session: dict, video_path: str, twitch_video: dict, video_snippet: dict, progress_callback=None, upload_url: str = None, DRY_RUN_ENABLED=False):
+def upload_video(credential, video_path: str, twitch_video: dict, video_snippet: dict, progress_callback=None, upload_url: str = None,
+                 uploaded_bytes: int = None, fingerprint: str = None, DRY_RUN_ENABLED=False):
     """
     Starts a resumable upload, configures the metadata used for the YouTube video (given by twitch_video),
-    and uploads the file at video_path.
+    and uploads the file at video_path using the given YouTubeCredential (see youtube_auth.py).
+    uploaded_bytes is the offset YouTube confirmed for upload_url, if it's already known.
+    Raises ResumableUpload.Interrupted if the process is shutting down (or the upload was paused or cancelled,
+    see upload_control.py), with the upload's progress saved in state.json unless it was cancelled.
     """
+    controller = get_upload_controller()
 
     def start_resumable_upload(google_session: dict, video_path: str, video_metadata: dict, chunk_size=None, upload_url: str = None):
         if not os.path.isfile(video_path):
             logger.error(f"Invalid file path: {video_path}")
             return
 
-        video = open(video_path, "rb")
-        resumable_upload = ResumableUpload(video_metadata, video, chunk_size=chunk_size, upload_url=upload_url, session=google_session)
+        video = VideoFileReader(video_path, direct=config["upload_direct_io"], drop_cache=config["upload_drop_page_cache"])
+        resumable_upload = ResumableUpload(
+            video_metadata, video, chunk_size=chunk_size, upload_url=upload_url, session=google_session,
+            uploaded_bytes=uploaded_bytes,
+            checkpoint_callback=lambda confirmed_bytes: checkpoint_in_progress_upload(twitch_video["id"], confirmed_bytes),
+            should_stop=lambda: controller.should_stop(video_path),
+            bandwidth_budget=get_bandwidth_budget()
+        )
         return resumable_upload, video
 
     if "title" in video_snippet and len(video_snippet["title"]) > 100:
@@ -67,18 +90,46 @@ def upload_video(google_session: dict, video_path: str, twitch_video: dict, vide
 
     if not DRY_RUN_ENABLED:
         try:
-            resumable_upload, video = start_resumable_upload(google_session, video_path, video_meta, upload_url=upload_url)
+            resumable_upload, video = start_resumable_upload(credential.session, video_path, video_meta, upload_url=upload_url)
+            if resumable_upload.upload_url and not upload_url:
+                credential.quota_ledger.charge("videos.insert")
+
             if resumable_upload.upload_url:
-                save_in_progress_upload(resumable_upload.upload_url, video_path, twitch_video)
-                response = resumable_upload.upload(progress_callback)
-                video.close()
-                remove_in_progress_upload(twitch_video["id"])
+                save_in_progress_upload(resumable_upload.upload_url, video_path, twitch_video, credential.name, fingerprint)
+
+                def on_progress(status, response, uploaded_bytes):
+                    controller.update(video_path, uploaded_bytes)
+                    if progress_callback:
+                        progress_callback(status, response, uploaded_bytes)
+
+                controller.start(video_path, twitch_video, credential.name, resumable_upload.file_size, resumable_upload.uploaded_bytes)
+                try:
+                    response = resumable_upload.upload(on_progress)
+                finally:
+                    upload = controller.finish(video_path)
+                    if upload:
+                        record_upload(upload)
+                    video.close()
+
+                # Successful uploads are removed from state.json once their post upload job is saved
+                if not response or response.status_code not in (200, 201):
+                    remove_in_progress_upload(twitch_video["id"])
                 return response
             else:
                 raise ResumableUpload.ReachedRetryMax
         except ResumableUpload.ReachedRetryMax:
             logger.error("Reached the maximum amount of retries", exc_info=True)
         except ResumableUpload.ExceededQuota:
+            credential.quota_ledger.mark_exhausted()
+            raise
+        except ResumableUpload.Interrupted:
+            if is_shutting_down():
+                logger.info(f"Stopped uploading {video_path} for shutdown, it will be resumed on next start")
+            elif controller.is_cancelled(video_path):
+                logger.info(f"Cancelled the upload of {video_path}")
+                remove_in_progress_upload(twitch_video["id"])
+            else:
+                logger.info(f"Paused the upload of {video_path}")
             raise
         except Exception:
             logger.error(f"An error occurred while uploading {video_path}.", exc_info=True)
@@ -90,54 +141,107 @@ def upload_video(google_session: dict, video_path: str, twitch_video: dict, vide
         # remove_in_progress_upload(twitch_video["id"])
 
 
-def quick_upload_video(google_session: dict, video_path: str, twitch_video: dict, upload_url: str = None, DRY_RUN_ENABLED=False):
+def quick_upload_video(credential, video_path: str, twitch_video: dict, upload_url: str = None, uploaded_bytes: int = None, DRY_RUN_ENABLED=False):
     """Handles starting a resumable upload automatically, and just uploads a video with the given metadata"""
 
+    # A copied or renamed recording (or one matched with a different VOD) that was uploaded before
+    fingerprint = get_fingerprint(video_path)
+    uploaded_vod_id = find_uploaded_fingerprint(fingerprint)
+    if uploaded_vod_id and not upload_url:
+        logger.warning(f"{video_path} has the same contents as the video uploaded for VOD {uploaded_vod_id}, skipping it")
+        return
+
     file_size = os.path.getsize(video_path)
+    progress_limiter = ProgressRateLimiter(config["progress_log_interval"])
 
     def prog(status, response, uploaded_bytes):
+        if not progress_limiter.should_log(uploaded_bytes / file_size):
+            return
+
         prog = (uploaded_bytes / file_size) * 100
-        logger.info(f"[PROGRESS] status: {status} {prog:.2f}%")
+        upload = get_upload_controller().get_upload(video_path)
+        eta = f" (ETA {datetime.fromtimestamp(get_upload_eta(upload)).strftime('%Y-%m-%d %I:%M %p')})" if upload else ""
+        logger.info(f"[PROGRESS] status: {status} {prog:.2f}%{eta}")
         # print(f"[PROGRESS] status: {status} {response.headers} {response.content}\nREQUEST HEADERS: {response.request.headers}")
 
-    video_snippet, category_data = get_formatted_metadata(categories, twitch_video)
+    with profiling.stage("metadata"):
+        video_snippet, category_data = get_formatted_metadata(get_categories(get_vod_channel(twitch_video).categories_path), twitch_video)
 
-    res = upload_video(google_session, video_path, twitch_video, video_snippet, progress_callback=prog, upload_url=upload_url, DRY_RUN_ENABLED=DRY_RUN_ENABLED)
+    res = upload_video(credential, video_path, twitch_video, video_snippet, progress_callback=prog, upload_url=upload_url,
+                       uploaded_bytes=uploaded_bytes, fingerprint=fingerprint, DRY_RUN_ENABLED=DRY_RUN_ENABLED)
     if res and res.status_code in (200, 201):
-
-        res_json = res.json()
-        logger.info(f"Final response: {res_json}")
-
-        if "thumbnail" in category_data:
-            set_video_thumbnail(google_session, res_json["id"], category_data["thumbnail"])
-
-        title = res_json["snippet"]["title"]
-        channel = res_json["snippet"]["channelTitle"]
-        channel_id = res_json["snippet"]["channelId"]
-        link = "https://youtube.com/watch?v=" + res_json["id"]
-        privacy = res_json["status"]["privacyStatus"]
-        published = res_json["snippet"]["publishedAt"]
-        logger.info(f"\ntitle: {title}\nchannel: {channel} ({channel_id})\nlink: {link}\nprivacy: {privacy}\npublished: {published}")
-
-        mark_twitch_vod_as_uploaded(twitch_video["id"])
-        move_video_to_uploaded_folder(video_path)
+        finish_upload(credential, video_path, twitch_video, res.json(), category_data.get("thumbnail"), fingerprint)
     else:
         logger.error(f"Unable to upload video: {video_path}")
+        metrics.uploads_finished.inc(result="failure")
 
 
-def set_video_thumbnail(google_session, video_id, thumbnail_path):
+def finish_upload(credential, video_path: str, twitch_video: dict, res_json: dict, thumbnail_path: str = None, fingerprint: str = None):
+    """
+    Hands a video YouTube has fully received (res_json is its video resource) to the post upload steps,
+    and removes its entry from state.json.
+    """
+    logger.info(f"Final response: {res_json}")
+
+    title = res_json["snippet"]["title"]
+    channel = res_json["snippet"]["channelTitle"]
+    channel_id = res_json["snippet"]["channelId"]
+    link = "https://youtube.com/watch?v=" + res_json["id"]
+    privacy = res_json["status"]["privacyStatus"]
+    published = res_json["snippet"]["publishedAt"]
+    logger.info(f"\ntitle: {title}\nchannel: {channel} ({channel_id})\nlink: {link}\nprivacy: {privacy}\npublished: {published}")
+
+    if thumbnail_path is None:
+        categories = get_categories(get_vod_channel(twitch_video).categories_path)
+        thumbnail_path = categories[detect_vod_game(categories, twitch_video)].get("thumbnail")
+    if fingerprint is None:
+        fingerprint = get_fingerprint(video_path)
+
+    # Marking the VOD as uploaded, moving the file and setting the thumbnail happen in the
+    # post upload pipeline's workers (if it's running), so the next upload can start right away
+    job = create_job(credential.name, video_path, twitch_video, res_json, thumbnail_path, fingerprint)
+    pipeline = get_post_upload_pipeline()
+    if pipeline:
+        pipeline.submit(job)
+    elif not run_job_steps(job, credential):
+        logger.error(f"Some post upload steps failed for {res_json['id']}: {job['steps_done']} are done")
+
+    remove_in_progress_upload(twitch_video["id"])
+    metrics.uploads_finished.inc(result="success")
+
+
+def get_video_upload_cost(twitch_video: dict) -> int:
+    """The quota units needed to upload the video for a Twitch VOD, including setting its thumbnail."""
+    categories = get_categories(get_vod_channel(twitch_video).categories_path)
+    category_data = categories[detect_vod_game(categories, twitch_video)]
+    return get_upload_cost(has_thumbnail="thumbnail" in category_data)
+
+
+def set_video_thumbnail(credential, video_id, thumbnail_path) -> bool:
+    """Returns False if the request failed (and should be retried)."""
     try:
-        thumbnail_file = open(thumbnail_path, "rb")
-        response = google_session.post(
-            "https://www.googleapis.com/upload/youtube/v3/thumbnails/set",
-            params={"videoId": video_id},
-            data=thumbnail_file
-        )
+        with open(thumbnail_path, "rb") as thumbnail_file:
+            response = credential.session.post(
+                "https://www.googleapis.com/upload/youtube/v3/thumbnails/set",
+                params={"videoId": video_id},
+                data=thumbnail_file
+            )
+        credential.quota_ledger.charge("thumbnails.set")
 
         if response.ok:
             logger.info(f"Successfully set thumbnail to {thumbnail_path} for video: {video_id}")
+        elif response.status_code == 403 and "quotaExceeded" in response.text:
+            logger.error(f"Unable to set thumbnail to {thumbnail_path} for video: {video_id}, the quota ran out")
+            credential.quota_ledger.mark_exhausted()
+        elif response.status_code == 403:
+            # e.g. the channel isn't allowed custom thumbnails, retrying won't help
+            logger.error(f"Unable to set thumbnail to {thumbnail_path} for video: {video_id} ({response.text})")
+            return True
         else:
             logger.error(f"Unable to set thumbnail to {thumbnail_path} for video: {video_id}")
 
+        return response.ok
+
     except FileNotFoundError:
         logger.error(f"Unable find thumbnail file: {thumbnail_path}")
+        return True
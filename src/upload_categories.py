@@ -1,12 +1,15 @@
 import json
 import os
-from category_variables import generate_variables
+from category_variables import TemplateVariables, clear_variable_cache, generate_variables
 
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__ + "/.."))
 UPLOAD_CATEGORIES_PATH = ROOT_DIR + "/data/upload_categories.json"
 
+# categories file path -> loaded categories (every channel can have its own file, see channels.py)
+categories = {}
 
-def create_default_categories():
+
+def create_default_categories(path: str = UPLOAD_CATEGORIES_PATH):
 
     data = {
         "_default": {
@@ -17,32 +20,33 @@ def create_default_categories():
         }
     }
 
-    with open(UPLOAD_CATEGORIES_PATH, "w") as cats:
+    with open(path, "w") as cats:
         cats.write(json.dumps(data, indent=4))
 
 
-def get_categories_file():
+def get_categories_file(path: str = UPLOAD_CATEGORIES_PATH):
     try:
-        with open(UPLOAD_CATEGORIES_PATH, "r", encoding="utf8") as cats:
+        with open(path, "r", encoding="utf8") as cats:
             res = json.loads(cats.read())
             if "_default" in res:
                 return res
             else:
-                raise Exception("A \"_default\" category is required (in data/upload_categories.json)")
+                raise Exception(f"A \"_default\" category is required (in {path})")
     except (FileNotFoundError, json.decoder.JSONDecodeError):
-        create_default_categories()
-        with open(UPLOAD_CATEGORIES_PATH, "r", encoding="utf8") as cats:
+        create_default_categories(path)
+        with open(path, "r", encoding="utf8") as cats:
             res = json.loads(cats.read())
             if "_default" in res:
                 return res
             else:
-                raise Exception("A \"_default\" category is required (in data/upload_categories.json)")
+                raise Exception(f"A \"_default\" category is required (in {path})")
 
 
 def detect_vod_game(categories, vod_data):
     title = vod_data["title"]
 
-    for game_name, game_keywords in ((game_name, categories[game_name]["keywords"]) for game_name in categories if game_name != "_default"):
+    # Keys starting with an underscore are reserved (_default, _variables)
+    for game_name, game_keywords in ((game_name, categories[game_name]["keywords"]) for game_name in categories if not game_name.startswith("_")):
         for keyword in game_keywords:
             if keyword.lower() in title.lower():
                 return game_name
@@ -55,23 +59,44 @@ def get_formatted_metadata(categories, vod_data):
     game_name = detect_vod_game(categories, vod_data)
     game_meta = categories[game_name]["metadata"]
 
-    gen_vars = generate_variables(vod_data)
-    if gen_vars:
-        vod_data.update(gen_vars)
+    # Custom variables are only computed if one of the templates references them
+    variables = TemplateVariables(vod_data, categories.get("_variables"))
 
     formatted = {}
     for prop in game_meta:
         if not isinstance(game_meta[prop], list):
-            formatted[prop] = game_meta[prop].format(**vod_data)
+            formatted[prop] = game_meta[prop].format_map(variables)
         else:
             formatted[prop] = []
             for val in game_meta[prop]:
-                formatted[prop].append(val.format(**vod_data))
+                formatted[prop].append(val.format_map(variables))
 
     return (formatted, categories[game_name])
 
 
-categories = get_categories_file()
+def get_categories(path: str = UPLOAD_CATEGORIES_PATH):
+    """Loads a categories file on first use, and returns the loaded categories after that."""
+
+    if path not in categories:
+        categories[path] = get_categories_file(path)
+        clear_variable_cache()
+
+    return categories[path]
+
+
+def reload_categories(path: str = UPLOAD_CATEGORIES_PATH):
+    """
+    Loads every categories file that was loaded (and path) again. The files are read into a new
+    mapping that replaces the old one at once, since other threads (uploads) use it meanwhile.
+    """
+    global categories
+
+    reloaded = {loaded_path: get_categories_file(loaded_path) for loaded_path in set(categories) | {path}}
+    categories = reloaded
+    clear_variable_cache()
+
+    return reloaded[path]
+
 
 if __name__ == "__main__":
     test_vod_data = {
@@ -90,5 +115,5 @@ if __name__ == "__main__":
         "type": "archive",
         "duration": "2h31m1s"
     }
-    print(get_formatted_metadata(categories, test_vod_data))
+    print(get_formatted_metadata(get_categories(), test_vod_data))
     print(generate_variables(test_vod_data))
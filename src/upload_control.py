@@ -0,0 +1,135 @@
+"""
+Runtime control over uploads (see control.py): which uploads are in flight and how fast they go,
+and which are paused or cancelled.
+
+Pausing or cancelling an upload that's in flight stops it after the chunk it's sending, like a
+shutdown does. A paused upload keeps its upload session (and confirmed offset) in the queue, so
+resuming it carries on where it stopped. A cancelled upload's session is dropped, and its video
+isn't queued again until it's resumed (or the process restarts).
+"""
+
+import time
+import threading
+from datetime import datetime
+
+from shutdown import is_shutting_down
+
+import logging
+logger = logging.getLogger()
+
+# weight of the newest chunk in the smoothed upload rate
+RATE_SMOOTHING = 0.3
+
+upload_controller = None
+
+
+class UploadController():
+    def __init__(self):
+        self.lock = threading.Lock()
+        # video path -> in flight upload
+        self.active = {}
+        self.paused = set()
+        self.cancelled = set()
+        self.paused_all = False
+
+    def start(self, video_path: str, twitch_vod: dict, credential_name: str, file_size: int, uploaded_bytes: int):
+        now = time.time()
+        with self.lock:
+            self.active[video_path] = {
+                "video_path": video_path,
+                "twitch_vod_id": twitch_vod["id"],
+                "credential": credential_name,
+                "file_size": file_size,
+                "uploaded_bytes": uploaded_bytes,
+                "started_at": now,
+                "started_bytes": uploaded_bytes,
+                "updated_at": now,
+                # bytes per second, smoothed over the last few chunks
+                "rate": 0,
+                # local hour of the day -> [bytes sent, seconds], recorded as throughput samples (see throughput.py)
+                "hours": {}
+            }
+
+    def update(self, video_path: str, uploaded_bytes: int):
+        """Records an upload's confirmed offset after a chunk."""
+        now = time.time()
+        with self.lock:
+            upload = self.active.get(video_path)
+            if not upload:
+                return
+
+            elapsed = now - upload["updated_at"]
+            if elapsed > 0 and uploaded_bytes >= upload["uploaded_bytes"]:
+                chunk_rate = (uploaded_bytes - upload["uploaded_bytes"]) / elapsed
+                upload["rate"] = chunk_rate if not upload["rate"] else (1 - RATE_SMOOTHING) * upload["rate"] + RATE_SMOOTHING * chunk_rate
+
+                hour = upload["hours"].setdefault(datetime.fromtimestamp(now).hour, [0, 0.0])
+                hour[0] += uploaded_bytes - upload["uploaded_bytes"]
+                hour[1] += elapsed
+
+            upload["uploaded_bytes"] = uploaded_bytes
+            upload["updated_at"] = now
+
+    def finish(self, video_path: str) -> dict:
+        """Stops tracking an upload, returning it (or None if it wasn't tracked)."""
+        with self.lock:
+            return self.active.pop(video_path, None)
+
+    def get_upload(self, video_path: str) -> dict:
+        with self.lock:
+            upload = self.active.get(video_path)
+            return dict(upload) if upload else None
+
+    def get_active_uploads(self) -> list:
+        with self.lock:
+            return [dict(upload, paused=upload["video_path"] in self.paused or self.paused_all) for upload in self.active.values()]
+
+    def pause(self, video_path: str = None):
+        """Pauses an upload (queued or in flight), or all of them."""
+        with self.lock:
+            if video_path is None:
+                self.paused_all = True
+            else:
+                self.paused.add(video_path)
+
+    def resume(self, video_path: str = None):
+        """Resumes a paused (or cancelled) upload, or all of them."""
+        with self.lock:
+            if video_path is None:
+                self.paused_all = False
+                self.paused.clear()
+                self.cancelled.clear()
+            else:
+                self.paused.discard(video_path)
+                self.cancelled.discard(video_path)
+
+    def cancel(self, video_path: str):
+        with self.lock:
+            self.cancelled.add(video_path)
+            self.paused.discard(video_path)
+
+    def is_paused(self, video_path: str) -> bool:
+        with self.lock:
+            return self.paused_all or video_path in self.paused
+
+    def is_cancelled(self, video_path: str) -> bool:
+        with self.lock:
+            return video_path in self.cancelled
+
+    def is_held(self, video_path: str) -> bool:
+        """Whether the video shouldn't be uploaded right now."""
+        with self.lock:
+            return self.paused_all or video_path in self.paused or video_path in self.cancelled
+
+    def should_stop(self, video_path: str) -> bool:
+        """Checked by ResumableUpload before every chunk."""
+        return is_shutting_down() or self.is_held(video_path)
+
+
+def get_upload_controller() -> UploadController:
+    global upload_controller
+
+    if upload_controller is None:
+        upload_controller = UploadController()
+
+    return upload_controller
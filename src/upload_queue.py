@@ -0,0 +1,292 @@
+"""
+A persistent (data/upload_queue.json) priority queue deciding which video is uploaded next.
+
+The order is decided by the scorers listed in "upload_queue_order" (config.json), compared
+one after another: by default interrupted uploads that can be resumed first, then pinned VODs,
+then videos on a disk that's running out of space (see retention.py), then the earliest contract
+release time, then the smallest file (shortest job first), then the video that has waited the longest.
+More scorers can be registered with @queue_scorer.
+"""
+
+import os
+import json
+import time
+import threading
+
+from config import config
+from state import write_json_atomic
+from twitch_api import get_contract_release_time
+from channels import get_vod_channel
+
+import logging
+logger = logging.getLogger()
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__ + "/.."))
+UPLOAD_QUEUE_PATH = ROOT_DIR + "/data/upload_queue.json"
+
+# scorer name -> function(entry: dict) -> sort key (lower is uploaded first)
+queue_scorers = {}
+
+upload_queue = None
+
+# recordings folders whose disk is running out of space, set by the retention manager (see retention.py)
+pressured_folders = set()
+
+
+def queue_scorer(name: str):
+    """Registers the decorated function as a scorer that can be listed in "upload_queue_order"."""
+
+    def decorator(func):
+        queue_scorers[name] = func
+        return func
+
+    return decorator
+
+
+@queue_scorer("resuming")
+def resuming_score(entry: dict):
+    """Interrupted uploads whose session is still usable, so the data YouTube already has isn't wasted."""
+    return 0 if entry.get("upload_url") else 1
+
+
+@queue_scorer("pinned")
+def pinned_score(entry: dict):
+    return 0 if entry.get("pinned") else 1
+
+
+@queue_scorer("pressure")
+def pressure_score(entry: dict):
+    """Videos on a disk that's running out of space, so their files can be moved off it sooner."""
+    return 0 if os.path.dirname(entry["video_path"]) in pressured_folders else 1
+
+
+@queue_scorer("release")
+def release_score(entry: dict):
+    """Videos that are scheduled to go public the soonest are uploaded first."""
+    if config["scheduled_upload_wait_time"] <= 0:
+        return 0
+    return get_contract_release_time(entry["twitch_vod"]).timestamp()
+
+
+@queue_scorer("size")
+def size_score(entry: dict):
+    return entry.get("file_size", 0)
+
+
+@queue_scorer("age")
+def age_score(entry: dict):
+    return entry.get("added_at", 0)
+
+
+def get_entry_channel(entry: dict) -> str:
+    """The name of the channel a queue entry belongs to (entries from before channels existed don't have one)."""
+    return entry.get("channel") or get_vod_channel(entry["twitch_vod"]).name
+
+
+class UploadQueue():
+    """Videos waiting to be uploaded, along with the Twitch VOD pins set with bot.py --pin."""
+
+    def __init__(self, file_path: str = UPLOAD_QUEUE_PATH, order: list = None):
+        self.file_path = file_path
+        self.order = order if order else ["resuming", "pinned", "pressure", "release", "size", "age"]
+        self.lock = threading.Lock()
+
+        # video path -> entry
+        self.entries = {}
+        self.pinned_vods = set()
+        # the pins in the file as of the last read or write, and the file's (mtime, size) then
+        self.synced_pins = set()
+        self.file_stamp = None
+
+        self.load()
+
+    def get_file_stamp(self):
+        try:
+            stat = os.stat(self.file_path)
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
+
+    def read_file(self) -> dict:
+        if not os.path.isfile(self.file_path):
+            return None
+
+        try:
+            with open(self.file_path, "r", encoding="utf8") as file:
+                return json.loads(file.read())
+        except json.decoder.JSONDecodeError:
+            logger.error(f"Unable to read {self.file_path}", exc_info=True)
+            return None
+
+    def load(self):
+        self.file_stamp = self.get_file_stamp()
+        contents = self.read_file()
+        if contents is None:
+            return
+
+        self.entries = contents.get("entries", {})
+        self.pinned_vods = set(contents.get("pinned_vods", []))
+        self.synced_pins = set(self.pinned_vods)
+
+    def merge_pins(self):
+        """
+        Picks up the pins another process (bot.py --pin / --unpin) saved since the file was last read
+        or written, keeping the pins changed here since then. Must be called with self.lock held.
+        """
+        file_stamp = self.get_file_stamp()
+        if file_stamp == self.file_stamp:
+            return
+        self.file_stamp = file_stamp
+
+        contents = self.read_file()
+        if contents is None:
+            return
+
+        file_pins = set(contents.get("pinned_vods", []))
+        pinned_here, unpinned_here = self.pinned_vods - self.synced_pins, self.synced_pins - self.pinned_vods
+        self.pinned_vods = (file_pins | pinned_here) - unpinned_here
+        self.synced_pins = file_pins
+
+        for entry in self.entries.values():
+            entry["pinned"] = entry["twitch_vod"]["id"] in self.pinned_vods
+
+    def save(self):
+        """Must be called with self.lock held."""
+        self.merge_pins()
+        write_json_atomic(self.file_path, {"entries": self.entries, "pinned_vods": sorted(self.pinned_vods)})
+        self.synced_pins = set(self.pinned_vods)
+        self.file_stamp = self.get_file_stamp()
+
+    def sort_key(self, entry: dict) -> tuple:
+        return tuple(queue_scorers[name](entry) for name in self.order)
+
+    def sync(self, videos_needing_upload: dict, persist: bool = True, channel: str = None):
+        """
+        Updates the queue to contain exactly the given videos ({video path: twitch vod}),
+        keeping the time each video was first queued.
+        If channel is given, only that channel's entries are replaced (see channels.py).
+        """
+        with self.lock:
+            # Interrupted uploads (see upload_sessions.py) stay queued until they're resumed,
+            # even if the folder scan doesn't match them anymore
+            entries = {
+                video_path: entry for video_path, entry in self.entries.items()
+                if (entry.get("upload_url") and os.path.isfile(video_path)) or (channel is not None and get_entry_channel(entry) != channel)
+            }
+            for video_path, twitch_vod in videos_needing_upload.items():
+                entry = self.entries.get(video_path, {"video_path": video_path, "added_at": time.time()})
+                entry["twitch_vod"] = twitch_vod
+                entry["channel"] = get_vod_channel(twitch_vod).name
+                entry["file_size"] = os.path.getsize(video_path) if os.path.isfile(video_path) else entry.get("file_size", 0)
+                entry["pinned"] = twitch_vod["id"] in self.pinned_vods
+                entries[video_path] = entry
+
+            changed = entries.keys() != self.entries.keys()
+            self.entries = entries
+
+            if changed and persist:
+                self.save()
+
+    def add(self, video_path: str, twitch_vod: dict, upload_url: str = None, credential_name: str = None, uploaded_bytes: int = None):
+        """
+        Queues a single video, optionally with the upload session (and its credentials) to resume it with,
+        and the amount of bytes YouTube has confirmed receiving for that session.
+        """
+        with self.lock:
+            entry = self.entries.setdefault(video_path, {"video_path": video_path, "added_at": time.time()})
+            entry["twitch_vod"] = twitch_vod
+            entry["channel"] = get_vod_channel(twitch_vod).name
+            entry["file_size"] = os.path.getsize(video_path) if os.path.isfile(video_path) else entry.get("file_size", 0)
+            entry["pinned"] = twitch_vod["id"] in self.pinned_vods
+            entry["upload_url"] = upload_url
+            entry["credential"] = credential_name
+            entry["uploaded_bytes"] = uploaded_bytes
+            self.save()
+
+    def clear_session(self, video_path: str):
+        """Forgets the upload session of a video, once it has been resumed (or failed to)."""
+        with self.lock:
+            entry = self.entries.get(video_path)
+            if entry and entry.get("upload_url"):
+                entry["upload_url"] = entry["credential"] = entry["uploaded_bytes"] = None
+                self.save()
+
+    def remove(self, video_path: str):
+        with self.lock:
+            if self.entries.pop(video_path, None):
+                self.save()
+
+    def pin(self, twitch_vod_id: str):
+        with self.lock:
+            self.pinned_vods.add(twitch_vod_id)
+            for entry in self.entries.values():
+                entry["pinned"] = entry["twitch_vod"]["id"] in self.pinned_vods
+            self.save()
+
+    def unpin(self, twitch_vod_id: str):
+        with self.lock:
+            self.pinned_vods.discard(twitch_vod_id)
+            for entry in self.entries.values():
+                entry["pinned"] = entry["twitch_vod"]["id"] in self.pinned_vods
+            self.save()
+
+    def ordered(self) -> list:
+        """The queued entries, in the order they should be uploaded."""
+        with self.lock:
+            self.merge_pins()
+            return sorted(self.entries.values(), key=self.sort_key)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def estimate_upload_times(entries: list, model, upload_costs: list, remaining_quota: int, daily_quota: int, seconds_until_reset: float) -> list:
+    """
+    Estimates when each of the (ordered) entries will start and finish uploading, as (start, finish)
+    Unix timestamps, assuming uploads run back to back at the speeds of the throughput model (see
+    throughput.py) and wait for the quota reset whenever the remaining quota can't pay for the next one.
+    """
+    now = time.time()
+    next_reset = now + seconds_until_reset
+
+    upload_times = []
+    current_time = now
+    for entry, cost in zip(entries, upload_costs):
+        while cost > remaining_quota and daily_quota >= cost:
+            current_time = max(current_time, next_reset)
+            next_reset += 24 * 60 * 60
+            remaining_quota = daily_quota
+
+        start_time = current_time
+        remaining_quota -= cost
+        # Resumed uploads only send what YouTube doesn't have yet
+        remaining_bytes = max((entry.get("file_size") or 0) - (entry.get("uploaded_bytes") or 0), 0)
+        current_time += model.seconds_to_upload(remaining_bytes, start_time)
+        upload_times.append((start_time, current_time))
+
+        if current_time >= next_reset:
+            next_reset += 24 * 60 * 60 * ((current_time - next_reset) // (24 * 60 * 60) + 1)
+            remaining_quota = daily_quota
+
+    return upload_times
+
+
+def get_queue_order(configured: list) -> list:
+    """
+    The scorers of the configured upload_queue_order. Default scorers added in newer versions were
+    inserted into it when config.json was loaded (see config.add_new_queue_scorers()).
+    """
+    order = [name for name in configured if name in queue_scorers]
+    if len(order) != len(configured):
+        logger.error(f"Unknown upload_queue_order entries are ignored. Available: {list(queue_scorers)}")
+
+    return order
+
+
+def get_upload_queue() -> UploadQueue:
+    global upload_queue
+
+    if upload_queue is None:
+        upload_queue = UploadQueue(order=get_queue_order(config["upload_queue_order"]))
+
+    return upload_queue
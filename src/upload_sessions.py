@@ -0,0 +1,133 @@
+"""
+Checks the upload sessions left in state.json by an interrupted run, all at once, on startup.
+
+Every session gets a single "bytes */<size>" status request (no retries or backoff), and is
+classified by the response:
+- complete: YouTube already has the whole file, only the post upload steps are left
+- resumable: YouTube has part of the file, the upload continues from the confirmed offset
+- expired: the session no longer exists (or belongs to credentials that were removed),
+  a new session is requested when the video's turn in the upload queue comes
+- unreachable: the status couldn't be fetched, the upload is resumed from the offset checkpointed
+  in state.json (see shutdown.py), or retried as usual if there isn't one
+
+Sessions whose video changed since the upload started (its fingerprint differs) are treated as expired.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from state import check_in_progress_uploads, get_in_progress_upload
+from fingerprint import fingerprint_files
+
+import logging
+logger = logging.getLogger()
+
+# seconds to wait for each status response
+PROBE_TIMEOUT = 15
+PROBE_WORKERS = 8
+
+COMPLETE = "complete"
+RESUMABLE = "resumable"
+EXPIRED = "expired"
+UNREACHABLE = "unreachable"
+
+
+def probe_upload_session(session, upload_url: str, file_size: int) -> tuple:
+    """Returns (classification, bytes YouTube has received, response)."""
+    headers = {"Content-Length": "0", "Content-Range": f"bytes */{file_size}"}
+
+    try:
+        response = session.put(upload_url, headers=headers, timeout=PROBE_TIMEOUT)
+    except Exception:
+        logger.debug(f"Unable to fetch the status of {upload_url}", exc_info=True)
+        return UNREACHABLE, None, None
+
+    if response.status_code in (200, 201):
+        return COMPLETE, file_size, response
+
+    if response.status_code == 308:
+        uploaded_bytes = 0
+        if "Range" in response.headers:
+            uploaded_bytes = int(response.headers["Range"].split("-", maxsplit=1)[1]) + 1
+        return RESUMABLE, uploaded_bytes, response
+
+    if response.status_code in (404, 410):
+        return EXPIRED, None, response
+
+    return UNREACHABLE, None, response
+
+
+def probe_interrupted_uploads(credential_pool) -> list:
+    """
+    Probes every interrupted upload in state.json concurrently. Returns a list of dicts with
+    video_path, twitch_vod, upload_url, credential (a YouTubeCredential, or None), status,
+    uploaded_bytes and response.
+    """
+    sessions = []
+    for video_path, twitch_vod, upload_url, credential_name in check_in_progress_uploads():
+        # Upload urls only work with the credentials (Google API project) that requested them
+        credential = credential_pool.get(credential_name)
+        if not credential:
+            logger.warning(f"The \"{credential_name}\" YouTube credentials are no longer configured. Restarting the upload of {video_path}")
+
+        sessions.append({
+            "video_path": video_path,
+            "twitch_vod": twitch_vod,
+            "upload_url": upload_url,
+            "credential": credential,
+            "status": EXPIRED,
+            "uploaded_bytes": None,
+            "response": None,
+            "checkpoint": get_in_progress_upload(twitch_vod["id"])
+        })
+
+    fingerprints = fingerprint_files([entry["video_path"] for entry in sessions])
+    for entry in sessions:
+        saved_fingerprint = entry["checkpoint"].get("fingerprint")
+        if saved_fingerprint and fingerprints.get(entry["video_path"]) not in (None, saved_fingerprint):
+            logger.warning(f"{entry['video_path']} changed since its upload started. Restarting the upload")
+            entry["credential"] = None
+
+    def probe(entry: dict):
+        if entry["credential"] and entry["upload_url"]:
+            entry["status"], entry["uploaded_bytes"], entry["response"] = probe_upload_session(
+                entry["credential"].session, entry["upload_url"], os.path.getsize(entry["video_path"])
+            )
+
+        if entry["status"] == UNREACHABLE and entry["checkpoint"].get("uploaded_bytes") is not None:
+            entry["uploaded_bytes"] = entry["checkpoint"]["uploaded_bytes"]
+
+        logger.info(f"Interrupted upload of VOD {entry['twitch_vod']['id']} ({entry['video_path']}): {entry['status']}"
+                    + (f" at {entry['uploaded_bytes']} bytes" if entry["uploaded_bytes"] is not None else ""))
+
+    if sessions:
+        with ThreadPoolExecutor(max_workers=min(len(sessions), PROBE_WORKERS), thread_name_prefix="session-probe") as executor:
+            list(executor.map(probe, sessions))
+
+    return sessions
+
+
+def resume_interrupted_uploads(credential_pool, upload_queue, DRY_RUN_ENABLED=False):
+    """
+    Finishes the interrupted uploads YouTube already has in full (in the post upload pipeline),
+    and puts the others in the upload queue, ahead of new videos, with their session if it's still usable.
+    """
+    from upload import finish_upload
+    from state import remove_in_progress_upload
+
+    for entry in probe_interrupted_uploads(credential_pool):
+        video_path, twitch_vod = entry["video_path"], entry["twitch_vod"]
+
+        if entry["status"] == COMPLETE:
+            if DRY_RUN_ENABLED:
+                logger.info(f"[DRY RUN] The post upload steps of {video_path} would now be run")
+                continue
+            finish_upload(entry["credential"], video_path, twitch_vod, entry["response"].json())
+
+        elif entry["status"] == EXPIRED:
+            if not DRY_RUN_ENABLED:
+                remove_in_progress_upload(twitch_vod["id"])
+            upload_queue.add(video_path, twitch_vod)
+
+        else:
+            upload_queue.add(video_path, twitch_vod, entry["upload_url"], entry["credential"].name, entry["uploaded_bytes"])
@@ -0,0 +1,116 @@
+"""
+File reader used by ResumableUpload to stream a video without polluting the page cache.
+
+A recording is read exactly once, so keeping it cached only pushes out memory that OBS and the
+encoder are using. The reader asks the kernel for sequential read-ahead (POSIX_FADV_SEQUENTIAL)
+and drops everything before the current position (POSIX_FADV_DONTNEED) as it goes, since that
+data has already been sent. Optionally, O_DIRECT bypasses the page cache entirely.
+"""
+
+import os
+import mmap
+import errno
+
+import logging
+logger = logging.getLogger()
+
+# O_DIRECT needs the file offset, read size and buffer address to be aligned to the logical block size
+DIRECT_IO_ALIGNMENT = 4096
+
+
+class VideoFileReader():
+    """A minimal read-only file object (read / seek / tell / close / name) over a raw file descriptor."""
+
+    def __init__(self, path: str, direct: bool = False, drop_cache: bool = True):
+        self.name = path
+        self.position = 0
+        self.drop_cache = drop_cache and hasattr(os, "posix_fadvise")
+        self.direct = False
+        self.buffer = None
+        self.closed = False
+
+        flags = os.O_RDONLY
+        if direct and hasattr(os, "O_DIRECT"):
+            try:
+                self.fd = os.open(path, flags | os.O_DIRECT)
+                self.direct = True
+            except OSError as e:
+                # e.g. tmpfs doesn't support O_DIRECT
+                if e.errno != errno.EINVAL:
+                    raise
+                logger.warning(f"O_DIRECT isn't supported for {path}, using buffered reads")
+
+        if not self.direct:
+            self.fd = os.open(path, flags)
+
+        self.size = os.fstat(self.fd).st_size
+
+        if hasattr(os, "posix_fadvise") and not self.direct:
+            os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_SET:
+            self.position = offset
+        elif whence == os.SEEK_CUR:
+            self.position += offset
+        elif whence == os.SEEK_END:
+            self.position = self.size + offset
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def discard_cached(self, end: int):
+        """Drops the page cache for everything before end (data that has already been sent)."""
+        if self.drop_cache and end > 0:
+            os.posix_fadvise(self.fd, 0, end, os.POSIX_FADV_DONTNEED)
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = self.size - self.position
+        size = max(min(size, self.size - self.position), 0)
+
+        self.discard_cached(self.position)
+
+        if size == 0:
+            return b""
+
+        data = self.read_direct(size) if self.direct else os.pread(self.fd, size, self.position)
+        self.position += len(data)
+        return data
+
+    def read_direct(self, size: int) -> bytes:
+        """Reads through an aligned buffer, since O_DIRECT can't read into arbitrary memory."""
+        start = self.position - self.position % DIRECT_IO_ALIGNMENT
+        end = self.position + size
+        aligned_length = -(-(end - start) // DIRECT_IO_ALIGNMENT) * DIRECT_IO_ALIGNMENT
+
+        # Anonymous mmaps are page aligned
+        if self.buffer is None or len(self.buffer) < aligned_length:
+            if self.buffer is not None:
+                self.buffer.close()
+            self.buffer = mmap.mmap(-1, aligned_length)
+
+        view = memoryview(self.buffer)[:aligned_length]
+        try:
+            read_length = os.preadv(self.fd, [view], start)
+        finally:
+            view.release()
+
+        return self.buffer[self.position - start:min(read_length, end - start)]
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.discard_cached(self.size)
+        os.close(self.fd)
+        if self.buffer is not None:
+            self.buffer.close()
+        self.closed = True
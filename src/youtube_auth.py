@@ -1,16 +1,24 @@
 """
 Handles retrieving and saving OAuth credentials used to initialize an
 authenticated Requests Session for calling the YouTube Data API.
+
+Every OAuth client (Google API project) has its own token file and daily quota. Besides the
+client in youtube_client_id / youtube_client_secret ("default", data/auth.json), more can be
+listed in youtube_credentials, and a CredentialPool spreads uploads across all of them.
 """
 
 import os
+import sys
 import json
 import time
 import math
+import threading
 import webbrowser
 from requests_oauthlib import OAuth2Session
 
 from redirect_server import start_server, wait_for_auth_redirection
+from state import write_json_atomic
+from quota import get_quota_ledger
 
 from config import config
 
@@ -20,15 +28,14 @@ logger = logging.getLogger()
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__ + "/.."))
 AUTH_FILE_PATH = ROOT_DIR + "/data/auth.json"
 
-if not config["youtube_client_id"] or not config["youtube_client_secret"]:
-    print("Please enter your YouTube Client ID and YouTube Client Secret in data/config.json. (More info in the README)")
-    exit(1)
+DEFAULT_CREDENTIAL_NAME = "default"
 
+# Refresh the access token this many seconds before it expires
+TOKEN_REFRESH_MARGIN = 5 * 60
+# How long to wait before trying again after a failed background refresh
+TOKEN_REFRESH_RETRY_DELAY = 60
 
-def token_saver(auth_data):
-    """Writes the OAuth token (and related data) to AUTH_FILE_PATH."""
-    with open(AUTH_FILE_PATH, "w") as auth_file:
-        auth_file.write(json.dumps(auth_data, indent=4))
+credential_pool = None
 
 
 def after_server_start(authorization_url):
@@ -37,9 +44,6 @@ def after_server_start(authorization_url):
     webbrowser.open(authorization_url)
 
 
-client_id = config["youtube_client_id"]
-client_secret = config["youtube_client_secret"]
-
 # OAuth endpoints given in the Google API documentation
 authorization_base_url = "https://accounts.google.com/o/oauth2/v2/auth"
 token_url = "https://www.googleapis.com/oauth2/v4/token"
@@ -49,6 +53,26 @@ scope = [
     "https://www.googleapis.com/auth/userinfo.profile",
     "https://www.googleapis.com/auth/youtube.upload"
 ]
+# videos.list and videos.update, for the processing status (processing_status.py) and metadata resync (metadata_resync.py)
+read_write_scope = "https://www.googleapis.com/auth/youtube.force-ssl"
+
+
+def get_requested_scopes() -> list:
+    """The scopes asked for on consent: uploading, and reading / editing videos if a feature needs it."""
+    if config["processing_status_polling"] or config["metadata_resync_quota_share"]:
+        return scope + [read_write_scope]
+    return list(scope)
+
+
+def get_granted_scopes(auth_data: dict) -> list:
+    granted = auth_data.get("scope") or []
+    return granted.split() if isinstance(granted, str) else list(granted)
+
+
+def get_missing_scopes(auth_data: dict) -> list:
+    """The requested scopes a token wasn't granted (Google lets users leave some unchecked on the consent screen)."""
+    granted = get_granted_scopes(auth_data)
+    return [requested for requested in get_requested_scopes() if requested not in granted]
 
 
 def test_auth(google_session: dict):
@@ -60,93 +84,290 @@ def test_auth(google_session: dict):
     print(json.dumps(json.loads(r.text), indent=4))
 
 
-def init_google_session():
-    """Initializes a Requests Session with the proper headers for calling Google APIs requiring OAuth (YouTube in this case)"""
+def get_auth_file_path(name: str) -> str:
+    if name == DEFAULT_CREDENTIAL_NAME:
+        return AUTH_FILE_PATH
+    return ROOT_DIR + f"/data/auth_{name}.json"
 
-    # A server is started even when we already have credentials saved from an earlier run
-    # in case the token needs to be refreshed.
-    server_addr = start_server()
 
-    redirect_host = server_addr[0] + ":" + str(server_addr[1])
-    redirect_uri = f"http://{redirect_host}/submit_credentials"
+class YouTubeCredential():
+    """An OAuth client, its saved token (auth file), quota ledger and authenticated session."""
 
-    if os.path.isfile(AUTH_FILE_PATH):
+    def __init__(self, name: str, client_id: str, client_secret: str):
+        self.name = name
+        self.client_id = client_id
+        self.client_secret = client_secret
 
-        with open(AUTH_FILE_PATH, "r+", encoding="utf-8") as auth_file:
-            auth_data = json.loads(auth_file.read())
+        self.auth_file_path = get_auth_file_path(name)
+        self.quota_ledger = get_quota_ledger(name)
 
-            # update the "expires_in" key
-            auth_data["expires_in"] = math.floor(auth_data["expires_at"] - time.time())
+        self.session = None
+        self.token_lock = threading.Lock()
+        self.saved_auth_data = None
 
-            auth_file.truncate(0)
-            auth_file.seek(0)
+    def __repr__(self):
+        return f"YouTubeCredential({self.name})"
 
-            auth_file.write(json.dumps(auth_data, indent=4))
+    def missing_scopes(self) -> list:
+        """The requested scopes the session's token wasn't granted."""
+        return get_missing_scopes(self.session.token) if self.session else get_requested_scopes()
 
-        google = OAuth2Session(
-            client_id,
-            scope=scope,
-            token=auth_data,
-            redirect_uri=redirect_uri,
-            auto_refresh_url=token_url,
-            auto_refresh_kwargs={"client_id": client_id, "client_secret": client_secret},
-            token_updater=token_saver
-        )
+    def token_saver(self, auth_data):
+        """Writes the OAuth token (and related data) to the auth file, if it changed since the last write."""
+        with self.token_lock:
+            if auth_data == self.saved_auth_data:
+                return
 
-        return google
+            write_json_atomic(self.auth_file_path, auth_data)
+            self.saved_auth_data = dict(auth_data)
 
-    else:
+    def load_saved_token(self):
+        """Returns the token saved in the auth file (with an up to date "expires_in"), or None."""
+        if not os.path.isfile(self.auth_file_path):
+            return None
+
+        with open(self.auth_file_path, "r", encoding="utf-8") as auth_file:
+            auth_data = json.loads(auth_file.read())
 
-        google = OAuth2Session(
-            client_id,
-            scope=scope,
-            redirect_uri=redirect_uri,
-            auto_refresh_url=token_url,
-            auto_refresh_kwargs={"client_id": client_id, "client_secret": client_secret},
-            token_updater=token_saver
-        )
-
-        # Offline for refresh token
-        # Force to always make user click authorize
-        authorization_url, state = google.authorization_url(
-            authorization_base_url,
-            access_type="offline",
-            prompt="select_account"
-        )
-        redirect_response = None
-
-        def redirect_callback(handler, request_path):
-            nonlocal redirect_response
-            if request_path:
-                full_url = f"https://{redirect_host}/{request_path}"
-                redirect_response = full_url
-
-        # Get the authorization verifier code from the callback url
-        wait_for_auth_redirection(state, redirect_callback, after_server_start, authorization_url)
-
-        if redirect_response:
-
-            logger.info("Authorization was granted. Fetching auth tokens...")
-
-            # Fetch the access token (and other related data)
-            auth_data = google.fetch_token(
-                token_url,
-                client_secret=client_secret,
-                authorization_response=redirect_response
+        self.saved_auth_data = dict(auth_data)
+
+        # "expires_in" is only updated in memory, the file is left alone unless the token changes
+        auth_data["expires_in"] = math.floor(auth_data["expires_at"] - time.time())
+        return auth_data
+
+    def refresh_token(self):
+        """Refreshes the access token of the session, saving the new token."""
+        with self.token_lock:
+            auth_data = self.session.refresh_token(token_url)
+
+        self.token_saver(auth_data)
+        logger.debug(f"Refreshed the access token ({self.name}). Expires at: {auth_data.get('expires_at')}")
+        return auth_data
+
+    def start_token_refresher(self):
+        """
+        Starts a daemon thread that refreshes the access token shortly (TOKEN_REFRESH_MARGIN) before it expires,
+        so requests (such as an upload's chunk PUTs) never have to wait on a refresh.
+        """
+
+        def refresher():
+            while 1:
+                expires_at = self.session.token.get("expires_at", time.time())
+                time.sleep(max(expires_at - TOKEN_REFRESH_MARGIN - time.time(), 0))
+
+                try:
+                    self.refresh_token()
+                except Exception:
+                    logger.error(f"Unable to refresh the access token ({self.name}). Trying again in {TOKEN_REFRESH_RETRY_DELAY} seconds", exc_info=True)
+                    time.sleep(TOKEN_REFRESH_RETRY_DELAY)
+
+        thread = threading.Thread(target=refresher, name=f"token-refresher-{self.name}", daemon=True)
+        thread.start()
+        return thread
+
+    def init_session(self, force_consent: bool = False):
+        """
+        Initializes a Requests Session with the proper headers for calling Google APIs requiring OAuth (YouTube in this case).
+        force_consent asks for consent again even if a token is saved, e.g. to grant a scope it lacks.
+        """
+
+        auth_data = None if force_consent else self.load_saved_token()
+
+        if auth_data:
+            # Tokens from before a scope was requested keep working, only the features needing it are skipped
+            if get_missing_scopes(auth_data):
+                logger.warning(
+                    f"The saved \"{self.name}\" YouTube credentials weren't granted {', '.join(get_missing_scopes(auth_data))}. "
+                    f"The processing status and metadata resync are skipped for them until \"python src/youtube_auth.py --grant {self.name}\" is run"
+                )
+
+            # The redirect server is only needed for interactive consent, refreshing works without it.
+            # The session asks for the granted scopes, so refreshes don't report them as changed.
+            self.session = OAuth2Session(
+                self.client_id,
+                scope=get_granted_scopes(auth_data) or scope,
+                token=auth_data,
+                auto_refresh_url=token_url,
+                auto_refresh_kwargs={"client_id": self.client_id, "client_secret": self.client_secret},
+                token_updater=self.token_saver
             )
 
-            logger.info("Received auth tokens")
-            token_saver(auth_data)
+            self.start_token_refresher()
+            return self.session
 
-            return google
         else:
-            logger.error("Authorization must be provided in order to upload videos on your behalf")
+
+            server_addr = start_server()
+
+            redirect_host = server_addr[0] + ":" + str(server_addr[1])
+            redirect_uri = f"http://{redirect_host}/submit_credentials"
+
+            google = OAuth2Session(
+                self.client_id,
+                scope=get_requested_scopes(),
+                redirect_uri=redirect_uri,
+                auto_refresh_url=token_url,
+                auto_refresh_kwargs={"client_id": self.client_id, "client_secret": self.client_secret},
+                token_updater=self.token_saver
+            )
+
+            # Offline for refresh token
+            # Force to always make user click authorize (and grant every scope, even if an older token exists)
+            authorization_url, state = google.authorization_url(
+                authorization_base_url,
+                access_type="offline",
+                prompt="consent select_account",
+                # Incremental consent: scopes granted before are kept
+                include_granted_scopes="true"
+            )
+            redirect_response = None
+
+            def redirect_callback(handler, request_path):
+                nonlocal redirect_response
+                if request_path:
+                    full_url = f"https://{redirect_host}/{request_path}"
+                    redirect_response = full_url
+
+            logger.info(f"Authorization is needed for the \"{self.name}\" YouTube credentials")
+
+            # Get the authorization verifier code from the callback url
+            wait_for_auth_redirection(state, redirect_callback, after_server_start, authorization_url)
+
+            if redirect_response:
+
+                logger.info("Authorization was granted. Fetching auth tokens...")
+
+                # Fetch the access token (and other related data)
+                try:
+                    auth_data = google.fetch_token(
+                        token_url,
+                        client_secret=self.client_secret,
+                        authorization_response=redirect_response
+                    )
+                except Warning as e:
+                    # oauthlib raises the token as a Warning when fewer scopes were granted than requested
+                    if not hasattr(e, "token"):
+                        raise
+                    auth_data = dict(e.token)
+                    google.token = auth_data
+                    google.scope = get_granted_scopes(auth_data)
+                    logger.warning(f"Only {', '.join(get_granted_scopes(auth_data))} were granted, the features needing {', '.join(get_missing_scopes(auth_data))} are skipped")
+
+                logger.info("Received auth tokens")
+                self.token_saver(auth_data)
+
+                self.session = google
+                self.start_token_refresher()
+                return google
+            else:
+                logger.error("Authorization must be provided in order to upload videos on your behalf")
+                return None
+
+
+class CredentialPool():
+    """
+    All of the configured YouTube credentials. Uploads go to the credential with the most
+    remaining quota, and move on to another one when a credential's quota runs out.
+    """
+
+    def __init__(self, credentials: list):
+        self.credentials = credentials
+
+    def __iter__(self):
+        return iter(self.credentials)
+
+    def get(self, name: str = DEFAULT_CREDENTIAL_NAME):
+        for credential in self.credentials:
+            if credential.name == name:
+                return credential
+        return None
+
+    def init_sessions(self) -> bool:
+        """Initializes the session of every credential, dropping the ones that couldn't be authorized."""
+        self.credentials = [credential for credential in self.credentials if credential.init_session()]
+        return len(self.credentials) > 0
+
+    def remaining(self) -> int:
+        return sum(credential.quota_ledger.remaining() for credential in self.credentials)
+
+    def pick(self, units: int, names: list = None):
+        """
+        Returns the credential with the most remaining quota, if it has at least the given amount of units left.
+        names limits the choice to those credentials (e.g. the ones of a channel, see channels.py).
+        """
+        credentials = [credential for credential in self.credentials if names is None or credential.name in names]
+        if not credentials:
             return None
 
+        credential = max(credentials, key=lambda credential: credential.quota_ledger.remaining())
+        return credential if credential.quota_ledger.can_afford(units) else None
 
-def main():
+    def plan_uploads(self, costs: list, allowed_names: list = None) -> tuple:
+        """
+        Like QuotaLedger.plan_uploads, but across every credential: each upload is assigned to the
+        credential with the most quota left at that point. Returns ([(index, credential), ...], [index, ...]).
+        allowed_names optionally lists the credential names each upload can use.
+        """
+        budgets = {credential.name: credential.quota_ledger.remaining() for credential in self.credentials}
+        planned, deferred = [], []
+
+        for i, cost in enumerate(costs):
+            candidates = [name for name in budgets if allowed_names is None or name in allowed_names[i]]
+            name = max(candidates, key=budgets.get) if candidates else None
+            if name is not None and budgets[name] >= cost:
+                budgets[name] -= cost
+                planned.append((i, self.get(name)))
+            else:
+                deferred.append(i)
+
+        return planned, deferred
+
+
+def check_credentials_config():
+    if not config["youtube_client_id"] or not config["youtube_client_secret"]:
+        print("Please enter your YouTube Client ID and YouTube Client Secret in data/config.json. (More info in the README)")
+        sys.exit(1)
+
+
+def get_credential_pool() -> CredentialPool:
+    """Creates the pool from youtube_client_id / youtube_client_secret and youtube_credentials on first use."""
+    global credential_pool
+
+    if credential_pool is None:
+        check_credentials_config()
+
+        credentials = [YouTubeCredential(DEFAULT_CREDENTIAL_NAME, config["youtube_client_id"], config["youtube_client_secret"])]
+        for entry in config["youtube_credentials"]:
+            credentials.append(YouTubeCredential(entry["name"], entry["client_id"], entry["client_secret"]))
 
-    google = init_google_session()
+        credential_pool = CredentialPool(credentials)
+
+    return credential_pool
+
+
+def init_credential_pool():
+    """Returns the credential pool with every session initialized, or None if none could be authorized."""
+    pool = get_credential_pool()
+    return pool if pool.init_sessions() else None
+
+
+def init_google_session():
+    """Initializes the session of the default credentials"""
+    check_credentials_config()
+    return get_credential_pool().get(DEFAULT_CREDENTIAL_NAME).init_session()
+
+
+def main():
+    # python src/youtube_auth.py --grant [credential name]: asks for consent again, e.g. for a scope the saved token lacks
+    if "--grant" in sys.argv:
+        name = sys.argv[sys.argv.index("--grant") + 1] if len(sys.argv) > sys.argv.index("--grant") + 1 else DEFAULT_CREDENTIAL_NAME
+        credential = get_credential_pool().get(name)
+        if not credential:
+            print(f"No YouTube credentials named \"{name}\" are configured")
+            return
+        google = credential.init_session(force_consent=True)
+    else:
+        google = init_google_session()
 
     if google:
         test_auth(google)